@@ -12,17 +12,31 @@ We will store user-audio pairs in the JSON. It will be loaded on bot start.
 '''
 # necessary imports
 import os
+import time
+import bisect
+import hashlib
+process_started = time.perf_counter() # startup timing is logged from here
 try:
     import discord
     from discord.ext import commands
+    from discord import app_commands
 except ImportError:
     print("discord.py module not found. Please install it with 'pip install discord.py'")
     exit(1)
 import asyncio
 
-# Audio processing
-import wave
-import contextlib
+# Audio processing (NumPy, Flask and the webserver are imported when first needed)
+from audio_cache import SoundCache
+from catalog import SoundCatalog
+from member_sounds import MemberSoundResolver
+import playback
+import metrics
+import governor
+from voice_manager import VoiceManager
+from coalescer import VoiceEventCoalescer
+from soundboard import Soundboard
+from sound_index import SoundIndex
+from sound_files import strip_extension
 
 # bot settings stored in .env
 from dotenv import load_dotenv
@@ -53,27 +67,141 @@ if loglevel is not None:
         loglevel = 'INFO'
 else:
     loglevel = 'WARNING'
+try:
+    audio_cache_mb = int(os.getenv('DISCORD_AUDIO_CACHE_MB', 64))
+except ValueError:
+    audio_cache_mb = 64
+try:
+    queue_size = int(os.getenv('DISCORD_QUEUE_SIZE', 10))
+except ValueError:
+    queue_size = 10
+try:
+    voice_idle_timeout = float(os.getenv('DISCORD_VOICE_IDLE_TIMEOUT', 30))
+except ValueError:
+    voice_idle_timeout = 30
+try:
+    batch_window = float(os.getenv('DISCORD_BATCH_WINDOW', 2))
+    batch_max = int(os.getenv('DISCORD_BATCH_MAX', 5))
+except ValueError:
+    batch_window, batch_max = 2, 5
+try:
+    mixer_voices = int(os.getenv('DISCORD_MIXER_VOICES', 8))
+except ValueError:
+    mixer_voices = 8
+try:
+    warmup_workers = int(os.getenv('DISCORD_WARMUP_WORKERS', 2))
+except ValueError:
+    warmup_workers = 2
+# FFmpeg processes running at a time and callers allowed to wait for one, playback goes before transcoding
+try:
+    governor.configure(
+        slots={governor.PLAYBACK: int(os.getenv('FFMPEG_PLAYBACK_SLOTS', 2)), governor.TRANSCODE: int(os.getenv('FFMPEG_TRANSCODE_SLOTS', 1))},
+        backlog={governor.PLAYBACK: int(os.getenv('FFMPEG_PLAYBACK_BACKLOG', 4)), governor.TRANSCODE: int(os.getenv('FFMPEG_TRANSCODE_BACKLOG', 16))}
+    )
+except ValueError:
+    pass
+# Sharding: DISCORD_SHARD_COUNT shards (a number, or auto) split over DISCORD_SHARD_PROCESSES bot processes
+try:
+    shard_processes = max(1, int(os.getenv('DISCORD_SHARD_PROCESSES', 1)))
+except ValueError:
+    shard_processes = 1
+shard_count = os.getenv('DISCORD_SHARD_COUNT')
+try:
+    shard_count = int(shard_count) if shard_count and shard_count.lower() != 'auto' else None
+except ValueError:
+    shard_count = None
+sharded = shard_count is not None or os.getenv('DISCORD_SHARD_COUNT', '').lower() == 'auto' or shard_processes > 1
+# Set by the supervisor for the bot processes it starts (see shards.py)
+shard_worker = os.getenv('HEYHEY_SHARD_WORKER')
+shard_ids = [int(i) for i in os.getenv('HEYHEY_SHARD_IDS', '').split(',') if i] or None
+if shard_worker is not None:
+    shard_count = int(os.getenv('HEYHEY_SHARD_COUNT'))
+is_supervisor = shard_processes > 1 and shard_worker is None
+# Decoded sounds shared by bot processes through a memory mapped file, always used with several processes
+sound_pack_path = os.getenv('SOUND_PACK') or ('./data/sounds.pack' if shard_processes > 1 else None)
 
 stop_button = '⏹️ Stop '
 
 # logging (rotate log every 1 MB, keep 5 old logs)
+# Records are put on a queue and written to the file by a listener thread, so the event loop never waits for disk
+import atexit
+import queue
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 logger = logging.getLogger('HeyHeyBot')
 loglevel = getattr(logging, loglevel)
 logger.setLevel(loglevel)
-handler = RotatingFileHandler('logs/heyheybot.log', maxBytes=1000000, backupCount=5, encoding='utf-8')
+# every bot process has its own log
+log_file = 'logs/heyheybot.log' if shard_worker is None else f'logs/heyheybot.worker{shard_worker}.log'
+handler = RotatingFileHandler(log_file, maxBytes=1000000, backupCount=5, encoding='utf-8')
 handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s'))
-logger.addHandler(handler)
+log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(log_queue))
+log_listener = QueueListener(log_queue, handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# Index of sound files, loaded once and kept up to date instead of listing folders on every command
+# Bot processes started by the supervisor never scan the folders: they follow the catalog file the supervisor writes
+sound_folders = ('./data/audio', './data/greetings', './data/leavings', './data/mutings')
+catalog = SoundCatalog(os.getenv('SOUND_CATALOG', './data/catalog.json'), read_only=shard_worker is not None)
+catalog.load(*sound_folders)
+# load() only lists files: folders are checked and new files are hashed and analyzed in a background thread,
+# never before the bot connects or on the bot loop
+catalog.watch()
+logger.info(f'Sound catalog: {catalog.stats()}')
 
-# Start webpage in separate thread
-if os.getenv('WEBPAGE_USERNAME') and os.getenv('WEBPAGE_PASSWORD'):
-    from webserver import WebApp
-    import threading
-    webapp = WebApp()
-    webapp_thread = threading.Thread(target=webapp.run)
-    webapp_thread.start()
-    logger.info(f'Webpage started')
+# Sound pack is written by the process that owns the catalog and read by the ones that play sounds
+sound_pack = pack_builder = None
+if sound_pack_path:
+    from sound_pack import SoundPack, PackBuilder
+    if shard_worker is None:
+        pack_builder = PackBuilder(sound_pack_path, catalog, sound_folders).start()
+    if not is_supervisor:
+        sound_pack = SoundPack(sound_pack_path, catalog=catalog)
+
+def start_webpage(on_change):
+    # Start webpage in separate thread, Flask is imported there so the bot doesn't wait for it to log in
+    if os.getenv('WEBPAGE_USERNAME') and os.getenv('WEBPAGE_PASSWORD'):
+        import threading
+        def run_webpage():
+            from webserver import WebApp
+            webapp = WebApp(on_change=on_change, catalog=catalog)
+            logger.info(f'Webpage started {time.perf_counter() - process_started:.1f} s after start')
+            webapp.run()
+        webapp_thread = threading.Thread(target=run_webpage, name='webpage')
+        webapp_thread.start()
+
+# Several bot processes: this process only runs the webpage and the sound pack, and supervises the bots
+if is_supervisor:
+    from shards import ShardSupervisor
+    catalog.on_change = pack_builder.schedule
+    start_webpage(on_change=pack_builder.schedule)
+    ShardSupervisor(shard_count or shard_processes, shard_processes).run()
+    log_listener.stop()
+    os._exit(0) # webpage thread doesn't stop by itself
+
+# Personal announcement sounds of members, cached per member id (also when member has no personal sound)
+resolver = MemberSoundResolver(catalog.find)
+
+# Soundboard messages posted by !playsound, edited when sounds are added or removed
+soundboard = Soundboard(lambda: catalog.names('./data/audio'),
+                        path='./data/soundboards.json' if shard_worker is None else f'./data/soundboards.worker{shard_worker}.json')
+
+def sounds_changed(*files):
+    # Called from the webserver thread and by the catalog when sound files are replaced or removed
+    # Resolver cache is only touched on the bot loop, notify() passes files over to it
+    sound_cache.invalidate(*files)
+    resolver.notify(*files)
+    if any(os.path.dirname(os.path.normpath(file)) == os.path.normpath('./data/audio') for file in files):
+        soundboard.notify()
+    if pack_builder is not None:
+        pack_builder.schedule()
+catalog.on_change = sounds_changed
+
+# Bot processes started by the supervisor leave the webpage to it
+if shard_worker is None:
+    start_webpage(on_change=sounds_changed)
 
 # start bot
 intents = discord.Intents.default()
@@ -84,114 +212,215 @@ intents.voice_states = True
 intents.presences = True
 intents.guilds = True
 
-client = commands.Bot(
-    command_prefix=commands.when_mentioned_or('!'),
-    description='HeyHeyBot',
-    intents=intents
-)
+if sharded:
+    # shard_ids is None unless started by the supervisor: all shards in this process
+    client = commands.AutoShardedBot(
+        command_prefix=commands.when_mentioned_or('!'),
+        description='HeyHeyBot',
+        intents=intents,
+        shard_count=shard_count,
+        shard_ids=shard_ids
+    )
+else:
+    client = commands.Bot(
+        command_prefix=commands.when_mentioned_or('!'),
+        description='HeyHeyBot',
+        intents=intents
+    )
+
+# Tasks started by event handlers, kept until they are done (the loop only keeps weak references to tasks)
+background_tasks = set()
+
+def start_task(coroutine, description):
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    def done(task):
+        background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f'{description} failed: {task.exception()!r}')
+    task.add_done_callback(done)
+    return task
 
 @client.event
 async def on_ready():
+    global commands_synced, warmed_up
+    resolver.bind()
+    if not warmed_up:
+        warmed_up = True
+        logger.info(f'Ready {time.perf_counter() - process_started:.1f} s after start')
+        start_task(warm_up(), 'Warm-up')
+    if not commands_synced and (shard_ids is None or 0 in shard_ids):
+        # on_ready runs again after reconnects, slash commands are registered once per start (by one bot process)
+        try:
+            await client.tree.sync()
+            commands_synced = True
+        except discord.HTTPException as e:
+            logger.warning(f'Could not register slash commands: {e}')
+    # sounds could have changed while the bot was offline
+    start_task(soundboard.refresh(), 'Soundboard refresh')
     logger.info('======')
     logger.info(f'Bot logged in as {client.user.name} (ID: {client.user.id})')
     logger.info(f'Connected to {len(client.guilds)} servers: {", ".join([guild.name for guild in client.guilds])}')
     logger.info(f'Bot is ready. Rich presence: {continue_presence}, arrival announce: {arrivial_announce}, muting announce: {muting_announce}, leaving announce: {leaving_announce}')
+    logger.info(f'Audio cache budget: {audio_cache_mb} MB, voice idle timeout: {voice_idle_timeout} s')
     logger.info('======')
 
 # Play audio file from ./data/audio folder
-sounds = {} # {filename: {'source': <discord.PCMVolumeTransformer>, 'duration': <int>}}
-async def wav_length(audio_file):
-    with contextlib.closing(wave.open(audio_file,'r')) as f:
-        frames = f.getnframes()
-        rate = f.getframerate()
-        audiolen = frames / float(rate)
-    return audiolen
-
-# returns BufferedIOBase from given sound path
-async def get_buffered_io(file):
-    return open(file, 'rb')
-
-# We are storing audio files in the dictionary to avoid opening the same file multiple times
-async def cached_sounds(audio_file):
-    if audio_file not in sounds:
-        sounds[audio_file] = {
-            'source': audio_file,
-            'duration': await wav_length(audio_file)
-        }
-        logger.debug(f'Playing {audio_file}')
-    else:
-        logger.debug(f'Playing {audio_file} from cache')
-    return sounds[audio_file]['source'], sounds[audio_file]['duration']
+sound_cache = SoundCache(max_bytes=audio_cache_mb * 1024 * 1024, pack=sound_pack) # decoded PCM, LRU by size
+
+# We are storing decoded audio in memory to avoid spawning FFmpeg for every playback
+# Several files are returned as one source that plays them back to back
+# pcm=True always returns decoded audio (for mixing), even for .opus files
+async def cached_sounds(audio_files, pcm=False):
+    if any(sound_cache.duration(audio_file, pcm=pcm) is None for audio_file in audio_files):
+        logger.debug(f'Playing {", ".join(audio_files)}')
+        # decoding reads the whole file, keep it off the event loop
+        result = await asyncio.to_thread(sound_cache.source, *audio_files, pcm=pcm)
+        logger.debug(f'Audio cache: {sound_cache.stats()}')
+        return result
+    logger.debug(f'Playing {", ".join(audio_files)} from cache')
+    return sound_cache.source(*audio_files, pcm=pcm)
 
-@client.command()
-async def play(client, audio_file, audiolen=5, default='./data/greetings/hello.wav'):
+async def play(channel, audio_files, priority=playback.SOUNDBOARD, default='./data/greetings/hello.wav', received=None):
+    # Queue audio file(s) (.opus or .wav, whichever exists) in the guild of the channel
+    # Returns a future that resolves when the sound has been played, or None if nothing was queued
+    if isinstance(audio_files, str):
+        audio_files = [audio_files]
+    audio_files = [catalog.find(audio_file) or catalog.find(default) for audio_file in audio_files]
+    if None in audio_files:
+        logger.warning(f'No audio file to play, default {default} is missing')
+        return None
     try:
-        # Play audio file
-        if not os.path.isfile(audio_file):
-            audio_file = default
-        sound, audiolen = await cached_sounds(audio_file)
-        sound = discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(sound), volume=1)
-        client.voice_clients[0].play(sound, after=lambda e: logger.exception(f'Player error') if e else None)
-        # wait until audio is played
-        await asyncio.sleep(audiolen + 1)
-    except discord.errors.ClientException as e:
-        # if bot is already playing audio file
-        if 'Already playing audio' in str(e):
-            # stop playing
-            client.voice_clients[0].stop()
-            # play audio file
-            await play(client, audio_file, audiolen, default)
-        else:
-            logger.error(f'Error playing audio file (ClientException): {e}')
-            return
-    except Exception as e:
-        logger.error(f'Error playing audio file: {e}')
-        return
+        return scheduler.enqueue(channel, audio_files, priority, received)
+    except playback.QueueFull as e:
+        logger.warning(f'{e}, skipping {", ".join(audio_files)}')
+        return None
+
+# Announcement sounds: folder with personal sounds and default sound for every event kind
+announcements = {
+    playback.GREETING: ('./data/greetings', 'hello.wav'),
+    playback.LEAVE: ('./data/leavings', 'bye.wav'),
+    playback.MUTE: ('./data/mutings', 'muted.wav')
+}
 
-# List all audio files in ./data/audio folder
+async def announce(channel, kind, members, condensed=False, received=None):
+    # Play personal sounds of members back to back, or just the default sound for a big crowd
+    folder, default = announcements[kind]
+    if condensed:
+        audio_files = [f'{folder}/{default}']
+    else:
+        audio_files = [resolver.resolve(folder, member) or f'{folder}/{default}' for member in members]
+    logger.debug(f'Member sounds: {resolver.stats()}')
+    await play(channel, audio_files, kind, default=f'{folder}/{default}', received=received)
+
+# List all audio files in ./data/audio folder (same sound can exist both as .wav and .opus, it is listed once)
 async def list_audio_files(sort=True):
-    audio_files = []
-    for file in os.listdir('./data/audio'):
-        if file.endswith('.wav'):
-            file = file[:-4]
-            audio_files.append(file)
-    if sort:
-        audio_files.sort()
-    return audio_files
-
-# Disconnect from voice channel
-@client.command()
-async def vc_disconnect(client, force=False):
-    try:
-        if continue_presence and not force:
-            # check if any user is in a current voice channel
-            current_voice_channel = client.voice_clients[0].channel
-            if len(current_voice_channel.members) == 1:
-                # if no users in a current voice channel, disconnect
-                logger.info(f'No users in {current_voice_channel.name}, disconnecting')
-                await client.voice_clients[0].disconnect()
-            else:
-                # if users in a current voice channel, do nothing
+    return list(catalog.names('./data/audio')) # sorted by the catalog
+
+# Voice connection is kept per guild and reused between sounds
+voice = VoiceManager(idle_timeout=voice_idle_timeout, stay_with_users=continue_presence)
+
+# Sounds are played one by one per guild, connection is released when the guild queue is empty
+scheduler = playback.PlaybackScheduler(
+    load_source=cached_sounds,
+    connect=voice.connect,
+    on_idle=voice.release,
+    max_queue=queue_size,
+    max_voices=mixer_voices
+)
+
+# Bursts of voice events in a channel are announced together
+coalescer = VoiceEventCoalescer(announce, window=batch_window, max_batch=batch_max)
+
+# Warm-up after start: the first announcements shouldn't pay for decoding, loading Opus and importing NumPy
+warmed_up = False
+first_announcement = None
+
+async def warm_up():
+    start = time.perf_counter()
+    # default sounds and personal sounds of members already in voice, for the announcements that are enabled
+    enabled = [kind for kind, on in ((playback.GREETING, arrivial_announce), (playback.LEAVE, leaving_announce), (playback.MUTE, muting_announce)) if on]
+    audio_files = [f'{announcements[kind][0]}/{announcements[kind][1]}' for kind in enabled]
+    for guild in client.guilds:
+        for channel in guild.voice_channels:
+            for member in channel.members:
+                if not member.bot:
+                    audio_files.extend(resolver.resolve(announcements[kind][0], member) for kind in enabled)
+    audio_files = list(dict.fromkeys(path for path in map(catalog.find, filter(None, audio_files)) if path))
+    semaphore = asyncio.Semaphore(max(warmup_workers, 1))
+    loaded = 0
+
+    async def load(audio_file):
+        nonlocal loaded
+        async with semaphore:
+            # keep half of the cache for sounds that are actually played
+            if sound_cache.size > sound_cache.max_bytes // 2:
                 return
-        await client.voice_clients[0].disconnect()
-    except Exception as e:
-        logger.warning(f'Error disconnecting from voice channel: {e}')
+            try:
+                await asyncio.to_thread(sound_cache.get, audio_file)
+                loaded += 1
+            except Exception as e:
+                logger.warning(f'Warm-up: could not load {audio_file}: {e!r}')
 
-async def is_same_channel(client, channel):
+    async def load_opus():
+        if discord.opus.is_loaded():
+            return
+        import ctypes.util
+        library = await asyncio.to_thread(ctypes.util.find_library, 'opus')
+        if library is None:
+            logger.warning('Warm-up: libopus not found, it is loaded when the bot first connects to voice')
+            return
+        try:
+            await asyncio.to_thread(discord.opus.load_opus, library)
+        except OSError as e:
+            logger.warning(f'Warm-up: could not load {library}: {e}')
+
+    async def import_numpy():
+        # the mixer imports it with the first soundboard sound
+        import importlib
+        await asyncio.to_thread(importlib.import_module, 'numpy')
+
+    await asyncio.gather(load_opus(), import_numpy(), *map(load, audio_files))
+    logger.info(f'Warm-up: {loaded} of {len(audio_files)} sounds loaded in {time.perf_counter() - start:.2f} s '
+                f'({time.perf_counter() - process_started:.1f} s after start)')
+
+def played(item, first_frame):
+    # Called by the scheduler when a sound was played, the first announcement after start is logged
+    global first_announcement
+    if first_announcement is None and item.priority != playback.SOUNDBOARD:
+        first_announcement = first_frame
+        logger.info(f'First announcement started {first_frame - process_started:.1f} s after start, '
+                    f'{first_frame - item.received:.2f} s after its event')
+scheduler.on_played = played
+
+# Values the components count themselves, read when /metrics is requested
+metrics.collect('heyhey_sound_cache_bytes', 'gauge', 'Size of audio held in the sound cache', lambda: sound_cache.size)
+metrics.collect('heyhey_sound_cache_evictions_total', 'counter', 'Sounds evicted from the sound cache', lambda: sound_cache.evictions)
+if sound_pack is not None:
+    metrics.collect('heyhey_sound_pack_bytes', 'gauge', 'Size of the mapped sound pack', lambda: sound_pack.stats()['bytes'])
+metrics.collect('heyhey_member_sound_requests_total', 'counter', 'Lookups of personal announcement sounds',
+                lambda: [({'result': 'hit'}, resolver.hits), ({'result': 'miss'}, resolver.misses)])
+metrics.collect('heyhey_playback_queue_length', 'gauge', 'Sounds waiting to be played in all guilds',
+                lambda: sum(len(guild_queue.items) for guild_queue in scheduler.queues.values()))
+metrics.collect('heyhey_voice_connections', 'gauge', 'Connected voice clients', lambda: len(client.voice_clients))
+
+async def is_same_channel(channel):
     # Check if user joins same voice channel as bot currently in
     # We don't want to play audio if person joins another voice channel
-    bot_current_vc = client.voice_clients[0].channel if client.voice_clients else None
+    voice_client = channel.guild.voice_client
+    bot_current_vc = voice_client.channel if voice_client else None
     logger.info(f'User joined {channel}, bot in {bot_current_vc}')
     if bot_current_vc is None:
-        print('bot_current_vc is None')
+        logger.debug('Bot is not in a voice channel')
         return True
     if bot_current_vc != channel:
-        print('not same channel')
+        logger.debug('Bot is in another voice channel')
         return False
-    print('same channel')
+    logger.debug('Bot is in the same voice channel')
     return True
 
 # logger.info username and channel name when user joins voice channel
+# Handlers only pass events to the coalescer, playback and disconnect are done by the scheduler
 @client.event
 async def on_voice_state_update(member, before, after):
     # If bot ignore
@@ -200,122 +429,139 @@ async def on_voice_state_update(member, before, after):
     # If other bot ignore
     if member.bot:
         return
+    # Last user left the bot's channel, start idle countdown even if nothing is announced
+    voice_client = member.guild.voice_client
+    if voice_client is not None and voice_client.channel == before.channel and not voice.has_users(member.guild) and not scheduler.is_busy(member.guild):
+        await voice.release(member.guild)
     if before.channel is None and after.channel is not None:
         if arrivial_announce:
             # When user joins voice channel (user was not in voice channel before)
             logger.info(f'{member.name} joined {after.channel.name}')
-            # Join the same voice channel
-            channel = after.channel
-            try:
-                await channel.connect()
-            except:
-                pass
-            if continue_presence and not await is_same_channel(client, channel):
+            if continue_presence and not await is_same_channel(after.channel):
                 return
-            # Play audio file
-            await play(client, f'./data/greetings/{member.name}.wav', default='./data/greetings/hello.wav')
-            # Disconnect from the voice channel
-            await vc_disconnect(client)
+            coalescer.add(after.channel, member, playback.GREETING)
     elif before.channel is not None and after.channel is None:
         if leaving_announce:
             # When user leaves voice channel (user was in voice channel before)
             logger.info(f'{member.name} left {before.channel.name}')
-            # Leave the voice channel announce
-            channel = before.channel
-            try:
-                await channel.connect()
-            except:
-                pass
-            if continue_presence and not await is_same_channel(client, channel):
+            if continue_presence and not await is_same_channel(before.channel):
                 return
-            # Play audio file
-            await play(client, f'./data/leavings/{member.name}.wav', audiolen=1, default='./data/leavings/bye.wav')
-            # Disconnect from the voice channel
-            await vc_disconnect(client) 
+            coalescer.add(before.channel, member, playback.LEAVE)
     elif before.channel != after.channel:
         if arrivial_announce:
             # When user moves from one voice channel to another
             logger.info(f'{member.name} moved from {before.channel.name} to {after.channel.name}')
-            # Disconnect from the previous voice channel
-            await vc_disconnect(client, force=True)
-            # Join the new voice channel
-            try:
-                await after.channel.connect()
-            except Exception as e:
-                logger.error(f'Error joining {after.channel.name}: {e}')
-            if continue_presence and not await is_same_channel(client, after.channel):
-                return
-            # Play audio file
-            await play(client, f'./data/greetings/{member.name}.wav', default='./data/greetings/hello.wav')
-            # Disconnect from the voice channel
-            await vc_disconnect(client)
+            # Bot follows the user to the new channel (scheduler moves the voice connection)
+            coalescer.discard(before.channel, member)
+            coalescer.add(after.channel, member, playback.GREETING)
     else:
         if muting_announce:
             # When user mutes/unmutes
             logger.info(f'{member.name} muted/unmuted')
-            # Join the voice channel
-            channel = after.channel
-            try:
-                await channel.connect()
-            except:
-                pass
-            if continue_presence and not await is_same_channel(client, channel):
+            if continue_presence and not await is_same_channel(after.channel):
                 return
-            # Play audio file
-            await play(client, f'./data/mutings/{member.name}.wav', default='./data/mutings/muted.wav')
-            # Disconnect from the voice channel
-            await vc_disconnect(client)
+            coalescer.add(after.channel, member, playback.MUTE)
+
+# Sound and stop buttons of soundboard messages
+async def stop_sounds(interaction):
+    scheduler.stop(interaction.guild)
+    await interaction.response.send_message(f'⏹️ Stopped', ephemeral=True, silent=True, delete_after=1)
+
+def is_sound(audio_file):
+    # Only sounds listed in ./data/audio can be played: a name typed into /play could contain a path to any file
+    names = catalog.names('./data/audio') # sorted
+    name = strip_extension(audio_file)
+    i = bisect.bisect_left(names, name)
+    return i < len(names) and names[i] == name
+
+async def play_sound(interaction, audio_file):
+    if interaction.user.voice is None:
+        await interaction.response.send_message(f'⭕ You are not in voice channel', ephemeral=True, delete_after=3)
+        return
+    audio_path = catalog.find(f'./data/audio/{audio_file}') if is_sound(audio_file) else None
+    if audio_path is None:
+        await interaction.response.send_message(f'⭕ {audio_file} not found', ephemeral=True, delete_after=3)
+        return
+    # Loading the sound can take longer than Discord waits for an answer (3 s): the interaction is acknowledged
+    # first and the result is sent as a follow-up
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    # Mix audio file with other soundboard sounds in the user's voice channel
+    try:
+        await scheduler.mix(interaction.user.voice.channel, audio_path)
+    except playback.QueueFull as e:
+        logger.info(f'{e}, skipping {audio_path}')
+        await followup(interaction, f'⭕ Can\'t play {audio_file} right now', delete_after=3)
+        return
+    except governor.Busy:
+        # every decoding slot is taken and others wait already, answer right away instead of queueing
+        logger.info(f'Too many sounds are being decoded, skipping {audio_path}')
+        await followup(interaction, f'⏳ Bot is busy, try {audio_file} again in a moment', delete_after=3)
+        return
+    except Exception as e:
+        logger.error(f'Error loading {audio_path}: {e!r}')
+        await followup(interaction, f'⭕ Could not play {audio_file}', delete_after=3)
+        return
+    # audio length from cache, or from the catalog (exact length of the trimmed sound) if it isn't loaded yet
+    audiolen = sound_cache.duration(audio_path, pcm=True) or getattr(catalog.entry(audio_path), 'duration', None) or 1
+    await followup(interaction, f'▶️ Playing: {audio_file}', delete_after=audiolen, silent=True)
 
-# Process button press
+async def followup(interaction, content, delete_after, **kwargs):
+    # Ephemeral answer to a deferred interaction, removed after delete_after seconds like send_message(delete_after=...)
+    try:
+        message = await interaction.followup.send(content, ephemeral=True, wait=True, **kwargs)
+        await message.delete(delay=delete_after)
+    except discord.HTTPException as e:
+        logger.warning(f'Could not answer interaction: {e}')
+
+# Board buttons are registered once and work after restarts (custom_id holds the sound name or page)
+soundboard.setup(client, play=play_sound, stop=stop_sounds)
+
+# Process button press on messages posted before boards were persistent (custom_id is the sound name)
 @client.event
 async def on_interaction(interaction):
-    # Get audio file name
+    if interaction.type != discord.InteractionType.component:
+        return
     audio_file = interaction.data['custom_id']
+    if Soundboard.is_board_item(audio_file):
+        return # handled by the soundboard
     if audio_file == stop_button:
-        client.voice_clients[0].stop()
-        await interaction.response.send_message(f'⏹️ Stopped', ephemeral=True, silent=True, delete_after=1)
-    try:
-        audiolen = sounds[f'./data/audio/{audio_file}.wav']['duration'] # audio length from cache
-    except:
-        audiolen = 1 # default audio length
-    await interaction.response.send_message(f'▶️ Playing: {audio_file}', ephemeral=True, silent=True, delete_after=audiolen)
-    # Join the voice channel
-    if interaction.user.voice is None:
-        await interaction.response.send_message(f'⭕ You are not in voice channel', ephemeral=True, delete_after=3)
+        await stop_sounds(interaction)
         return
-    channel = interaction.user.voice.channel
-    try:
-        await channel.connect()
-    except:
-        pass
-    # Play audio file
-    await play(client, f'./data/audio/{audio_file}.wav')
-    # # Delete message
-    # await interaction.message.delete()
-    # Disconnect from the voice channel
-    await vc_disconnect(client)
-
-# Display buttons with audio files when user types !playsound
+    await play_sound(interaction, audio_file)
+
+# /play <sound> with autocomplete over sound names
+# Index follows the catalog: names tuple is cached by the catalog until files change, then only the difference is indexed
+sound_index = SoundIndex()
+commands_synced = False
+
+@client.tree.command(name='play', description='Play a sound from the soundboard')
+@app_commands.guild_only()
+@app_commands.describe(sound='Name of the sound')
+async def play_command(interaction, sound: str):
+    await play_sound(interaction, sound_name(sound))
+
+# Discord allows choice values of up to 100 characters, a longer name is sent as a hash of it
+def choice_value(name):
+    return name if len(name) <= 100 else f'#{hashlib.sha1(name.encode("utf-8")).hexdigest()}'
+
+def sound_name(value):
+    # Name of the sound a choice value stands for, anything else (typed by the user) is returned as is
+    if value.startswith('#'):
+        for name in catalog.names('./data/audio'):
+            if len(name) > 100 and choice_value(name) == value:
+                return name
+    return value
+
+@play_command.autocomplete('sound')
+async def play_autocomplete(interaction, current):
+    sound_index.sync(catalog.names('./data/audio'))
+    return [app_commands.Choice(name=name[:100], value=choice_value(name)) for name in sound_index.search(current, 25)]
+
+# Post a soundboard (one message, pages are turned in place) when user types !playsound
 @client.event
 async def on_message(message):
     if message.content.startswith('!playsound'):
-        # Get list of audio files
-        audio_files = await list_audio_files()
-        # Append stop button
-        audio_files.append(stop_button)
-        # Split to 25 files per button
-        buttons_groups = [audio_files[i:i + 25] for i in range(0, len(audio_files), 25)]
-        for group in buttons_groups:
-            # Create buttons
-            buttons = []
-            for file in group:
-                buttons.append(discord.ui.Button(label=file, custom_id=file))
-            # Create view
-            view = discord.ui.View()
-            for button in buttons:
-                view.add_item(button)
-            # Send message
-            await message.channel.send('', view=view)
+        await soundboard.post(message.channel)
     await client.process_commands(message)
 
 # Run bot
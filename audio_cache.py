@@ -0,0 +1,357 @@
+'''
+In-memory cache of decoded audio for the bot.
+
+Sounds are decoded once to 48 kHz s16le stereo PCM (the format discord.py sends to the Opus encoder)
+and kept in memory up to a configurable byte budget. Least recently used sounds are evicted first.
+Playback reads 20 ms frames straight from memory, so no FFmpeg process is spawned for cached sounds.
+
+Ogg Opus files (AUDIO_FORMAT=opus) are not decoded at all: their packets are cached as they are
+and sent to Discord without re-encoding.
+
+With a sound pack (sound_pack.py) sounds are read from the shared memory map first, only sounds that are
+missing from it or changed since it was written are decoded into the cache.
+'''
+import os
+import time
+import wave
+import threading
+import subprocess
+import contextlib
+from collections import OrderedDict
+
+import discord
+from discord.oggparse import OggStream, OggError
+
+import metrics
+import governor
+
+SAMPLE_RATE = 48000
+CHANNELS = 2
+SAMPLE_WIDTH = 2
+FRAME_SIZE = SAMPLE_RATE // 50 * CHANNELS * SAMPLE_WIDTH # 20 ms of audio, 3840 bytes
+BYTES_PER_SECOND = SAMPLE_RATE * CHANNELS * SAMPLE_WIDTH
+FRAME_DURATION = 0.02
+
+CACHE_REQUESTS = metrics.counter('heyhey_sound_cache_requests_total', 'Sound cache lookups', ('result',))
+DECODE_SECONDS = metrics.histogram('heyhey_sound_decode_seconds', 'Time to load a sound into the cache', ('method',))
+
+
+class CachedPCMAudio(discord.AudioSource):
+    '''
+    Audio source that plays PCM data already held in memory.
+    Data must be 48 kHz s16le stereo, padded to a whole number of frames.
+    '''
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self):
+        chunk = self.data[self.position:self.position + FRAME_SIZE]
+        self.position += FRAME_SIZE
+        if len(chunk) != FRAME_SIZE:
+            return b''
+        return chunk
+
+    def is_opus(self):
+        return False
+
+
+class CachedOpusAudio(discord.AudioSource):
+    '''
+    Audio source that plays Opus packets already held in memory, one 20 ms packet per read.
+    '''
+    def __init__(self, packets):
+        self.packets = packets
+        self.position = 0
+
+    def read(self):
+        if self.position >= len(self.packets):
+            return b''
+        packet = self.packets[self.position]
+        self.position += 1
+        return packet
+
+    def is_opus(self):
+        return True
+
+
+class ConcatAudio(discord.AudioSource):
+    '''
+    Plays several sources back to back as a single source. All sources must be either PCM or Opus.
+    '''
+    def __init__(self, sources):
+        self.sources = sources
+        self.index = 0
+
+    def read(self):
+        while self.index < len(self.sources):
+            data = self.sources[self.index].read()
+            if data:
+                return data
+            self.index += 1
+        return b''
+
+    def is_opus(self):
+        return self.sources[0].is_opus()
+
+    def cleanup(self):
+        for source in self.sources:
+            source.cleanup()
+
+
+class TimedAudio(discord.AudioSource):
+    '''
+    Wraps a source and records when the player read its first frame (perf_counter() time, in first_frame),
+    i.e. when the sound started to go out.
+    '''
+    def __init__(self, source):
+        self.source = source
+        self.first_frame = None
+
+    def read(self):
+        data = self.source.read()
+        if self.first_frame is None:
+            self.first_frame = time.perf_counter()
+        return data
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
+
+
+class CacheEntry:
+    '''
+    Decoded PCM of a single sound.
+    '''
+    opus = False
+
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+        self.duration = self.size / BYTES_PER_SECOND
+
+    def source(self):
+        return CachedPCMAudio(self.data)
+
+
+class OpusCacheEntry:
+    '''
+    Opus packets of a single sound, 20 ms each.
+    '''
+    opus = True
+
+    def __init__(self, packets):
+        self.packets = packets
+        self.size = sum(len(packet) for packet in packets)
+        self.duration = len(packets) * FRAME_DURATION
+
+    def source(self):
+        return CachedOpusAudio(self.packets)
+
+
+def opus_packet_duration(packet):
+    '''
+    Returns duration of an Opus packet in seconds, read from its TOC byte (RFC 6716, section 3.1).
+    '''
+    toc = packet[0]
+    config = toc >> 3
+    if config < 12:
+        frame = (0.01, 0.02, 0.04, 0.06)[config % 4]
+    elif config < 16:
+        frame = (0.01, 0.02)[config % 2]
+    else:
+        frame = (0.0025, 0.005, 0.01, 0.02)[config % 4]
+    code = toc & 0x03
+    if code == 0:
+        frames = 1
+    elif code in (1, 2):
+        frames = 2
+    else:
+        frames = packet[1] & 0x3F
+    return frame * frames
+
+
+def read_opus_packets(audio_file):
+    '''
+    Reads Opus packets from an Ogg Opus file without decoding them.
+    Returns None if the file can not be sent as is (not Opus, or packets are not 20 ms long).
+    '''
+    packets = []
+    try:
+        with open(audio_file, 'rb') as f:
+            for packet in OggStream(f).iter_packets():
+                if packet.startswith((b'OpusHead', b'OpusTags')):
+                    continue
+                if not packet or abs(opus_packet_duration(packet) - FRAME_DURATION) > 1e-6:
+                    return None
+                packets.append(packet)
+    except (OggError, IndexError):
+        return None
+    return packets
+
+
+def decode_pcm(audio_file, kind=governor.PLAYBACK):
+    '''
+    Decodes audio file to 48 kHz s16le stereo PCM.
+    WAV files that are already in this format (everything converted by the webserver) are read directly,
+    anything else is decoded with FFmpeg once, in a slot of the governor (`kind` of work, raises governor.Busy).
+    '''
+    data = None
+    with contextlib.suppress(wave.Error, EOFError):
+        with contextlib.closing(wave.open(audio_file, 'rb')) as f:
+            if (f.getframerate(), f.getnchannels(), f.getsampwidth()) == (SAMPLE_RATE, CHANNELS, SAMPLE_WIDTH):
+                data = f.readframes(f.getnframes())
+    if data is None:
+        with governor.slot(kind):
+            metrics.FFMPEG_SPAWNS.inc(purpose='decode')
+            data = subprocess.run(
+                governor.command(kind, ['ffmpeg', '-v', 'error', '-i', audio_file, '-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', str(CHANNELS), 'pipe:1']),
+                stdout=subprocess.PIPE, stdin=subprocess.DEVNULL, check=True
+            ).stdout
+    # pad last frame with silence so every read returns a full frame
+    remainder = len(data) % FRAME_SIZE
+    if remainder:
+        data += b'\x00' * (FRAME_SIZE - remainder)
+    return data
+
+
+def load_entry(audio_file, pcm=False):
+    '''
+    Loads a sound for caching: Opus packets as they are when possible, decoded PCM otherwise.
+    '''
+    if audio_file.lower().endswith('.opus') and not pcm:
+        with DECODE_SECONDS.time(method='opus_packets'):
+            packets = read_opus_packets(audio_file)
+        if packets:
+            return OpusCacheEntry(packets)
+    with DECODE_SECONDS.time(method='pcm'):
+        return CacheEntry(decode_pcm(audio_file))
+
+
+class SoundCache:
+    '''
+    LRU cache of sounds limited by total size in bytes.
+    Thread-safe: the webserver thread invalidates entries while the bot reads them.
+    pack - SoundPack that is looked up before the cache (sounds in it take no cache memory)
+    '''
+    def __init__(self, max_bytes=64 * 1024 * 1024, pack=None):
+        self.max_bytes = max_bytes
+        self.pack = pack
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict() # {path: CacheEntry}
+        self._generations = {} # {path: invalidations}, a sound decoded before one of them isn't cached
+        self._generation = 0 # invalidations of everything
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(audio_file, pcm=False):
+        # Opus files can also be cached decoded, when they are played together with PCM sounds
+        key = os.path.normpath(audio_file)
+        return f'{key}|pcm' if pcm and key.lower().endswith('.opus') else key
+
+    def get(self, audio_file, pcm=False):
+        '''
+        Returns cache entry for the given file, decoding it on a miss.
+        Decoding is blocking, call it from an executor when running in the event loop.
+        '''
+        if self.pack is not None:
+            entry = self.pack.get(audio_file, pcm)
+            if entry is not None:
+                CACHE_REQUESTS.inc(result='pack')
+                return entry
+        key = self.key(audio_file, pcm)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                CACHE_REQUESTS.inc(result='hit')
+                return entry
+            self.misses += 1
+            generation = self._generation_of(audio_file)
+        CACHE_REQUESTS.inc(result='miss')
+        entry = load_entry(audio_file, pcm)
+        with self._lock:
+            # file was replaced while it was decoded, the old audio is played this time but not kept
+            if self._generation_of(audio_file) != generation:
+                return entry
+        self.put(key, entry)
+        return entry
+
+    def _generation_of(self, audio_file):
+        return self._generation, self._generations.get(os.path.normpath(audio_file), 0)
+
+    def put(self, key, entry):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            # sounds larger than the whole budget are played but never cached
+            if entry.size > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.size
+                self.evictions += 1
+
+    def source(self, *audio_files, pcm=False):
+        '''
+        Returns a new audio source and duration in seconds for the given file.
+        Several files are joined into one source that plays them back to back.
+        With pcm=True the source is always decoded PCM, even for Opus files.
+        '''
+        entries = [self.get(audio_file, pcm) for audio_file in audio_files]
+        if len(entries) == 1:
+            return entries[0].source(), entries[0].duration
+        if len({entry.opus for entry in entries}) > 1:
+            # Opus and PCM can't be mixed in one source, use decoded audio for all of them
+            entries = [self.get(audio_file, pcm=True) for audio_file in audio_files]
+        return ConcatAudio([entry.source() for entry in entries]), sum(entry.duration for entry in entries)
+
+    def duration(self, audio_file, default=None, pcm=False):
+        '''
+        Returns duration of a cached (or packed) sound without decoding it.
+        '''
+        if self.pack is not None:
+            entry = self.pack.get(audio_file, pcm)
+            if entry is not None:
+                return entry.duration
+        with self._lock:
+            entry = self._entries.get(self.key(audio_file, pcm))
+        return entry.duration if entry is not None else default
+
+    def invalidate(self, *audio_files):
+        '''
+        Drops given files from the cache, or everything if no files are given.
+        '''
+        with self._lock:
+            if not audio_files:
+                self._entries.clear()
+                self.size = 0
+                self._generation += 1
+                return
+            for audio_file in audio_files:
+                path = os.path.normpath(audio_file)
+                self._generations[path] = self._generations.get(path, 0) + 1
+                for key in {self.key(audio_file), self.key(audio_file, pcm=True)}:
+                    entry = self._entries.pop(key, None)
+                    if entry is not None:
+                        self.size -= entry.size
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
@@ -0,0 +1,109 @@
+'''
+Benchmark of /play autocomplete: query latency of the sound name index on a large library.
+
+Builds the index over --names synthetic sound names (2-4 words out of a shared vocabulary, joined with
+`_`, `-` or spaces), then times queries as they are typed: a prefix of a name (1 to 8 characters),
+two words out of order, a word from the middle of the name and typos. A linear scan over all names (substring match, the
+cost of filtering list_audio_files()) is timed on the same queries for comparison.
+Incremental update cost is the time to sync the index after 10 names were added and 10 removed.
+
+Usage: python benchmarks/bench_autocomplete.py [--names 10000] [--queries 2000]
+'''
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sound_index import SoundIndex, normalize
+
+CONSONANTS = 'bcdfghjklmnprstvwz'
+VOWELS = 'aeiouy'
+
+
+def make_word(rng):
+    return ''.join(rng.choice(CONSONANTS) + rng.choice(VOWELS) for _ in range(rng.randint(2, 4)))
+
+
+def make_names(count, rng):
+    # vocabulary of a few thousand words, names share words like real libraries do
+    words = list({make_word(rng) for _ in range(count // 3)})
+    names = set()
+    while len(names) < count:
+        separator = rng.choice('_- ')
+        names.add(separator.join(rng.choices(words, k=rng.randint(2, 4))))
+    return sorted(names)
+
+
+def make_queries(names, count, rng):
+    queries = {'prefix': [], 'reordered': [], 'middle_word': [], 'typo': []}
+    for name in rng.sample(names, count):
+        words = normalize(name).split()
+        queries['prefix'].append(name[:rng.randint(1, 8)])
+        queries['reordered'].append(' '.join(reversed(words[:2])))
+        queries['middle_word'].append(words[len(words) // 2])
+        typo = list(words[0])
+        i = rng.randrange(len(typo) - 1)
+        typo[i], typo[i + 1] = typo[i + 1], typo[i]
+        queries['typo'].append(''.join(typo))
+    return queries
+
+
+def percentiles(times):
+    times = sorted(times)
+    pick = lambda p: round(times[min(int(len(times) * p), len(times) - 1)] * 1000, 3)
+    return {'p50_ms': pick(0.5), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99), 'max_ms': round(times[-1] * 1000, 3)}
+
+
+def timed(function, queries):
+    times = []
+    for query in queries:
+        start = time.perf_counter()
+        function(query)
+        times.append(time.perf_counter() - start)
+    return percentiles(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Autocomplete index benchmark')
+    parser.add_argument('--names', type=int, default=10000, help='sound library size')
+    parser.add_argument('--queries', type=int, default=2000, help='queries of every kind')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    names = make_names(args.names, rng)
+    start = time.perf_counter()
+    index = SoundIndex(tuple(names))
+    build = time.perf_counter() - start
+
+    changed = names[10:] + [f'new sound {i}' for i in range(10)]
+    start = time.perf_counter()
+    index.sync(tuple(changed))
+    update = time.perf_counter() - start
+    index.sync(tuple(names))
+
+    lowered = [(name, normalize(name)) for name in names]
+    def scan(query):
+        query = normalize(query)
+        return [name for name, normalized in lowered if query in normalized][:25]
+
+    results = {}
+    for kind, queries in make_queries(names, min(args.queries, len(names)), rng).items():
+        results[kind] = {
+            'index': timed(lambda query: index.search(query, 25), queries),
+            'linear_scan': timed(scan, queries)
+        }
+    print(json.dumps({
+        'benchmark': 'autocomplete',
+        'names': len(names),
+        'build_ms': round(build * 1000, 1),
+        'update_20_names_ms': round(update * 1000, 2),
+        'results': results
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+'''
+Benchmark of the built-in loudness analyzer against FFmpeg's loudnorm probe.
+
+Writes synthetic 48 kHz stereo WAV files (sines at several levels and filtered noise with quiet and loud parts),
+measures them with loudness.py and, if FFmpeg is installed, with `ffmpeg -af loudnorm=print_format=json`
+(what volume_normalization.py and the webserver used before). Prints time per file for both and the
+difference of integrated loudness, loudness range and true peak.
+
+Usage: python benchmarks/bench_loudness.py [--seconds 30] [--repeat 3]
+'''
+import os
+import sys
+import wave
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from loudness import LoudnessMeter, analyze_file
+from ingest import SAMPLE_RATE
+
+
+def write_wav(path, samples):
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(np.clip(np.rint(samples * 32767), -32768, 32767).astype('<i2').tobytes())
+
+
+def make_signals(seconds):
+    rng = np.random.default_rng(0)
+    t = np.arange(seconds * SAMPLE_RATE) / SAMPLE_RATE
+    signals = {}
+    for level in (-30, -23, -10):
+        tone = 10 ** (level / 20) * np.sin(2 * np.pi * 1000 * t)
+        signals[f'sine_1k_{level}dB'] = np.stack([tone, tone], axis=1)
+    # noise, low-passed by a moving average, switching between -30 and -12 dB every 2 seconds
+    noise = rng.standard_normal((len(t), 2))
+    noise = np.apply_along_axis(lambda x: np.convolve(x, np.ones(8) / 8, mode='same'), 0, noise)
+    envelope = np.where((t // 2) % 2, 10 ** (-12 / 20), 10 ** (-30 / 20))[:, None]
+    signals['noise_dynamic'] = np.clip(noise / np.abs(noise).max() * envelope * 3, -1, 1)
+    return signals
+
+
+def ffmpeg_probe(path):
+    result = subprocess.run(
+        ['ffmpeg', '-hide_banner', '-nostats', '-i', path, '-af', 'loudnorm=print_format=json', '-f', 'null', '-'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True
+    ).stderr.decode('utf-8')
+    stats = json.loads(result[result.rindex('{'):result.rindex('}') + 1])
+    return {'integrated': float(stats['input_i']), 'lra': float(stats['input_lra']), 'true_peak': float(stats['input_tp'])}
+
+
+def timed(func, path, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(path)
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Loudness analyzer benchmark')
+    parser.add_argument('--seconds', type=int, default=30, help='length of every test file')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per file, the fastest is reported')
+    args = parser.parse_args()
+
+    have_ffmpeg = shutil.which('ffmpeg') is not None
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        # the first meter computes the K-weighting filter, don't count it
+        LoudnessMeter(SAMPLE_RATE, 2)
+        for name, samples in make_signals(args.seconds).items():
+            path = os.path.join(directory, f'{name}.wav')
+            write_wav(path, samples)
+            stats, builtin_time = timed(analyze_file, path, args.repeat)
+            entry = {
+                'file': name,
+                'builtin_ms': round(builtin_time * 1000, 1),
+                'builtin_realtime_x': round(args.seconds / builtin_time, 1),
+                'builtin': {key: round(stats[key], 2) for key in ('integrated', 'lra', 'true_peak')}
+            }
+            if have_ffmpeg:
+                reference, ffmpeg_time = timed(ffmpeg_probe, path, args.repeat)
+                entry['ffmpeg_ms'] = round(ffmpeg_time * 1000, 1)
+                entry['ffmpeg'] = reference
+                entry['speedup'] = round(ffmpeg_time / builtin_time, 2)
+                entry['difference'] = {key: round(stats[key] - reference[key], 2) for key in reference}
+            results.append(entry)
+    print(json.dumps({
+        'benchmark': 'loudness',
+        'seconds_per_file': args.seconds,
+        'ffmpeg': 'found' if have_ffmpeg else 'not found, comparison skipped',
+        'results': results
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
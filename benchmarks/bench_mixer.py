@@ -0,0 +1,58 @@
+'''
+Benchmark of the soundboard mixer: how many simultaneous voices one core can mix in real time.
+
+Mixes synthetic noise for a growing number of voices and measures time per 20 ms frame.
+A voice count is sustainable while mixing a frame takes less than 20 ms, the estimate below
+assumes the cost grows linearly with the number of voices.
+
+Usage: python benchmarks/bench_mixer.py [--frames 500] [--voices 1 8 32 128]
+'''
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from audio_cache import CachedPCMAudio, FRAME_SIZE, FRAME_DURATION
+from mixer import Mixer
+
+
+def bench(voices, frames):
+    rng = np.random.default_rng(0)
+    data = rng.integers(-8000, 8000, size=FRAME_SIZE // 2 * frames, dtype=np.int16).tobytes()
+    mixer = Mixer(max_voices=voices)
+    for i in range(voices):
+        # every other voice with a gain, so both code paths are measured
+        mixer.add(CachedPCMAudio(data), gain=1.0 if i % 2 else 0.8)
+    start = time.perf_counter()
+    mixed = 0
+    while mixer.read():
+        mixed += 1
+    elapsed = time.perf_counter() - start
+    return elapsed / mixed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Soundboard mixer benchmark')
+    parser.add_argument('--frames', type=int, default=500, help='frames per voice (500 = 10 s of audio)')
+    parser.add_argument('--voices', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64, 128])
+    args = parser.parse_args()
+
+    results = []
+    for voices in args.voices:
+        frame_time = bench(voices, args.frames)
+        results.append({
+            'voices': voices,
+            'frame_us': round(frame_time * 1e6, 1),
+            'realtime_load': round(frame_time / FRAME_DURATION, 4)
+        })
+    largest = results[-1]
+    voices_per_core = int(largest['voices'] / largest['realtime_load']) if largest['realtime_load'] else None
+    print(json.dumps({'benchmark': 'mixer', 'results': results, 'voices_per_core': voices_per_core}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+'''
+Micro-benchmarks of the audio pipeline, on generated audio, offline.
+
+Cases:
+  wav_length     - reading duration from a WAV header (what wav_length() in app.py does, measured through
+                   catalog.wav_info as app.py can't be imported) against a duration lookup in the catalog
+  catalog        - SoundCatalog over --files sounds: first scan, start with a saved catalog, periodic check
+                   with nothing changed and with one changed file; os.listdir of the folder for reference
+  decode         - a --seconds long sound to PCM frames: in-process (audio_cache.decode_pcm) and FFmpegPCMAudio
+  opus_encode    - encoding one 20 ms frame with discord.py's Opus encoder (what discord.py does for PCM sources)
+  normalization  - loudness analysis of volume_normalization.py, in seconds of audio analyzed per second
+  convert        - WebApp.convert() of a typical upload: 48 kHz stereo WAV, 44.1 kHz mono WAV and MP3
+
+Cases that need FFmpeg or libopus are reported as skipped when they are not available.
+Results are printed as JSON (or written to --output) with the commit they were measured on;
+compare two result files with benchmarks/compare.py.
+
+Usage: python benchmarks/bench_pipeline.py [--files 500] [--seconds 5] [--only decode convert] [--output results.json]
+'''
+import os
+import sys
+import json
+import time
+import wave
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import ingest
+from audio_cache import decode_pcm, FRAME_SIZE
+from catalog import SoundCatalog, wav_info
+from volume_normalization import measure_loudness
+
+
+def make_wav(path, seconds, rate=48000, channels=2, seed=0):
+    '''
+    Noise with a sine on top, at about -20 dBFS, so loudness analysis has something to measure.
+    '''
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * rate)) / rate
+    signal = 0.05 * np.sin(2 * np.pi * (220 + seed % 200) * t) + 0.02 * rng.standard_normal(t.size)
+    samples = np.repeat((signal * 32767).astype('<i2')[:, None], channels, axis=1)
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(samples.tobytes())
+    return path
+
+
+def timed(function, repeat=5):
+    '''
+    Runs function `repeat` times, returns median and best time in milliseconds.
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {'median_ms': round(statistics.median(times) * 1000, 3), 'min_ms': round(min(times) * 1000, 3)}
+
+
+def skipped(reason):
+    return {'skipped': reason}
+
+
+def bench_wav_length(directory, args):
+    folder = os.path.join(directory, 'wav_length')
+    os.makedirs(folder)
+    paths = [make_wav(os.path.join(folder, f'sound{i}.wav'), 1, seed=i) for i in range(100)]
+    catalog = SoundCatalog(None, measure_loudness=False)
+    catalog.load(folder)
+    catalog.fill()
+    # microseconds per file
+    per_file = lambda timing: {key.replace('_ms', '_us'): round(value / len(paths) * 1000, 3) for key, value in timing.items()}
+    return {
+        'header': per_file(timed(lambda: [wav_info(path) for path in paths])),
+        'catalog': per_file(timed(lambda: [catalog.entry(path).duration for path in paths]))
+    }
+
+
+def bench_catalog(directory, args):
+    folder = os.path.join(directory, 'catalog')
+    os.makedirs(folder)
+    source = make_wav(os.path.join(directory, 'catalog_source.wav'), 1)
+    for i in range(args.files):
+        shutil.copy(source, os.path.join(folder, f'sound{i:05}.wav'))
+    path = os.path.join(directory, 'catalog.json')
+    results = {'files': args.files}
+
+    def cold():
+        if os.path.exists(path):
+            os.remove(path)
+        catalog = SoundCatalog(path)
+        catalog.load(folder)
+        catalog.fill()
+
+    def cold_without_loudness():
+        catalog = SoundCatalog(None, measure_loudness=False)
+        catalog.load(folder)
+        catalog.fill()
+    results['first_start'] = timed(lambda: SoundCatalog(None).load(folder), repeat=3)
+    results['first_scan'] = timed(cold, repeat=1)
+    results['first_scan_without_loudness'] = timed(cold_without_loudness, repeat=3)
+    results['start_with_saved_catalog'] = timed(lambda: SoundCatalog(path).load(folder))
+
+    catalog = SoundCatalog(path)
+    catalog.load(folder)
+    results['check_unchanged'] = timed(lambda: catalog.refresh(force=True), repeat=20)
+    changed = os.path.join(folder, 'sound00000.wav')
+
+    def check_changed():
+        make_wav(changed, 1, seed=int(time.perf_counter() * 1000) % 1000)
+        # directory mtime changes when a file is added or removed, not when it is rewritten in place
+        os.replace(changed, changed + '.tmp')
+        os.replace(changed + '.tmp', changed)
+        catalog.refresh(force=True)
+    results['check_one_changed'] = timed(check_changed)
+    results['listdir'] = timed(lambda: sorted(os.listdir(folder)), repeat=20)
+    return results
+
+
+def bench_decode(directory, args):
+    path = make_wav(os.path.join(directory, 'decode.wav'), args.seconds)
+    results = {'seconds': args.seconds, 'in_process': timed(lambda: decode_pcm(path))}
+    if shutil.which('ffmpeg') is None:
+        results['ffmpeg_pcm_audio'] = skipped('ffmpeg not found')
+        return results
+    import discord
+
+    def ffmpeg():
+        source = discord.FFmpegPCMAudio(path)
+        try:
+            while len(source.read()) == FRAME_SIZE:
+                pass
+        finally:
+            source.cleanup()
+    results['ffmpeg_pcm_audio'] = timed(ffmpeg)
+    return results
+
+
+def bench_opus_encode(directory, args):
+    import discord.opus
+    if not discord.opus.is_loaded():
+        try:
+            discord.opus._load_default()
+        except Exception:
+            pass
+    if not discord.opus.is_loaded():
+        return skipped('libopus not found')
+    encoder = discord.opus.Encoder()
+    pcm = decode_pcm(make_wav(os.path.join(directory, 'opus.wav'), 2))
+    frames = [pcm[i:i + FRAME_SIZE] for i in range(0, len(pcm) - FRAME_SIZE + 1, FRAME_SIZE)]
+    timing = timed(lambda: [encoder.encode(frame, encoder.SAMPLES_PER_FRAME) for frame in frames])
+    per_frame = {key.replace('_ms', '_us'): round(value / len(frames) * 1000, 2) for key, value in timing.items()}
+    # share of one core spent encoding one real-time stream
+    per_frame['core_share_per_stream'] = round(per_frame['median_us'] / 20000, 4)
+    return per_frame
+
+
+def bench_normalization(directory, args):
+    folder = os.path.join(directory, 'normalization')
+    os.makedirs(folder)
+    paths = [make_wav(os.path.join(folder, f'sound{i}.wav'), args.seconds, seed=i) for i in range(4)]
+    timing = timed(lambda: [measure_loudness(path) for path in paths], repeat=3)
+    audio = args.seconds * len(paths)
+    return {**timing, 'audio_seconds_per_second': round(audio / (timing['median_ms'] / 1000), 1)}
+
+
+def bench_convert(directory, args):
+    os.environ.setdefault('WEBPAGE_USERNAME', 'bench')
+    os.environ.setdefault('WEBPAGE_PASSWORD', 'bench')
+    folder = os.path.join(directory, 'convert')
+    os.makedirs(folder)
+    cwd = os.getcwd()
+    # WebApp creates its folders relative to the working directory
+    os.chdir(directory)
+    try:
+        from webserver import WebApp
+        os.environ['SOUND_CATALOG'] = os.path.join(directory, 'convert_catalog.json')
+        webapp = WebApp()
+    finally:
+        os.chdir(cwd)
+    has_ffmpeg = shutil.which('ffmpeg') is not None
+    sources = {
+        'wav_48k_stereo': make_wav(os.path.join(directory, 'upload_48k.wav'), args.seconds, 48000, 2),
+        'wav_44k_mono': make_wav(os.path.join(directory, 'upload_44k.wav'), args.seconds, 44100, 1),
+    }
+    if has_ffmpeg:
+        mp3 = os.path.join(directory, 'upload.mp3')
+        subprocess.run(['ffmpeg', '-v', 'error', '-i', sources['wav_44k_mono'], '-ac', '2', '-b:a', '192k', '-y', mp3], check=True)
+        sources['mp3'] = mp3
+    results = {'seconds': args.seconds}
+    for name, source in sources.items():
+        if not has_ffmpeg and not ingest.is_canonical_wav(source):
+            results[name] = skipped('ffmpeg not found')
+            continue
+        filename = 'upload' + os.path.splitext(source)[1]
+
+        def convert():
+            shutil.copy(source, os.path.join(folder, filename))
+            if not webapp.convert(filename, folder):
+                raise RuntimeError(f'Conversion of {name} failed')
+        results[name] = timed(convert, repeat=3)
+    return results
+
+
+CASES = {
+    'wav_length': bench_wav_length,
+    'catalog': bench_catalog,
+    'decode': bench_decode,
+    'opus_encode': bench_opus_encode,
+    'normalization': bench_normalization,
+    'convert': bench_convert,
+}
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Audio pipeline benchmarks')
+    parser.add_argument('--files', type=int, default=500, help='sounds in the catalog benchmark')
+    parser.add_argument('--seconds', type=float, default=5, help='length of decoded, analyzed and converted sounds')
+    parser.add_argument('--only', nargs='+', choices=sorted(CASES), help='run only these cases')
+    parser.add_argument('--output', help='write results to this file instead of printing them')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, case in CASES.items():
+            if args.only and name not in args.only:
+                continue
+            case_directory = os.path.join(directory, name)
+            os.makedirs(case_directory)
+            results[name] = case(case_directory, args)
+    report = {
+        'benchmark': 'pipeline',
+        'commit': commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'ffmpeg': shutil.which('ffmpeg') is not None,
+        'results': results
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+'''
+Load test of the web interface: Flask development server against the production server (Cheroot).
+
+For every server mode the webserver is started in a separate process in a temporary data directory,
+then concurrent clients log in and
+  - request the login page (a cheap page render) for --seconds,
+  - upload a file of --upload-mb megabytes (multipart, like the upload form) for --seconds.
+Requests per second and peak RSS of the server process (VmHWM, Linux only) are printed as JSON.
+The uploaded file has an extension the server rejects, so the whole body is received and parsed
+but not converted: the test measures serving, not conversion jobs.
+
+Usage: python benchmarks/bench_webserver.py [--clients 16] [--seconds 10] [--upload-mb 8] [--modes development production]
+--root serves another checkout of the project, e.g. to measure a version before a change:
+    git worktree add /tmp/old <commit> && python benchmarks/bench_webserver.py --root /tmp/old --modes development
+'''
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+import urllib.parse
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def serve(port, root):
+    '''
+    Server process: runs WebApp with settings from the environment.
+    '''
+    sys.path.insert(0, root)
+    from webserver import WebApp
+    webapp = WebApp()
+    webapp.port = port
+    webapp.run()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def peak_rss_mb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def make_upload(size_mb):
+    path = os.path.join(tempfile.gettempdir(), f'bench_upload_{size_mb}mb.raw')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size_mb * 1024 * 1024))
+    return path
+
+
+def login(port):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    body = urllib.parse.urlencode({'username': 'bench', 'password': 'bench'})
+    conn.request('POST', '/login', body, {'Content-Type': 'application/x-www-form-urlencoded'})
+    response = conn.getresponse()
+    response.read()
+    cookie = response.getheader('Set-Cookie').split(';')[0]
+    conn.close()
+    return cookie
+
+
+def multipart(path):
+    boundary = uuid.uuid4().hex
+    with open(path, 'rb') as f:
+        data = f.read()
+    head = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="bench.raw"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode()
+    return f'multipart/form-data; boundary={boundary}', head + data + f'\r\n--{boundary}--\r\n'.encode()
+
+
+def load(port, clients, seconds, method, url, body=None, headers=None):
+    '''
+    Runs `clients` threads with a keep-alive connection each, returns completed requests per second and errors.
+    '''
+    cookie = login(port)
+    headers = {'Cookie': cookie, **(headers or {})}
+    done = [0] * clients
+    errors = [0] * clients
+    deadline = time.perf_counter() + seconds
+
+    def client(i):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        while time.perf_counter() < deadline:
+            try:
+                conn.request(method, url, body, headers)
+                response = conn.getresponse()
+                response.read()
+                if response.status < 400:
+                    done[i] += 1
+                else:
+                    errors[i] += 1
+            except (OSError, http.client.HTTPException):
+                errors[i] += 1
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        conn.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return round(sum(done) / elapsed, 1), sum(errors)
+
+
+def bench(mode, args, upload):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, WEBPAGE_USERNAME='bench', WEBPAGE_PASSWORD='bench', WEBPAGE_SERVER=mode,
+                   WEBPAGE_THREADS=str(args.threads), WEBPAGE_MAX_UPLOAD_MB=str(args.upload_mb + 1),
+                   SOUND_CATALOG=os.path.join(directory, 'catalog.json'))
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', str(port), '--root', args.root],
+                                  cwd=directory, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            for _ in range(100):
+                try:
+                    socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            idle_rss = peak_rss_mb(server.pid)
+            page_rps, page_errors = load(port, args.clients, args.seconds, 'GET', '/login')
+            content_type, body = upload
+            upload_rps, upload_errors = load(port, args.clients, args.seconds, 'POST', '/upload', body,
+                                             {'Content-Type': content_type, 'Accept': 'application/json'})
+            return {
+                'server': mode,
+                'page_rps': page_rps,
+                'page_errors': page_errors,
+                'upload_rps': upload_rps,
+                'upload_mb_s': round(upload_rps * args.upload_mb, 1),
+                'upload_errors': upload_errors,
+                'idle_rss_mb': idle_rss,
+                'peak_rss_mb': peak_rss_mb(server.pid)
+            }
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Webserver load test')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--seconds', type=float, default=10, help='duration of every test')
+    parser.add_argument('--upload-mb', type=int, default=8, help='size of the uploaded file')
+    parser.add_argument('--threads', type=int, default=8, help='WEBPAGE_THREADS of the production server')
+    parser.add_argument('--modes', nargs='+', default=['development', 'production'])
+    parser.add_argument('--root', default=ROOT, help='project directory to serve (default: this checkout)')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.root = os.path.abspath(args.root)
+    if args.serve:
+        serve(args.serve, args.root)
+        return
+
+    upload = multipart(make_upload(args.upload_mb))
+    results = [bench(mode, args, upload) for mode in args.modes]
+    print(json.dumps({'benchmark': 'webserver', 'root': args.root, 'clients': args.clients, 'seconds': args.seconds,
+                      'upload_mb': args.upload_mb, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+'''
+Compares two benchmark result files (JSON printed by the benchmarks), e.g. measured on two commits.
+
+Every number found in both files is listed with its relative change. Times (`_ms`, `_us`) are better
+when lower, everything else (throughput, counts of voices, ...) when higher; changes larger than
+--threshold percent in the worse direction are marked.
+
+Usage: python benchmarks/compare.py old.json new.json [--threshold 10]
+'''
+import sys
+import json
+import argparse
+
+
+def flatten(value, prefix=''):
+    '''
+    {'a': {'b': 1}} -> {'a.b': 1}, lists are indexed by position.
+    '''
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, list):
+        items = enumerate(value)
+    else:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return {prefix: value}
+        return {}
+    flat = {}
+    for key, item in items:
+        flat.update(flatten(item, f'{prefix}.{key}' if prefix else str(key)))
+    return flat
+
+
+def lower_is_better(key):
+    return key.endswith(('_ms', '_us', '_s', '_mb', '_share_per_stream'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare benchmark results')
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=10, help='percent change marked as a regression')
+    args = parser.parse_args()
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f'{old.get("commit") or args.old} -> {new.get("commit") or args.new}')
+    old_values, new_values = flatten(old.get('results', old)), flatten(new.get('results', new))
+    regressions = 0
+    width = max((len(key) for key in old_values), default=0)
+    for key in sorted(old_values.keys() & new_values.keys()):
+        before, after = old_values[key], new_values[key]
+        if before == after:
+            change, marker = 0.0, ''
+        elif before == 0:
+            change, marker = float('inf'), ''
+        else:
+            change = (after - before) / abs(before) * 100
+            worse = change > 0 if lower_is_better(key) else change < 0
+            marker = '  <- regression' if worse and abs(change) > args.threshold else ''
+            regressions += bool(marker)
+        print(f'{key:<{width}}  {before:>12g}  {after:>12g}  {change:+8.1f}%{marker}')
+    for key in sorted(old_values.keys() ^ new_values.keys()):
+        print(f'{key:<{width}}  only in {"old" if key in old_values else "new"}')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
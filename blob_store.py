@@ -0,0 +1,151 @@
+'''
+Content-addressed store of sound files.
+
+Every distinct sound is kept once, as data/blobs/<first 2 hash chars>/<sha1><ext>. Files in the sound
+folders (soundboard, current greetings and their versions) are hard links to these blobs, so setting
+a sound as a greeting, keeping old greeting versions or uploading the same clip again only adds a link.
+Everything reading the folders (catalog, bot, webserver) sees ordinary files.
+
+Files are never written in place (conversion and normalization write a new file and rename it over
+the old one), so a file replaced in one folder doesn't change its other links.
+A blob whose only link is the store itself is garbage, gc() removes it. gc() also adds files that are not
+in the store yet (copied into the folders by hand, or from before the store existed), which replaces
+duplicates with links to one blob.
+
+On file systems without hard links files are copied as before, nothing is deduplicated.
+
+Run `python blob_store.py gc` to collect garbage and print a report, `--dry-run` only reports.
+'''
+import os
+import sys
+import json
+import shutil
+import argparse
+
+from sound_files import is_audio_file
+from catalog import file_hash
+
+SOUND_FOLDERS = ('./data/audio', './data/greetings', './data/leavings', './data/mutings')
+
+
+class BlobStore:
+    def __init__(self, folder='./data/blobs'):
+        self.folder = folder
+        self.linkable = True # cleared when the file system doesn't support hard links
+
+    def path(self, digest, ext):
+        return os.path.join(self.folder, digest[:2], f'{digest}{ext.lower()}')
+
+    def _link(self, blob, target):
+        '''
+        Makes target a link to blob, replacing target atomically.
+        '''
+        temp = f'{target}.linking'
+        if os.path.exists(temp):
+            os.remove(temp)
+        os.link(blob, temp)
+        os.replace(temp, target)
+
+    def add(self, path, digest=None):
+        '''
+        Puts the file into the store: it becomes the blob, or a link to the same content stored before.
+        Returns path of the blob, or None if the file system doesn't support hard links.
+        '''
+        if not self.linkable:
+            return None
+        digest = digest or file_hash(path)
+        blob = self.path(digest, os.path.splitext(path)[1])
+        try:
+            if os.path.exists(blob):
+                if not os.path.samefile(blob, path):
+                    self._link(blob, path)
+            else:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.link(path, blob)
+        except OSError:
+            # e.g. a mounted folder on another device or a file system without links
+            self.linkable = False
+            return None
+        return blob
+
+    def link(self, source, target, digest=None):
+        '''
+        Makes target a file with the content of source: a link to its blob, or a copy without the store.
+        '''
+        blob = self.add(source, digest)
+        if blob is None:
+            shutil.copy2(source, target)
+            return
+        self._link(blob, target)
+
+    def blobs(self):
+        if not os.path.isdir(self.folder):
+            return
+        for prefix in os.scandir(self.folder):
+            if prefix.is_dir():
+                for item in os.scandir(prefix.path):
+                    if item.is_file() and is_audio_file(item.name):
+                        yield item
+
+    def gc(self, folders=SOUND_FOLDERS, dry_run=False):
+        '''
+        Adds sound files that are not in the store yet and removes blobs nothing links to.
+        Returns report: number of blobs, files added, duplicates replaced by links and bytes reclaimed.
+        '''
+        report = {'blobs': 0, 'added': 0, 'deduplicated': 0, 'removed': 0, 'reclaimed_bytes': 0, 'linkable': self.linkable}
+        # 1. files that aren't links into the store (a file with one link can't be one)
+        new = set() # (digest, ext) of files that become blobs
+        relinked = set() # blobs that files become links to
+        for folder in folders:
+            if not os.path.isdir(folder):
+                continue
+            for item in os.scandir(folder):
+                if not item.is_file() or not is_audio_file(item.name):
+                    continue
+                stat = item.stat()
+                if stat.st_nlink > 1:
+                    continue
+                digest = file_hash(item.path)
+                ext = os.path.splitext(item.name)[1].lower()
+                blob = self.path(digest, ext)
+                if os.path.exists(blob) or (digest, ext) in new:
+                    report['deduplicated'] += 1
+                    report['reclaimed_bytes'] += stat.st_size
+                    relinked.add(blob)
+                else:
+                    report['added'] += 1
+                    new.add((digest, ext))
+                if not dry_run:
+                    self.add(item.path, digest)
+                    if not self.linkable:
+                        report['linkable'] = False
+                        return report
+        # 2. blobs linked only from the store
+        for item in self.blobs():
+            stat = item.stat()
+            if stat.st_nlink > 1 or (dry_run and item.path in relinked):
+                report['blobs'] += 1
+                continue
+            report['removed'] += 1
+            report['reclaimed_bytes'] += stat.st_size
+            if not dry_run:
+                os.remove(item.path)
+        if dry_run:
+            report['blobs'] += len(new)
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Content-addressed store of sound files')
+    parser.add_argument('command', choices=['gc'], help='gc: add files that are not in the store, remove unused blobs')
+    parser.add_argument('--store', default='./data/blobs', help='store folder (default: ./data/blobs)')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be done')
+    args = parser.parse_args()
+    report = BlobStore(args.store).gc(dry_run=args.dry_run)
+    print(json.dumps(report, indent=2))
+    if not report['linkable']:
+        print('File system does not support hard links, sounds are not deduplicated', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
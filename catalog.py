@@ -0,0 +1,579 @@
+'''
+Catalog of sound files: one index of every sound and greeting version with its metadata.
+
+The bot and the webserver look sounds up here instead of listing directories on every command,
+page render and request. The catalog is loaded from a JSON file at startup and reconciled with the disk:
+only files whose size or modification time changed are read again. After that it is kept up to date by
+explicit updates from the web layer (uploads, deletes, greeting changes) and by checking the modification
+time of every folder at most once per `check_interval` seconds, which catches files copied in by hand.
+Checks run in the thread that looks a sound up, or with watch() in a background thread, so lookups from
+the bot's event loop never wait for them.
+
+Scans only list files: a new or changed file is added with its size and modification time, its hash,
+duration and loudness (a full read and an EBU R128 analysis) are filled in later by fill(), in the watcher
+thread. So a first start on a big library doesn't wait minutes for the analysis.
+
+A read only catalog (bot processes of a sharded bot) never scans folders or reads sound files: its entries
+are the ones in the catalog file, which is read again when the process that owns it saves it.
+
+Lookups by path or name are dict lookups; sorted listings are rebuilt only after a folder changed.
+Every change gets a sequence number, so clients can ask for changes since their last sync (see changes()).
+'''
+import os
+import json
+import time
+import uuid
+import wave
+import hashlib
+import logging
+import threading
+import contextlib
+from collections import deque
+
+from sound_files import AUDIO_EXTENSIONS, is_audio_file, strip_extension
+
+logger = logging.getLogger('HeyHeyBot')
+
+
+class SoundEntry:
+    '''
+    One sound file. `name` is the filename without audio extension, for versioned greetings (`user.3.wav`)
+    `base` is the name without version (`user`) and `version` is the number, otherwise version is None.
+    Duration, sample rate, channels and loudness are None when they couldn't be read.
+    trim_start and trim_end are seconds of silence cut from the sound when it was uploaded (None for other sounds).
+    '''
+    FIELDS = ('size', 'mtime', 'hash', 'duration', 'rate', 'channels', 'loudness', 'trim_start', 'trim_end')
+
+    def __init__(self, path, size=0, mtime=0, hash=None, duration=None, rate=None, channels=None, loudness=None, trim_start=None, trim_end=None):
+        self.path = os.path.normpath(path)
+        self.folder, self.filename = os.path.split(self.path)
+        self.name = strip_extension(self.filename)
+        self.ext = self.filename[len(self.name):].lower()
+        base, _, version = self.name.rpartition('.')
+        self.base, self.version = (base, int(version)) if base and version.isdigit() else (self.name, None)
+        self.size = size
+        self.mtime = mtime # nanoseconds
+        self.hash = hash
+        self.duration = duration
+        self.rate = rate
+        self.channels = channels
+        self.loudness = loudness
+        self.trim_start = trim_start
+        self.trim_end = trim_end
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def wav_info(path):
+    with contextlib.closing(wave.open(path, 'rb')) as f:
+        return f.getnframes() / f.getframerate(), f.getframerate(), f.getnchannels()
+
+
+def opus_info(path):
+    '''
+    Reads duration from the granule position of the last Ogg page and channels from OpusHead,
+    without decoding the file. Opus is always decoded at 48 kHz.
+    '''
+    with open(path, 'rb') as f:
+        head = f.read(512)
+        f.seek(max(0, os.fstat(f.fileno()).st_size - 65536))
+        tail = f.read()
+    i = head.find(b'OpusHead')
+    if i < 0 or tail.rfind(b'OggS') < 0:
+        raise ValueError(f'{path} is not an Ogg Opus file')
+    channels = head[i + 9]
+    pre_skip = int.from_bytes(head[i + 10:i + 12], 'little')
+    last = tail.rfind(b'OggS')
+    granule = int.from_bytes(tail[last + 6:last + 14], 'little')
+    return max(0, granule - pre_skip) / 48000, 48000, channels
+
+
+def read_metadata(path, measure_loudness=True):
+    '''
+    Reads metadata of a sound file. Loudness is measured for 16-bit WAV files only
+    (Opus files get it from the conversion that created them).
+    '''
+    stat = os.stat(path)
+    metadata = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': file_hash(path)}
+    try:
+        metadata['duration'], metadata['rate'], metadata['channels'] = opus_info(path) if path.lower().endswith('.opus') else wav_info(path)
+    except (wave.Error, EOFError, ValueError, OSError):
+        return metadata
+    if measure_loudness and path.lower().endswith('.wav'):
+        from loudness import analyze_file
+        try:
+            loudness = analyze_file(path)['integrated']
+            metadata['loudness'] = loudness if loudness != float('-inf') else None
+        except (wave.Error, ValueError):
+            pass
+    return metadata
+
+
+class FolderIndex:
+    def __init__(self, folder):
+        self.folder = folder
+        self.mtime = None # of the directory when it was last scanned
+        self.entries = {} # {filename: SoundEntry}
+        self.names = {} # {name: {ext: SoundEntry}}
+        self.versions = {} # {base: {version: SoundEntry}}
+        self._files = None # sorted filenames, rebuilt after a change
+        self._names = None # sorted names
+
+    def add(self, entry):
+        self.remove(entry.filename)
+        self.entries[entry.filename] = entry
+        self.names.setdefault(entry.name, {})[entry.ext] = entry
+        if entry.version is not None:
+            self.versions.setdefault(entry.base, {})[entry.version] = entry
+        self._files = self._names = None
+
+    def remove(self, filename):
+        entry = self.entries.pop(filename, None)
+        if entry is None:
+            return None
+        exts = self.names[entry.name]
+        del exts[entry.ext]
+        if not exts:
+            del self.names[entry.name]
+        if entry.version is not None:
+            versions = self.versions[entry.base]
+            del versions[entry.version]
+            if not versions:
+                del self.versions[entry.base]
+        self._files = self._names = None
+        return entry
+
+    def files(self):
+        if self._files is None:
+            self._files = tuple(sorted(self.entries))
+        return self._files
+
+    def sound_names(self):
+        if self._names is None:
+            self._names = tuple(sorted(self.names))
+        return self._names
+
+
+class SoundCatalog:
+    '''
+    Thread safe index of sound files in a set of folders. Folders are added when they are first queried.
+
+    path - JSON file metadata is kept in between runs (None to keep it only in memory)
+    check_interval - how often (seconds) folders are checked for changes made outside of the web layer
+    on_change - called with paths of files found changed or removed by these checks
+                (changes passed to update() are not reported, whoever wrote the files knows about them)
+    read_only - entries are loaded from path and follow its changes instead of the folders, nothing is saved;
+                for processes that share the catalog file with the one that owns it
+    '''
+    def __init__(self, path='./data/catalog.json', check_interval=2.0, measure_loudness=True, on_change=None, history=5000, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        self.on_change = on_change
+        self.check_interval = check_interval
+        self.measure_loudness = measure_loudness
+        self._folders = {} # {normalized folder: FolderIndex}
+        self._stored = {} # {path: metadata} loaded from the JSON file, used when folders are scanned
+        self._stored_stat = None # (mtime, size) of the JSON file when it was read
+        self._lock = threading.RLock()
+        self._checked = 0.0
+        self._watcher = None
+        self._pending = set() # paths of entries whose metadata wasn't read yet
+        self._dirty = False
+        self.scans = 0 # folder scans done, for stats
+        # change log: sequence numbers are valid within one run (epoch), last `history` changes are kept
+        self.epoch = uuid.uuid4().hex[:8]
+        self.seq = 0
+        self._changes = deque(maxlen=history) # (seq, folder, filename)
+        self._forgotten = 0 # highest sequence number that was dropped from the log
+        self._read()
+
+    def _read(self):
+        '''
+        Reads stored metadata from the JSON file if it changed since it was last read. Returns True if it was read.
+        '''
+        if not self.path:
+            return False
+        try:
+            stat = os.stat(self.path)
+            if (stat.st_mtime_ns, stat.st_size) == self._stored_stat:
+                return False
+            with open(self.path, encoding='utf-8') as f:
+                stored = json.load(f).get('entries', {})
+        except (OSError, ValueError):
+            return False
+        with self._lock:
+            self._stored = stored
+            self._stored_stat = (stat.st_mtime_ns, stat.st_size)
+        return True
+
+    def load(self, *folders):
+        '''
+        Scans folders (reusing stored metadata of unchanged files) and saves the catalog.
+        Metadata of new and changed files is read later, see fill().
+        '''
+        for folder in folders:
+            self._index(folder)
+        self.save()
+
+    def _index(self, folder):
+        folder = os.path.normpath(folder)
+        with self._lock:
+            index = self._folders.get(folder)
+            if index is None:
+                index = self._folders[folder] = FolderIndex(folder)
+                if self.read_only:
+                    self._sync(index)
+                    return index
+                self._scan(index)
+                # stored entries of files that are gone
+                for path in [path for path in self._stored if os.path.dirname(path) == folder]:
+                    del self._stored[path]
+                    self._dirty = True
+            return index
+
+    def _scan(self, index):
+        '''
+        Brings folder index in line with the disk. New or changed files are added with their size and
+        modification time only, fill() reads the rest. Returns paths of files that were added, changed or removed.
+        '''
+        try:
+            mtime = os.stat(index.folder).st_mtime_ns
+            found = {}
+            with os.scandir(index.folder) as it:
+                for item in it:
+                    if is_audio_file(item.name) and item.is_file():
+                        stat = item.stat()
+                        found[item.name] = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            mtime, found = None, {}
+        self.scans += 1
+        changed = []
+        with self._lock:
+            for filename in list(index.entries):
+                # a file added by update() after the folder was listed is kept
+                if filename not in found and not os.path.exists(os.path.join(index.folder, filename)):
+                    changed.append(self._remove(index, filename).path)
+            for filename, (size, file_mtime) in found.items():
+                entry = index.entries.get(filename)
+                if entry is not None and (entry.size, entry.mtime) == (size, file_mtime):
+                    continue
+                if entry is not None and entry.mtime > file_mtime:
+                    # written by update() after the folder was listed
+                    continue
+                path = os.path.join(index.folder, filename)
+                stored = self._stored.pop(os.path.normpath(path), None)
+                if stored is None or (stored.get('size'), stored.get('mtime')) != (size, file_mtime):
+                    stored = {'size': size, 'mtime': file_mtime}
+                self._add(index, SoundEntry(path, **{k: v for k, v in stored.items() if k in SoundEntry.FIELDS}))
+                changed.append(os.path.normpath(path))
+        index.mtime = mtime
+        return changed
+
+    def _sync(self, index):
+        '''
+        Brings folder index of a read only catalog in line with the stored metadata.
+        Returns paths of files that were added, changed or removed.
+        '''
+        stored = {}
+        for path, values in self._stored.items():
+            if os.path.dirname(path) == index.folder:
+                stored[os.path.basename(path)] = {k: v for k, v in values.items() if k in SoundEntry.FIELDS}
+        changed = []
+        with self._lock:
+            for filename in list(index.entries):
+                if filename not in stored:
+                    changed.append(self._remove(index, filename).path)
+            for filename, values in stored.items():
+                entry = index.entries.get(filename)
+                if entry is not None and entry.to_dict() == dict(dict.fromkeys(SoundEntry.FIELDS), **values):
+                    continue
+                self._add(index, SoundEntry(os.path.join(index.folder, filename), **values))
+                # metadata read later by the owner doesn't change the sound
+                if entry is None or (entry.size, entry.mtime) != (values.get('size'), values.get('mtime')):
+                    changed.append(os.path.join(index.folder, filename))
+        return changed
+
+    def fill(self):
+        '''
+        Reads metadata (hash, duration, loudness) of entries added by scans, without holding the lock.
+        Runs in the watcher thread, or in refresh() of a catalog that isn't watched.
+        '''
+        if self.read_only:
+            return
+        with self._lock:
+            pending = sorted(self._pending)
+        for path in pending:
+            try:
+                values = read_metadata(path, self.measure_loudness)
+            except OSError:
+                values = None
+            folder, filename = os.path.split(path)
+            with self._lock:
+                self._pending.discard(path)
+                index = self._folders.get(folder)
+                entry = index.entries.get(filename) if index is not None else None
+                # removed, changed again (the next scan adds it again) or written by update() meanwhile
+                if values is None or entry is None or entry.hash is not None or (entry.size, entry.mtime) != (values['size'], values['mtime']):
+                    continue
+                self._add(index, SoundEntry(path, **dict(entry.to_dict(), **values)))
+        if pending:
+            self.save()
+
+    def _log(self, index, filename):
+        if len(self._changes) == self._changes.maxlen:
+            self._forgotten = self._changes[0][0]
+        self.seq += 1
+        self._changes.append((self.seq, index.folder, filename))
+        self._dirty = True
+
+    def _add(self, index, entry):
+        index.add(entry)
+        self._log(index, entry.filename)
+        # every readable file has a hash, entries without one were only listed
+        if entry.hash is None:
+            self._pending.add(entry.path)
+        else:
+            self._pending.discard(entry.path)
+
+    def _remove(self, index, filename):
+        entry = index.remove(filename)
+        if entry is not None:
+            self._log(index, filename)
+            self._pending.discard(entry.path)
+        return entry
+
+    def refresh(self, force=False):
+        '''
+        Rescans folders whose modification time changed (read only catalog: reads the catalog file again
+        if it was saved since). Without force runs at most once per check_interval, and not at all when
+        the catalog is watched (the watcher thread does it).
+        '''
+        now = time.monotonic()
+        if not force and (self._watcher is not None or now - self._checked < self.check_interval):
+            return
+        self._checked = now
+        if self.read_only:
+            changed = []
+            if self._read():
+                with self._lock:
+                    indexes = list(self._folders.values())
+                for index in indexes:
+                    changed.extend(self._sync(index))
+            if changed and self.on_change is not None:
+                self.on_change(*changed)
+            return
+        changed = []
+        with self._lock:
+            indexes = list(self._folders.values())
+        for index in indexes:
+            try:
+                mtime = os.stat(index.folder).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if mtime != index.mtime:
+                changed.extend(self._scan(index))
+        if self._watcher is None:
+            self.fill()
+        self.save()
+        if changed and self.on_change is not None:
+            self.on_change(*changed)
+
+    def watch(self):
+        '''
+        Checks folders every check_interval seconds and reads metadata of new files in a background thread
+        instead of in lookups, which then never touch the disk. on_change is called from that thread.
+        '''
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch, name='sound-catalog', daemon=True)
+            self._watcher.start()
+        return self
+
+    def _watch(self):
+        while True:
+            try:
+                self.refresh(force=True)
+                self.fill()
+            except Exception as e:
+                logger.error(f'Could not check sound folders: {e!r}')
+            time.sleep(self.check_interval)
+
+    def update(self, *paths, **metadata):
+        '''
+        Re-reads given files after they were written, renamed or removed. Keyword arguments
+        (e.g. loudness measured during conversion) are stored for the files that exist.
+        '''
+        for path in paths:
+            path = os.path.normpath(path)
+            if not is_audio_file(path):
+                continue
+            folder, filename = os.path.split(path)
+            with self._lock:
+                index = self._index(folder)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    self._remove(index, filename)
+                    continue
+                entry = index.entries.get(filename)
+            if entry is None or (entry.size, entry.mtime) != (stat.st_size, stat.st_mtime_ns):
+                values = read_metadata(path, self.measure_loudness and 'loudness' not in metadata)
+                entry = SoundEntry(path, **values)
+            for key, value in metadata.items():
+                setattr(entry, key, value)
+            with self._lock:
+                self._add(index, entry)
+        self.save()
+
+    def duplicate(self, source, target):
+        '''
+        Adds target, just written as a link to (or renamed from) source, with metadata of source instead
+        of reading the file again. Source may already be gone, its entry is used until the next scan.
+        '''
+        source, target = os.path.normpath(source), os.path.normpath(target)
+        with self._lock:
+            entry = self._index(os.path.dirname(source)).entries.get(os.path.basename(source))
+        if entry is None:
+            return self.update(target)
+        stat = os.stat(target)
+        values = dict(entry.to_dict(), size=stat.st_size, mtime=stat.st_mtime_ns)
+        with self._lock:
+            self._add(self._index(os.path.dirname(target)), SoundEntry(target, **values))
+        self.save()
+
+    def save(self):
+        if not self.path or self.read_only:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = {entry.path: entry.to_dict() for index in self._folders.values() for entry in index.entries.values()}
+            # keep stored metadata of folders that weren't loaded in this run
+            entries.update(self._stored)
+            self._dirty = False
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'entries': entries}, f)
+        os.replace(self.path + '.tmp', self.path)
+
+    def get(self, folder, filename):
+        '''
+        Returns entry of the file, or None. Filename must be a plain name from the folder (no path separators).
+        '''
+        self.refresh()
+        return self._index(folder).entries.get(filename)
+
+    def find(self, path):
+        '''
+        Path of an existing sound with the same name in the preferred format (see AUDIO_EXTENSIONS),
+        or None. Path can be given with or without an extension.
+        '''
+        self.refresh()
+        folder, name = os.path.split(os.path.normpath(path))
+        exts = self._index(folder or '.').names.get(strip_extension(name))
+        if not exts:
+            return None
+        for ext in AUDIO_EXTENSIONS:
+            if ext in exts:
+                return exts[ext].path
+        return None
+
+    def entry(self, path):
+        '''
+        Entry of the sound found by find(), or None.
+        '''
+        found = self.find(path)
+        return self._index(os.path.dirname(found)).entries.get(os.path.basename(found)) if found else None
+
+    def files(self, folder):
+        '''
+        Sorted tuple of audio filenames in the folder.
+        '''
+        self.refresh()
+        return self._index(folder).files()
+
+    def names(self, folder):
+        '''
+        Sorted tuple of sound names (filenames without audio extension) in the folder,
+        a sound stored in several formats is listed once.
+        '''
+        self.refresh()
+        return self._index(folder).sound_names()
+
+    def entries(self, folder):
+        '''
+        Entries of the folder sorted by filename.
+        '''
+        self.refresh()
+        index = self._index(folder)
+        with self._lock:
+            return [index.entries[filename] for filename in index.files()]
+
+    def versions(self, folder, base):
+        '''
+        Versioned files (`base.N.ext`) sorted by version.
+        '''
+        self.refresh()
+        index = self._index(folder)
+        with self._lock:
+            versions = index.versions.get(base, {})
+            return [versions[version] for version in sorted(versions)]
+
+    def cursor(self):
+        '''
+        Opaque position in the change log, pass it to changes() to get what changed after it.
+        '''
+        return f'{self.epoch}-{self.seq}'
+
+    def page(self, folder, offset=0, limit=100, query=None):
+        '''
+        Returns (cursor, number of matching entries, entries[offset:offset + limit]) sorted by filename.
+        query filters by a case-insensitive substring of the filename.
+        '''
+        self.refresh()
+        index = self._index(folder)
+        with self._lock:
+            files = index.files()
+            if query:
+                query = query.lower()
+                files = [filename for filename in files if query in filename.lower()]
+            return self.cursor(), len(files), [index.entries[filename] for filename in files[offset:offset + limit]]
+
+    def changes(self, folder, since):
+        '''
+        Returns (cursor, {filename: entry or None if removed}) of files in the folder changed after `since` cursor,
+        or (cursor, None) if it is from another run or too old, then the client has to load everything again.
+        '''
+        self.refresh()
+        index = self._index(folder)
+        epoch, _, seq = (since or '').partition('-')
+        with self._lock:
+            if epoch != self.epoch or not seq.isdigit() or not self._forgotten <= int(seq) <= self.seq:
+                return self.cursor(), None
+            seq = int(seq)
+            changed = {}
+            # log is ordered, walk it from the end
+            for change_seq, change_folder, filename in reversed(self._changes):
+                if change_seq <= seq:
+                    break
+                if change_folder == index.folder:
+                    changed[filename] = index.entries.get(filename)
+            return self.cursor(), changed
+
+    def stats(self):
+        with self._lock:
+            return {
+                'folders': len(self._folders),
+                'entries': sum(len(index.entries) for index in self._folders.values()),
+                'scans': self.scans
+            }
@@ -0,0 +1,118 @@
+'''
+Coalescing of voice state events into batched announcements.
+
+When many members join at once (raid, scheduled event), announcing every one of them separately
+floods the playback queue. The first event in a quiet channel is announced right away, the events that
+follow within a short window are collected and announced together when the window closes:
+a few members get their sounds played back to back, a bigger crowd gets one default sound.
+Events cancelled by a later event (join then leave, mute then unmute) are dropped.
+'''
+import time
+import asyncio
+import logging
+
+from playback import GREETING, LEAVE, MUTE
+
+logger = logging.getLogger('HeyHeyBot')
+
+
+class ChannelBatch:
+    def __init__(self):
+        self.events = {} # {member_id: (member, kind, perf_counter() when received)}, in arrival order
+        self.timer = None
+
+    def add(self, member, kind, received):
+        existing = self.events.get(member.id)
+        if existing is None:
+            self.events[member.id] = (member, kind, received)
+            return
+        existing_kind = existing[1]
+        if existing_kind == kind:
+            if kind == MUTE:
+                # muted and unmuted back
+                del self.events[member.id]
+        elif {existing_kind, kind} == {GREETING, LEAVE}:
+            # joined and left (or left and came back) before anything was announced
+            del self.events[member.id]
+        elif kind == MUTE:
+            # muting right after joining is not worth a separate announcement
+            pass
+        else:
+            del self.events[member.id]
+            self.events[member.id] = (member, kind, received)
+
+
+class VoiceEventCoalescer:
+    '''
+    Collects voice events per channel and passes them on in batches.
+
+    announce(channel, kind, members, condensed, received) is a coroutine called once per event kind in a batch,
+    condensed is True when there are more than max_batch members and one default sound should be played,
+    received is perf_counter() time of the first of the events (for latency metrics).
+    window - seconds to collect events for, 0 announces every event on its own.
+    '''
+    def __init__(self, announce, window=2.0, max_batch=5):
+        self.announce = announce
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = {} # {channel_id: ChannelBatch}
+        self.tasks = set() # running windows and announcements, the loop only keeps weak references to tasks
+
+    def add(self, channel, member, kind):
+        received = time.perf_counter()
+        batch = self.batches.get(channel.id)
+        if self.window <= 0 or batch is None:
+            # nothing announced in this channel recently, play right away and collect what follows
+            if self.window > 0:
+                batch = self.batches[channel.id] = ChannelBatch()
+                batch.timer = self._start(self._close_window(channel, batch))
+            self._emit(channel, [(member, kind, received)])
+            return
+        batch.add(member, kind, received)
+
+    def discard(self, channel, member):
+        '''
+        Drops pending event of a member in the channel, e.g. when they moved to another channel.
+        '''
+        batch = self.batches.get(channel.id)
+        if batch is not None:
+            batch.events.pop(member.id, None)
+
+    async def _close_window(self, channel, batch):
+        while True:
+            await asyncio.sleep(self.window)
+            if not batch.events:
+                del self.batches[channel.id]
+                return
+            events = list(batch.events.values())
+            batch.events = {}
+            if len(events) > 1:
+                logger.info(f'Coalesced {len(events)} voice events in {channel.name}')
+            self._emit(channel, events)
+            # keep collecting while the burst goes on
+
+    def _emit(self, channel, events):
+        by_kind = {}
+        for member, kind, received in events:
+            members, first = by_kind.get(kind, ([], received))
+            members.append(member)
+            by_kind[kind] = (members, min(first, received))
+        for kind, (members, received) in sorted(by_kind.items(), key=lambda item: item[0]):
+            self._start(self._announce(channel, kind, members, received))
+
+    def _start(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f'Voice event task failed: {task.exception()!r}')
+
+    async def _announce(self, channel, kind, members, received):
+        try:
+            await self.announce(channel, kind, members, len(members) > self.max_batch, received)
+        except Exception as e:
+            logger.error(f'Error announcing in {channel.name}: {e}')
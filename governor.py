@@ -0,0 +1,140 @@
+'''
+Admission control of FFmpeg work, shared by the bot and the webserver running in the same process.
+
+Two kinds of work start FFmpeg: playback (decoding a sound the bot is about to play) and transcoding
+(conversion and previews of uploads, the sound pack, loudness of unusual files). Each kind has a number of
+slots, FFmpeg runs only while its caller holds one. Playback always goes first:
+- transcoding doesn't start while playback waits for a slot,
+- transcoding FFmpeg runs with a lower CPU priority (nice), so the ones already running yield to playback.
+
+Work is never queued without a limit. When all slots of a kind are taken and `backlog` callers already
+wait, slot() raises Busy right away. The webserver reserves a place with admit() when an upload arrives,
+so a flood of uploads is answered with 429 before the files are received, and releases it when the
+conversion is done.
+
+Limits are set with configure() (app.py reads them from FFMPEG_* variables). With several bot processes
+(DISCORD_SHARD_PROCESSES) every process has its own governor; bot processes play sounds from the pack,
+so they rarely start FFmpeg.
+'''
+import shutil
+import threading
+import contextlib
+
+import metrics
+
+PLAYBACK = 'playback'
+TRANSCODE = 'transcode'
+KINDS = (PLAYBACK, TRANSCODE)
+
+REJECTED = metrics.counter('heyhey_ffmpeg_rejected_total', 'FFmpeg work rejected because its budget was used up', ('kind',))
+WAIT_SECONDS = metrics.histogram('heyhey_ffmpeg_wait_seconds', 'Time FFmpeg work waited for a slot', ('kind',))
+
+
+class Busy(Exception):
+    def __init__(self, kind):
+        super().__init__(f'Too much {kind} work, try again later')
+        self.kind = kind
+
+
+class Governor:
+    '''
+    slots - {kind: FFmpeg processes of the kind running at a time}
+    backlog - {kind: callers allowed to wait for a slot (or admitted uploads waiting for conversion)}
+    nice - niceness of transcoding FFmpeg processes (0 disables)
+    '''
+    def __init__(self, slots=None, backlog=None, nice=10):
+        self.slots = {PLAYBACK: 2, TRANSCODE: 1}
+        self.backlog = {PLAYBACK: 4, TRANSCODE: 16}
+        self.nice = nice
+        self._running = dict.fromkeys(KINDS, 0)
+        self._waiting = dict.fromkeys(KINDS, 0)
+        self._admitted = dict.fromkeys(KINDS, 0)
+        self._changed = threading.Condition()
+        self.configure(slots, backlog)
+
+    def configure(self, slots=None, backlog=None, nice=None):
+        with self._changed:
+            self.slots.update({kind: max(1, value) for kind, value in (slots or {}).items()})
+            self.backlog.update({kind: max(0, value) for kind, value in (backlog or {}).items()})
+            if nice is not None:
+                self.nice = nice
+            self._changed.notify_all()
+
+    def _load(self, kind):
+        # admitted work holds its place until it is released, also while it runs
+        return max(self._admitted[kind], self._running[kind] + self._waiting[kind])
+
+    def busy(self, kind):
+        '''
+        True if new work of the kind would be rejected.
+        '''
+        with self._changed:
+            return self._load(kind) >= self.slots[kind] + self.backlog[kind]
+
+    def admit(self, kind=TRANSCODE):
+        '''
+        Reserves a place for work that will run later (an upload waiting for conversion), raises Busy if
+        there is none. Every admit() must be followed by release().
+        '''
+        with self._changed:
+            if self._load(kind) >= self.slots[kind] + self.backlog[kind]:
+                REJECTED.inc(kind=kind)
+                raise Busy(kind)
+            self._admitted[kind] += 1
+
+    def release(self, kind=TRANSCODE):
+        with self._changed:
+            self._admitted[kind] -= 1
+            self._changed.notify_all()
+
+    def _can_run(self, kind):
+        if self._running[kind] >= self.slots[kind]:
+            return False
+        return kind == PLAYBACK or self._waiting[PLAYBACK] == 0
+
+    @contextlib.contextmanager
+    def slot(self, kind):
+        '''
+        Holds a slot of the kind while FFmpeg runs, waits for one if all are taken.
+        Raises Busy without waiting if too many callers wait already. Admitted uploads don't count here,
+        their conversion waits for its slots like any other work.
+        '''
+        with WAIT_SECONDS.time(kind=kind), self._changed:
+            if self._running[kind] + self._waiting[kind] >= self.slots[kind] + self.backlog[kind]:
+                REJECTED.inc(kind=kind)
+                raise Busy(kind)
+            self._waiting[kind] += 1
+            try:
+                self._changed.wait_for(lambda: self._can_run(kind))
+            finally:
+                self._waiting[kind] -= 1
+            self._running[kind] += 1
+        try:
+            yield
+        finally:
+            with self._changed:
+                self._running[kind] -= 1
+                self._changed.notify_all()
+
+    def command(self, kind, args):
+        '''
+        FFmpeg command line for work of the kind: transcoding runs with a lower CPU priority.
+        '''
+        if kind == TRANSCODE and self.nice and shutil.which('nice'):
+            return ['nice', '-n', str(self.nice), *args]
+        return list(args)
+
+    def stats(self):
+        with self._changed:
+            return {kind: {'running': self._running[kind], 'waiting': self._waiting[kind], 'admitted': self._admitted[kind],
+                           'slots': self.slots[kind], 'backlog': self.backlog[kind]} for kind in KINDS}
+
+
+GOVERNOR = Governor()
+configure = GOVERNOR.configure
+busy = GOVERNOR.busy
+admit = GOVERNOR.admit
+release = GOVERNOR.release
+slot = GOVERNOR.slot
+command = GOVERNOR.command
+stats = GOVERNOR.stats
@@ -0,0 +1,212 @@
+'''
+Conversion of uploaded sounds to the format the bot plays.
+
+Every sound is brought to 48 kHz 16-bit stereo, its loudness is measured in-process (see loudness.py)
+and a linear gain brings it to the target loudness. WAV output is written directly from Python,
+Opus output is encoded by FFmpeg in the same pass that applies the gain.
+FFmpeg is only started to decode formats other than 48 kHz stereo WAV and to encode Opus.
+Leading and trailing silence is cut, so a greeting is heard as soon as it starts to play.
+'''
+import os
+import wave
+import tarfile
+import zipfile
+import subprocess
+import contextlib
+
+import numpy as np
+
+import metrics
+import governor
+from loudness import analyze_file, iter_wav, normalization_gain
+
+SAMPLE_RATE = 48000
+CHANNELS = 2
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+
+def is_canonical_wav(audio_file):
+    '''
+    Checks if file is a 48 kHz 16-bit stereo WAV, the format the bot plays without decoding.
+    '''
+    try:
+        with contextlib.closing(wave.open(audio_file, 'rb')) as f:
+            return (f.getframerate(), f.getnchannels(), f.getsampwidth()) == (SAMPLE_RATE, CHANNELS, 2)
+    except (wave.Error, EOFError, OSError):
+        return False
+
+
+def iter_archive(path):
+    '''
+    Yields (name, size, file object) of regular files in a zip or tar archive, one at a time.
+    Tar archives (also compressed) are read as a stream and zip entries from their offsets, so nothing
+    is extracted or held in memory ahead of the entry being read. The file object is valid until the next entry.
+    Raises zipfile.BadZipFile or tarfile.TarError if the file is not a readable archive.
+    '''
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                with archive.open(info) as f:
+                    yield info.filename, info.file_size, f
+        return
+    with tarfile.open(path, 'r|*') as archive:
+        for member in archive:
+            # links and devices are skipped, they can point outside of the archive
+            if member.isfile():
+                yield member.name, member.size, archive.extractfile(member)
+
+
+def decode_to_wav(input_path, output_path):
+    '''
+    Decodes any audio file FFmpeg understands to 48 kHz 16-bit stereo WAV. Returns True on success.
+    '''
+    with governor.slot(governor.TRANSCODE):
+        metrics.FFMPEG_SPAWNS.inc(purpose='upload_decode')
+        result = subprocess.call(
+            governor.command(governor.TRANSCODE, ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', input_path,
+             '-ar', str(SAMPLE_RATE), '-ac', str(CHANNELS), '-c:a', 'pcm_s16le', '-f', 'wav', '-y', output_path]),
+            stdin=subprocess.DEVNULL
+        )
+    return result == 0
+
+
+def find_silence(input_wav, threshold_db=-50.0, window=0.01, lead=0.01, tail=0.05):
+    '''
+    Finds leading and trailing silence of a 16-bit WAV file: windows of `window` seconds whose RMS over all
+    channels is under threshold_db dBFS. Returns (start, end, total) in frames, the audible part is start:end.
+    `lead` seconds before the first audible window are kept so its attack isn't cut, `tail` seconds after the last
+    one so it fades out naturally. Silent files are not trimmed.
+    '''
+    threshold = (10 ** (threshold_db / 20) * 32768) ** 2 # mean square in int16 units
+    first = last = None
+    total = 0
+    rate = SAMPLE_RATE
+    for rate, channels, samples in iter_wav(input_wav):
+        size = max(int(rate * window), 1)
+        count = -(-len(samples) // size)
+        # last window of the file is padded with silence
+        padded = np.zeros((count * size, channels), dtype=np.float32)
+        padded[:len(samples)] = samples
+        power = np.square(padded.reshape(count, -1)).mean(axis=1)
+        loud = np.flatnonzero(power > threshold)
+        if loud.size:
+            if first is None:
+                first = total + int(loud[0]) * size
+            last = total + min((int(loud[-1]) + 1) * size, len(samples))
+        total += len(samples)
+    if first is None:
+        return 0, total, total
+    return max(first - int(rate * lead), 0), min(last + int(rate * tail), total), total
+
+
+def write_wav_with_gain(input_wav, output_path, gain_db, start=0, end=None):
+    '''
+    Copies 16-bit WAV file applying gain, chunk by chunk. Samples over full scale are clipped.
+    Only frames start:end are written. Raises ValueError (or wave.Error) before writing anything
+    if the input is not a 16-bit WAV file.
+    '''
+    factor = 10 ** (gain_db / 20)
+    # checked before the output is opened: closing a writer without parameters raises wave.Error,
+    # which would hide the error of the input
+    with contextlib.closing(wave.open(input_wav, 'rb')) as f:
+        if f.getsampwidth() != 2:
+            raise ValueError(f'{input_wav}: only 16-bit WAV files are supported')
+    with contextlib.closing(wave.open(output_path, 'wb')) as out:
+        params = None
+        position = 0
+        for rate, channels, samples in iter_wav(input_wav):
+            if params is None:
+                params = (rate, channels)
+                out.setnchannels(channels)
+                out.setsampwidth(2)
+                out.setframerate(rate)
+            chunk_start = position
+            position += len(samples)
+            samples = samples[max(start - chunk_start, 0):len(samples) if end is None else max(end - chunk_start, 0)]
+            if not len(samples):
+                continue
+            if factor != 1.0:
+                samples = np.clip(np.rint(samples * factor), -32768, 32767).astype('<i2')
+            out.writeframes(samples.tobytes())
+        if params is None:
+            # empty input
+            out.setnchannels(CHANNELS)
+            out.setsampwidth(2)
+            out.setframerate(SAMPLE_RATE)
+
+
+def encode_opus(input_wav, output_path, gain_db, start=0, end=None):
+    '''
+    Encodes WAV file to Ogg Opus with 20 ms frames (sent to Discord as is), applying gain. Returns True on success.
+    Only frames start:end are encoded.
+    '''
+    trim = f'atrim=start_sample={start}' + (f':end_sample={end}' if end is not None else '') + ',asetpts=PTS-STARTPTS,'
+    with governor.slot(governor.TRANSCODE):
+        metrics.FFMPEG_SPAWNS.inc(purpose='opus_encode')
+        result = subprocess.call(
+            governor.command(governor.TRANSCODE, ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', input_wav, '-af', f'{trim}volume={gain_db:.2f}dB',
+             '-c:a', 'libopus', '-b:a', '96k', '-frame_duration', '20', '-application', 'audio', '-f', 'ogg', '-y', output_path]),
+            stdin=subprocess.DEVNULL
+        )
+    return result == 0
+
+
+def encode_preview(input_path, output_path):
+    '''
+    Encodes a small preview for the web interface: 32 kbps Opus in WebM, about 50 times smaller than WAV.
+    Returns True on success.
+    '''
+    temp_path = f'{output_path}.part'
+    with governor.slot(governor.TRANSCODE):
+        metrics.FFMPEG_SPAWNS.inc(purpose='preview')
+        result = subprocess.call(
+            governor.command(governor.TRANSCODE, ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', input_path,
+             '-c:a', 'libopus', '-b:a', '32k', '-application', 'audio', '-f', 'webm', '-y', temp_path]),
+            stdin=subprocess.DEVNULL
+        )
+    if result != 0:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+    os.replace(temp_path, output_path)
+    return True
+
+
+def convert(input_path, output_path, audio_format='wav', loudness=-16.0, trim_db=-50.0):
+    '''
+    Converts input file to a normalized .wav or .opus file at output_path.
+    Silence under trim_db dBFS is cut from the start and the end (None keeps it).
+    Output is written to a temporary file first, so input and output can be the same file.
+    Returns loudness stats of the input with applied gain and seconds of silence removed (trim_start, trim_end;
+    duration is the length of the output), or None if conversion failed.
+    '''
+    base = os.path.splitext(output_path)[0]
+    decoded = f'{base}.decoded'
+    temp_path = f'{base}.converting'
+    try:
+        if is_canonical_wav(input_path):
+            source = input_path
+        elif decode_to_wav(input_path, decoded):
+            source = decoded
+        else:
+            return None
+        stats = analyze_file(source)
+        stats['gain'] = normalization_gain(stats, loudness)
+        start, end, total = find_silence(source, trim_db) if trim_db is not None else (0, None, None)
+        if total is not None:
+            stats['trim_start'] = start / SAMPLE_RATE
+            stats['trim_end'] = (total - end) / SAMPLE_RATE
+            stats['duration'] = (end - start) / SAMPLE_RATE
+        if audio_format == 'opus':
+            if not encode_opus(source, temp_path, stats['gain'], start, end):
+                return None
+        else:
+            write_wav_with_gain(source, temp_path, stats['gain'], start, end)
+        os.replace(temp_path, output_path)
+        return stats
+    finally:
+        for path in (decoded, temp_path):
+            if os.path.exists(path):
+                os.remove(path)
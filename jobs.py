@@ -0,0 +1,161 @@
+'''
+Background job queue for the webserver.
+
+Converting an upload runs FFmpeg for as long as the file takes to transcode, so request handlers
+only save the file and submit a job. Jobs run on a bounded thread pool (FFmpeg runs in its own process,
+threads only wait for it) and their status can be polled by id.
+A batch (bulk import) tracks many entries converted by such jobs, as a log of events clients can follow.
+'''
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Job:
+    def __init__(self, description):
+        self.id = uuid.uuid4().hex[:12]
+        self.description = description
+        self.status = 'queued' # queued -> running -> done / failed
+        self.error = None
+        self.result = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'description': self.description,
+            'status': self.status,
+            'error': self.error,
+            'result': self.result,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished
+        }
+
+
+class Batch:
+    '''
+    Progress of a batch of entries (files of an imported archive). Every change of an entry is appended to
+    `events` with the counts after it, so clients can follow the batch from any position (see wait()).
+    Batch is running until finish() is called and no entry is queued or converting.
+    '''
+    def __init__(self, description):
+        self.id = uuid.uuid4().hex[:12]
+        self.description = description
+        self.entries = OrderedDict() # {name: status}, queued -> converting -> done / failed
+        self.events = []
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self._adding = True
+        self._changed = threading.Condition()
+
+    @property
+    def status(self):
+        if self.error is not None:
+            return 'failed'
+        if self._adding or any(status in ('queued', 'converting') for status in self.entries.values()):
+            return 'running'
+        return 'done'
+
+    def counts(self):
+        counts = {'total': len(self.entries), 'queued': 0, 'converting': 0, 'done': 0, 'failed': 0}
+        for status in self.entries.values():
+            counts[status] += 1
+        return counts
+
+    def _event(self, **event):
+        event.update(self.counts(), batch=self.status)
+        if event['batch'] != 'running' and self.finished is None:
+            self.finished = time.time()
+        self.events.append(event)
+        self._changed.notify_all()
+
+    def update(self, name, status, **fields):
+        '''
+        Sets status of an entry, fields (error, result) are passed to clients with the event.
+        '''
+        with self._changed:
+            self.entries[name] = status
+            self._event(entry=name, status=status, **fields)
+
+    def finish(self, error=None):
+        '''
+        No more entries will be added. With an error the whole batch failed (e.g. unreadable archive).
+        '''
+        with self._changed:
+            self._adding = False
+            self.error = error
+            self._event(error=error)
+
+    def wait(self, position, timeout=None):
+        '''
+        Returns events after `position`, waiting up to timeout seconds for one (empty list on timeout).
+        '''
+        with self._changed:
+            self._changed.wait_for(lambda: len(self.events) > position, timeout)
+            return self.events[position:]
+
+    def to_dict(self):
+        with self._changed:
+            return {
+                'id': self.id,
+                'description': self.description,
+                'status': self.status,
+                'error': self.error,
+                **self.counts(),
+                'failures': [{'entry': event['entry'], 'error': event.get('error')} for event in self.events if event.get('status') == 'failed'],
+                'created': self.created,
+                'finished': self.finished
+            }
+
+
+class JobQueue:
+    '''
+    Runs jobs on at most `workers` threads. Keeps last `history` jobs for status requests.
+    '''
+    def __init__(self, workers=2, history=200):
+        self.workers = workers
+        self.history = history
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._jobs = OrderedDict() # {job_id: Job}
+        self._lock = threading.Lock()
+
+    def submit(self, description, func, *args, **kwargs):
+        '''
+        Queues func(*args, **kwargs). Its return value becomes job result, an exception marks the job failed.
+        '''
+        job = Job(description)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.history:
+                oldest = next(iter(self._jobs.values()))
+                if oldest.status in ('queued', 'running'):
+                    break
+                self._jobs.popitem(last=False)
+        self._executor.submit(self._run, job, func, args, kwargs)
+        return job
+
+    def _run(self, job, func, args, kwargs):
+        job.status = 'running'
+        job.started = time.time()
+        try:
+            job.result = func(*args, **kwargs)
+            job.status = 'done'
+        except Exception as e:
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            job.finished = time.time()
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def pending(self):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job.status in ('queued', 'running'))
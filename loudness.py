@@ -0,0 +1,238 @@
+'''
+EBU R128 / ITU-R BS.1770-4 loudness meter working on decoded PCM with NumPy.
+
+Measures integrated loudness (LUFS), loudness range (LU, EBU Tech 3342) and true peak (dBTP)
+without starting FFmpeg. Audio is fed in chunks, so long files are never held in memory;
+per 100 ms only one energy value per channel is kept.
+
+K-weighting is a pair of biquads. Running an IIR filter sample by sample is slow in Python, so its impulse
+response (which decays below 1e-9 within 8192 samples at 48 kHz) is applied as an FIR filter with FFT
+overlap-save over whole chunks. Gating follows BS.1770-4: 400 ms blocks with 75% overlap,
+-70 LUFS absolute gate and -10 LU relative gate. True peak uses 4x polyphase oversampling.
+
+Results match FFmpeg's ebur128/loudnorm within 0.1 LU for integrated loudness, 0.5 LU for loudness range
+and 0.5 dB for true peak (FFmpeg measures true peak on its own resampled signal); see
+benchmarks/bench_loudness.py for the comparison.
+'''
+import wave
+import contextlib
+
+import numpy as np
+
+SILENCE = float('-inf')
+FIR_LENGTH = 8192
+OVERSAMPLING = 4
+TRUE_PEAK_TAPS = 12 # per phase
+
+
+def k_weighting_coefficients(rate):
+    '''
+    Returns ((b, a) of the high shelf, (b, a) of the high pass) for the given sample rate (BS.1770-4, as in libebur128).
+    '''
+    f0 = 1681.974450955533
+    gain = 3.999843853973347
+    q = 0.7071752369554196
+    k = np.tan(np.pi * f0 / rate)
+    vh = 10 ** (gain / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = (
+        [(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0],
+        [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    )
+    f0 = 38.13547087602444
+    q = 0.5003270373238773
+    k = np.tan(np.pi * f0 / rate)
+    a0 = 1 + k / q + k * k
+    highpass = (
+        [1.0, -2.0, 1.0],
+        [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    )
+    return shelf, highpass
+
+
+def k_weighting_fir(rate, length=FIR_LENGTH):
+    '''
+    Impulse response of the K-weighting filter, computed once per sample rate.
+    '''
+    signal = np.zeros(length)
+    signal[0] = 1.0
+    for b, a in k_weighting_coefficients(rate):
+        out = np.zeros(length)
+        x1 = x2 = y1 = y2 = 0.0
+        for i in range(length):
+            x = signal[i]
+            y = b[0] * x + b[1] * x1 + b[2] * x2 - a[1] * y1 - a[2] * y2
+            x2, x1, y2, y1 = x1, x, y1, y
+            out[i] = y
+        signal = out
+    return signal
+
+
+def true_peak_filter():
+    '''
+    Polyphase lowpass for 4x oversampling (windowed sinc, 48 taps), shape (phases, taps).
+    '''
+    taps = OVERSAMPLING * TRUE_PEAK_TAPS
+    n = np.arange(taps) - (taps - 1) / 2
+    h = np.sinc(n / OVERSAMPLING) * np.kaiser(taps, 8.0)
+    h *= OVERSAMPLING / h.sum()
+    return h.reshape(TRUE_PEAK_TAPS, OVERSAMPLING).T[:, ::-1].copy()
+
+
+_fir_cache = {}
+
+
+class LoudnessMeter:
+    '''
+    Streaming loudness meter. Feed float samples in [-1, 1] with add() or raw s16le PCM with add_pcm().
+    Channel weights are 1.0 (left, right, center), surround channels are not weighted separately.
+    '''
+    def __init__(self, rate=48000, channels=2):
+        self.rate = rate
+        self.channels = channels
+        if rate not in _fir_cache:
+            _fir_cache[rate] = k_weighting_fir(rate)
+        fir = _fir_cache[rate]
+        self._chunk = 1 << 15
+        self._nfft = 1 << int(np.ceil(np.log2(self._chunk + len(fir) - 1)))
+        self._fir_spectrum = np.fft.rfft(fir, self._nfft)[:, None]
+        self._history = np.zeros((len(fir) - 1, channels))
+        self._subblock = rate // 10 # 100 ms
+        self._leftover = np.zeros((0, channels))
+        self._energies = [] # mean square per 100 ms sub-block, per channel
+        self._tp_filter = true_peak_filter()
+        self._tp_history = np.zeros((TRUE_PEAK_TAPS - 1, channels))
+        self._peak = 0.0
+        self.samples = 0
+
+    def add_pcm(self, data):
+        samples = np.frombuffer(data, dtype='<i2').reshape(-1, self.channels)
+        self.add(samples.astype(np.float64) / 32768.0)
+
+    def add(self, samples):
+        '''
+        Adds samples, array of shape (n, channels).
+        '''
+        samples = np.asarray(samples, dtype=np.float64).reshape(-1, self.channels)
+        for start in range(0, len(samples), self._chunk):
+            chunk = samples[start:start + self._chunk]
+            self._true_peak(chunk)
+            self._accumulate(self._filter(chunk))
+            self.samples += len(chunk)
+
+    def _filter(self, chunk):
+        # overlap-save: previous FIR_LENGTH - 1 samples are prepended, their output is discarded
+        block = np.concatenate((self._history, chunk))
+        self._history = block[-len(self._history):]
+        spectrum = np.fft.rfft(block, self._nfft, axis=0) * self._fir_spectrum
+        return np.fft.irfft(spectrum, self._nfft, axis=0)[len(self._history):len(block)]
+
+    def _accumulate(self, filtered):
+        squared = np.concatenate((self._leftover, filtered * filtered))
+        full = len(squared) // self._subblock * self._subblock
+        if full:
+            sums = squared[:full].reshape(-1, self._subblock, self.channels).mean(axis=1)
+            self._energies.extend(sums)
+        self._leftover = squared[full:]
+
+    def _true_peak(self, chunk):
+        block = np.concatenate((self._tp_history, chunk))
+        self._tp_history = block[-(TRUE_PEAK_TAPS - 1):]
+        # every phase of the oversampled signal is an FIR over the original samples,
+        # computed as a sum of shifted slices (much faster than a matmul over a strided window view)
+        n = len(chunk)
+        for phase in self._tp_filter:
+            acc = phase[0] * block[:n]
+            for k in range(1, TRUE_PEAK_TAPS):
+                acc += phase[k] * block[k:k + n]
+            self._peak = max(self._peak, float(np.abs(acc).max(initial=0.0)))
+        self._peak = max(self._peak, float(np.abs(chunk).max(initial=0.0)))
+
+    def _blocks(self, size):
+        '''
+        Loudness of sliding windows of `size` sub-blocks with 100 ms hop.
+        '''
+        if len(self._energies) < size:
+            return np.array([])
+        energies = np.asarray(self._energies).sum(axis=1)
+        windows = np.convolve(energies, np.ones(size) / size, mode='valid')
+        with np.errstate(divide='ignore'):
+            return -0.691 + 10 * np.log10(windows)
+
+    def integrated(self):
+        blocks = self._blocks(4) # 400 ms
+        blocks = blocks[blocks > -70.0]
+        if not len(blocks):
+            return SILENCE
+        relative_gate = power_mean(blocks) - 10.0
+        blocks = blocks[blocks > relative_gate]
+        return power_mean(blocks) if len(blocks) else SILENCE
+
+    def loudness_range(self):
+        blocks = self._blocks(30) # 3 s short-term loudness
+        blocks = blocks[blocks > -70.0]
+        if not len(blocks):
+            return 0.0
+        blocks = blocks[blocks > power_mean(blocks) - 20.0]
+        if not len(blocks):
+            return 0.0
+        low, high = np.percentile(blocks, [10, 95])
+        return float(high - low)
+
+    def true_peak(self):
+        return 20 * np.log10(self._peak) if self._peak > 0 else SILENCE
+
+    def result(self):
+        return {
+            'integrated': float(self.integrated()),
+            'lra': self.loudness_range(),
+            'true_peak': float(self.true_peak()),
+            'duration': self.samples / self.rate
+        }
+
+
+def power_mean(loudness):
+    return float(-0.691 + 10 * np.log10(np.mean(10 ** ((loudness + 0.691) / 10))))
+
+
+def iter_wav(audio_file, seconds=10):
+    '''
+    Yields (rate, channels, int16 array of shape (n, channels)) chunks of a 16-bit PCM WAV file.
+    '''
+    with contextlib.closing(wave.open(audio_file, 'rb')) as f:
+        if f.getsampwidth() != 2:
+            raise ValueError(f'{audio_file}: only 16-bit WAV files are supported')
+        rate, channels = f.getframerate(), f.getnchannels()
+        while True:
+            data = f.readframes(rate * seconds)
+            if not data:
+                return
+            yield rate, channels, np.frombuffer(data, dtype='<i2').reshape(-1, channels)
+
+
+def analyze_file(audio_file):
+    '''
+    Measures loudness of a 16-bit WAV file in chunks. Returns dict with integrated, lra, true_peak and duration.
+    '''
+    meter = None
+    for rate, channels, samples in iter_wav(audio_file):
+        if meter is None:
+            meter = LoudnessMeter(rate, channels)
+        meter.add(samples / 32768.0)
+    if meter is None:
+        return {'integrated': SILENCE, 'lra': 0.0, 'true_peak': SILENCE, 'duration': 0.0}
+    return meter.result()
+
+
+def normalization_gain(stats, target=-16.0, max_true_peak=-1.0):
+    '''
+    Linear gain in dB that brings integrated loudness to the target without pushing true peak over max_true_peak.
+    Silent or too short (< 400 ms) sounds get no gain.
+    '''
+    if not np.isfinite(stats['integrated']):
+        return 0.0
+    gain = target - stats['integrated']
+    if np.isfinite(stats['true_peak']):
+        gain = min(gain, max_true_peak - stats['true_peak'])
+    return float(gain)
@@ -0,0 +1,84 @@
+'''
+Resolves personal announcement sounds of members.
+
+Every voice event needs the greeting (leaving, muting) sound of a member, which is either
+`<folder>/<member name>.<ext>`, `<folder>/<member id>.<ext>` or the default sound of the folder.
+Results are cached per member id, including "no personal sound", so announcing a member costs
+a dict lookup. When the webserver (running in another thread) or the catalog changes a sound,
+entries of members with that name or id are dropped on the bot's event loop.
+'''
+import os
+import asyncio
+
+from sound_files import strip_extension
+
+
+class MemberSoundResolver:
+    '''
+    find - returns path of an existing sound for a path without extension, or None (SoundCatalog.find)
+    '''
+    def __init__(self, find):
+        self.find = find
+        self.loop = None # bot event loop, set with bind()
+        self._cache = {} # {(folder, member id): (member name, path or None)}
+        self._aliases = {} # {(folder, name or id as str): {member id}}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def bind(self, loop=None):
+        '''
+        Sets the event loop invalidations are delivered to, the running one by default.
+        '''
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+
+    def resolve(self, folder, member):
+        '''
+        Returns path of the member's personal sound in the folder, or None if the default sound should be played.
+        '''
+        folder = os.path.normpath(folder)
+        key = (folder, member.id)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] == member.name:
+            self.hits += 1
+            return cached[1]
+        self.misses += 1
+        path = None
+        for alias in (member.name, str(member.id)):
+            self._aliases.setdefault((folder, alias), set()).add(member.id)
+            if path is None:
+                path = self.find(os.path.join(folder, alias))
+        self._cache[key] = (member.name, path)
+        return path
+
+    def invalidate(self, *paths):
+        '''
+        Drops cached sounds of members whose name or id matches the changed files. Must run on the bot loop.
+        '''
+        for path in paths:
+            folder, filename = os.path.split(os.path.normpath(path))
+            member_ids = self._aliases.pop((folder, strip_extension(filename)), ())
+            for member_id in member_ids:
+                if self._cache.pop((folder, member_id), None) is not None:
+                    self.invalidations += 1
+
+    def notify(self, *paths):
+        '''
+        Thread safe invalidate(): called from the webserver thread, it is scheduled on the bot loop.
+        '''
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            # bot is not running yet, nothing is cached from its side
+            self.invalidate(*paths)
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self.invalidate(*paths)
+        else:
+            loop.call_soon_threadsafe(self.invalidate, *paths)
+
+    def stats(self):
+        return {'entries': len(self._cache), 'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations}
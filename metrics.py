@@ -0,0 +1,200 @@
+'''
+Counters and histograms of the bot, exposed in Prometheus text format by the webserver (/metrics).
+
+Metrics are module level objects updated from the bot loop, the audio player thread and web threads,
+so every update takes a lock (a dict lookup and an addition).
+Values the components already count themselves (cache sizes, connection stats) are read when metrics
+are rendered, with callbacks registered by collect().
+'''
+import time
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._values = {} # {label values: value}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _render_value(self, key, value):
+        yield f'{self.name}{_labels(self.labelnames, key)} {_number(value)}'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+                    break
+            counts[1] += value
+            counts[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def _render_value(self, key, value):
+        buckets, total, count = value
+        cumulative = 0
+        for bound, bucket in zip(self.buckets, buckets):
+            cumulative += bucket
+            yield f'{self.name}_bucket{_labels(self.labelnames, key, ("le", _number(bound)))} {cumulative}'
+        yield f'{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}'
+        yield f'{self.name}_count{_labels(self.labelnames, key)} {count}'
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Collected:
+    '''
+    Metric read from a callback when rendered. func returns a number or a list of (labels dict, number).
+    '''
+    def __init__(self, name, kind, help, func):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.func = func
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        values = self.func()
+        if not isinstance(values, list):
+            values = [({}, values)]
+        for labels, value in values:
+            lines.append(f'{self.name}{_labels(labels.keys(), labels.values())} {_number(value)}')
+        return lines
+
+
+class Span:
+    '''
+    Timeline of one operation: every mark() observes the time since the previous mark as a stage.
+    start - perf_counter() time the operation began (e.g. when the event was received), now by default
+    '''
+    def __init__(self, histogram, start=None, **labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = self.last = time.perf_counter() if start is None else start
+        self.marks = {}
+
+    def mark(self, stage, at=None):
+        at = time.perf_counter() if at is None else at
+        self.histogram.observe(max(at - self.last, 0.0), stage=stage, **self.labels)
+        self.marks[stage] = at
+        self.last = at
+        return at
+
+    def elapsed(self, at=None):
+        return (time.perf_counter() if at is None else at) - self.start
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {} # {name: metric}, in registration order
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None and not isinstance(metric, Collected):
+                return existing
+            # callbacks are replaced, e.g. when a component is created again
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def collect(self, name, kind, help, func):
+        return self._register(Collected(name, kind, help, func))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                # a failing callback must not break the whole page
+                continue
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+collect = REGISTRY.collect
+
+# shared by everything that starts FFmpeg (decoding for playback, conversion and previews of uploads)
+FFMPEG_SPAWNS = counter('heyhey_ffmpeg_spawns_total', 'FFmpeg processes started', ('purpose',))
@@ -0,0 +1,117 @@
+'''
+Real-time PCM mixer for the soundboard.
+
+A voice client can only play one AudioSource, so overlapping soundboard sounds are summed into one
+stream: every 20 ms frame of every active voice is added up with NumPy, scaled by its gain
+and passed through a peak limiter, so loud overlaps are turned down instead of clipping.
+NumPy is imported by the first mixer, not when the bot starts.
+'''
+import threading
+
+import discord
+
+from audio_cache import FRAME_SIZE, FRAME_DURATION
+
+FRAME_SAMPLES = FRAME_SIZE // 2 # int16 samples (both channels) in a frame
+PEAK = 32767.0
+
+
+class MixerVoice:
+    def __init__(self, source, gain, duration):
+        self.source = source
+        self.gain = gain
+        self.frames_left = int(duration / FRAME_DURATION) if duration else 0
+
+
+class Mixer(discord.AudioSource):
+    '''
+    AudioSource that plays several PCM sources at once.
+
+    max_voices - maximum number of sounds playing at the same time
+    release - how fast limiter gain returns to 1.0 after a loud peak, per frame
+    Playback ends when all voices are finished; after that the mixer is closed and can't take new voices.
+    '''
+    def __init__(self, max_voices=8, release=0.05):
+        import numpy as np
+        self.max_voices = max_voices
+        self.release = release
+        self.closed = False
+        self.voices = []
+        self._limiter_gain = 1.0
+        self._mix = np.zeros(FRAME_SAMPLES, dtype=np.float32)
+        self._lock = threading.Lock()
+
+    def add(self, source, gain=1.0, duration=None):
+        '''
+        Adds a PCM source to the mix. Returns False if the mixer is closed or already plays max_voices sounds.
+        '''
+        if source.is_opus():
+            raise ValueError('Mixer needs PCM sources')
+        with self._lock:
+            if self.closed or len(self.voices) >= self.max_voices:
+                return False
+            self.voices.append(MixerVoice(source, gain, duration))
+            return True
+
+    def clear(self):
+        '''
+        Stops all voices, the mixer finishes on the next read.
+        '''
+        with self._lock:
+            voices, self.voices = self.voices, []
+        for voice in voices:
+            voice.source.cleanup()
+
+    @property
+    def active(self):
+        return not self.closed and bool(self.voices)
+
+    def remaining(self):
+        '''
+        Seconds until the longest voice ends, if voice durations are known.
+        '''
+        with self._lock:
+            return max((voice.frames_left for voice in self.voices), default=0) * FRAME_DURATION
+
+    def read(self):
+        import numpy as np
+        with self._lock:
+            voices = list(self.voices)
+            if not voices:
+                self.closed = True
+                return b''
+        mix = self._mix
+        mix.fill(0)
+        finished = []
+        for voice in voices:
+            data = voice.source.read()
+            voice.frames_left -= 1
+            if len(data) != FRAME_SIZE:
+                finished.append(voice)
+                continue
+            frame = np.frombuffer(data, dtype=np.int16)
+            if voice.gain == 1.0:
+                mix += frame
+            else:
+                mix += frame * np.float32(voice.gain)
+        if finished:
+            with self._lock:
+                self.voices = [voice for voice in self.voices if voice not in finished]
+            for voice in finished:
+                voice.source.cleanup()
+        # limiter: drop gain at once on a peak, bring it back slowly
+        peak = float(np.abs(mix).max()) * self._limiter_gain
+        if peak > PEAK:
+            self._limiter_gain *= PEAK / peak
+        elif self._limiter_gain < 1.0:
+            self._limiter_gain = min(1.0, self._limiter_gain + self.release)
+        if self._limiter_gain != 1.0:
+            mix *= self._limiter_gain
+        np.clip(mix, -PEAK - 1, PEAK, out=mix)
+        return mix.astype(np.int16).tobytes()
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        self.clear()
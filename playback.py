@@ -0,0 +1,236 @@
+'''
+Playback scheduler for the bot.
+
+Every guild has its own queue of sounds that is played by a single worker task.
+Handlers only enqueue a sound and get a future back, they don't wait for playback.
+Playback completion comes from the voice client `after` callback, so the next sound starts right away
+and the bot can leave as soon as the queue is empty.
+
+Soundboard sounds are played through a mixer: a click while soundboard sounds are playing (or waiting)
+adds one more voice to the same mix instead of queueing after it or stopping it.
+
+Every played item is timed in stages, from the event that caused it to the end of playback:
+queued (event received until the guild worker takes it, including coalescing and waiting for other sounds),
+connect (voice connection ready), load (audio source ready), start (until the player read the first frame)
+and playback (first frame until done).
+'''
+import time
+import asyncio
+import bisect
+import itertools
+import logging
+
+import metrics
+from mixer import Mixer
+from audio_cache import TimedAudio
+
+logger = logging.getLogger('HeyHeyBot')
+
+# priority classes, lower plays first
+GREETING = 0
+LEAVE = 1
+MUTE = 2
+SOUNDBOARD = 3
+PRIORITY_NAMES = {GREETING: 'greeting', LEAVE: 'leave', MUTE: 'mute', SOUNDBOARD: 'soundboard'}
+
+STAGES = metrics.histogram('heyhey_playback_stage_seconds', 'Time spent in every stage of playing a sound', ('kind', 'stage'))
+LATENCY = metrics.histogram('heyhey_playback_latency_seconds', 'Time from the event to the first frame sent', ('kind',))
+PLAYED = metrics.counter('heyhey_playback_total', 'Sounds by outcome: played, failed or dropped', ('kind', 'result'))
+MIXED = metrics.counter('heyhey_mixer_joins_total', 'Soundboard sounds added to a mix that was already playing or waiting')
+
+
+class QueueFull(Exception):
+    '''
+    Raised when guild queue is full of sounds with the same or higher priority,
+    or when the soundboard mix already plays the maximum number of sounds.
+    '''
+    pass
+
+
+class PlaybackItem:
+    def __init__(self, priority, seq, channel, audio_files, future, received=None):
+        self.priority = priority
+        self.seq = seq
+        self.channel = channel
+        self.audio_files = audio_files # played back to back as one sound
+        self.future = future
+        self.mixer = None # soundboard items play a mix that can take more sounds while playing
+        self.received = time.perf_counter() if received is None else received # perf_counter() of the event
+
+    @property
+    def name(self):
+        return ', '.join(self.audio_files)
+
+    @property
+    def kind(self):
+        return PRIORITY_NAMES[self.priority]
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class GuildQueue:
+    def __init__(self):
+        self.items = [] # sorted by priority, then by arrival
+        self.current = None
+        self.task = None
+
+
+class PlaybackScheduler:
+    '''
+    Plays sounds one after another, separately for every guild.
+
+    load_source(audio_files, pcm=False) -> (AudioSource, duration) and connect(channel) -> VoiceClient are
+    coroutines provided by the bot. on_idle(guild) is awaited when the guild queue runs empty.
+    on_played(item, first_frame) is called after a sound was played, with perf_counter() time it started.
+    max_voices limits how many soundboard sounds are mixed at once.
+    '''
+    def __init__(self, load_source, connect, on_idle=None, max_queue=10, max_voices=8, on_played=None):
+        self.load_source = load_source
+        self.connect = connect
+        self.on_idle = on_idle
+        self.on_played = on_played
+        self.max_queue = max_queue
+        self.max_voices = max_voices
+        self.queues = {} # {guild_id: GuildQueue}
+        self._seq = itertools.count()
+
+    def enqueue(self, channel, audio_files, priority=SOUNDBOARD, received=None):
+        '''
+        Adds a sound to the queue of the channel's guild. Several files are played as one combined sound.
+        Returns a future that resolves to True when the sound was played, False if it failed or was dropped.
+        When the queue is full, the newest sound with a lower priority is dropped, or QueueFull is raised.
+        received - perf_counter() time of the event that caused the sound, for latency metrics (now by default)
+        '''
+        loop = asyncio.get_running_loop()
+        queue = self.queues.setdefault(channel.guild.id, GuildQueue())
+        if len(queue.items) >= self.max_queue:
+            lowest = queue.items[-1]
+            if lowest.priority <= priority:
+                PLAYED.inc(kind=PRIORITY_NAMES[priority], result='dropped')
+                raise QueueFull(f'Playback queue of {channel.guild.name} is full')
+            queue.items.pop()
+            if not lowest.future.done():
+                lowest.future.set_result(False)
+            PLAYED.inc(kind=lowest.kind, result='dropped')
+            logger.info(f'Queue full, dropped {lowest.name}')
+        if isinstance(audio_files, str):
+            audio_files = [audio_files]
+        item = PlaybackItem(priority, next(self._seq), channel, list(audio_files), loop.create_future(), received)
+        bisect.insort(queue.items, item)
+        logger.debug(f'Queued {PRIORITY_NAMES[priority]} {item.name} in {channel.guild.name} ({len(queue.items)} waiting)')
+        if queue.task is None or queue.task.done():
+            queue.task = loop.create_task(self._worker(channel.guild, queue))
+        return item.future
+
+    async def mix(self, channel, audio_file, gain=1.0):
+        '''
+        Plays a soundboard sound together with other soundboard sounds of the channel.
+        Joins the mix that is playing or waiting in the queue, or queues a new one.
+        Returns a future that resolves when the mix has finished. Raises QueueFull when no more sounds fit.
+        '''
+        received = time.perf_counter()
+        source, duration = await self.load_source([audio_file], pcm=True)
+        queue = self.queues.setdefault(channel.guild.id, GuildQueue())
+        for item in [queue.current, *queue.items]:
+            if item is not None and item.mixer is not None and item.channel == channel:
+                if item.mixer.add(source, gain, duration):
+                    MIXED.inc()
+                    logger.debug(f'Mixing {audio_file} in {channel.guild.name} ({len(item.mixer.voices)} voices)')
+                    item.audio_files.append(audio_file)
+                    return item.future
+                if not item.mixer.closed:
+                    PLAYED.inc(kind=PRIORITY_NAMES[SOUNDBOARD], result='dropped')
+                    raise QueueFull(f'Already mixing {self.max_voices} sounds in {channel.guild.name}')
+        future = self.enqueue(channel, [audio_file], SOUNDBOARD, received)
+        item = next(item for item in queue.items if item.future is future)
+        item.mixer = Mixer(max_voices=self.max_voices)
+        item.mixer.add(source, gain, duration)
+        return future
+
+    def stop(self, guild):
+        '''
+        Drops queued sounds of the guild and stops the current one.
+        '''
+        queue = self.queues.get(guild.id)
+        if queue is not None:
+            for item in queue.items:
+                if not item.future.done():
+                    item.future.set_result(False)
+                PLAYED.inc(kind=item.kind, result='dropped')
+            queue.items.clear()
+            if queue.current is not None and queue.current.mixer is not None:
+                queue.current.mixer.clear()
+        if guild.voice_client is not None and guild.voice_client.is_playing():
+            guild.voice_client.stop()
+
+    def is_busy(self, guild):
+        queue = self.queues.get(guild.id)
+        return queue is not None and (queue.current is not None or bool(queue.items))
+
+    async def _play(self, item):
+        loop = asyncio.get_running_loop()
+        span = metrics.Span(STAGES, start=item.received, kind=item.kind)
+        span.mark('queued')
+        voice_client = await self.connect(item.channel)
+        span.mark('connect')
+        if item.mixer is not None:
+            source, duration = item.mixer, item.mixer.remaining()
+        else:
+            source, duration = await self.load_source(item.audio_files)
+        span.mark('load')
+        source = TimedAudio(source)
+        done = loop.create_future()
+
+        def after(error):
+            # called from the audio player thread
+            loop.call_soon_threadsafe(lambda: done.done() or done.set_result(error))
+
+        if voice_client.is_playing():
+            voice_client.stop()
+        voice_client.play(source, after=after)
+        timeout = duration + 5
+        while True:
+            try:
+                # `after` is not called if the connection dies, don't wait forever
+                error = await asyncio.wait_for(asyncio.shield(done), timeout=timeout)
+                break
+            except asyncio.TimeoutError:
+                # mix got longer while playing
+                if item.mixer is not None and item.mixer.active:
+                    timeout = item.mixer.remaining() + 5
+                    continue
+                voice_client.stop()
+                raise
+        if source.first_frame is not None:
+            span.mark('start', at=source.first_frame)
+            span.mark('playback')
+            LATENCY.observe(span.elapsed(source.first_frame), kind=item.kind)
+            if self.on_played is not None:
+                self.on_played(item, source.first_frame)
+        if error:
+            raise error
+
+    async def _worker(self, guild, queue):
+        while True:
+            while queue.items:
+                item = queue.current = queue.items.pop(0)
+                try:
+                    await self._play(item)
+                    played = True
+                except Exception as e:
+                    logger.error(f'Error playing {item.name} in {guild.name}: {e!r}')
+                    played = False
+                finally:
+                    queue.current = None
+                PLAYED.inc(kind=item.kind, result='played' if played else 'failed')
+                if not item.future.done():
+                    item.future.set_result(played)
+            if self.on_idle is not None:
+                try:
+                    await self.on_idle(guild)
+                except Exception as e:
+                    logger.warning(f'Error in idle handler for {guild.name}: {e}')
+            # sounds could have been queued while the idle handler was running
+            if not queue.items:
+                break
@@ -0,0 +1,132 @@
+'''
+Runs the bot as several processes, each connected to a part of Discord shards.
+
+The supervisor (the process started by the user) splits shards between worker processes and starts them
+one after another: Discord allows one shard to identify every ~5 seconds, so worker n starts after the
+shards of the workers before it had time to connect. Workers that exit are restarted, with a delay that
+grows while they keep crashing. SIGTERM / SIGINT of the supervisor stops all workers.
+
+Workers run the same script with these variables set:
+  HEYHEY_SHARD_WORKER - number of the worker
+  HEYHEY_SHARD_IDS    - shards of the worker, comma separated
+  HEYHEY_SHARD_COUNT  - total number of shards
+'''
+import os
+import sys
+import time
+import signal
+import logging
+import subprocess
+
+logger = logging.getLogger('HeyHeyBot')
+
+
+def layout(shard_count, processes):
+    '''
+    Splits shards 0..shard_count-1 into `processes` contiguous groups of (almost) equal size.
+    '''
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    groups = []
+    start = 0
+    for i in range(processes):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(list(range(start, end)))
+        start = end
+    return groups
+
+
+class Worker:
+    def __init__(self, number, shard_ids):
+        self.number = number
+        self.shard_ids = shard_ids
+        self.process = None
+        self.started = 0.0
+        self.failures = 0 # exits in a row shortly after start
+        self.restart_at = None
+
+
+class ShardSupervisor:
+    '''
+    shard_count - total number of shards
+    processes - number of worker processes
+    command - command line of a worker (this script by default)
+    identify_delay - seconds between identifying two shards (Discord's limit is 1 per 5 s)
+    restart_delay - delay before restarting a worker, doubled for every crash in a row (up to 5 minutes)
+    '''
+    def __init__(self, shard_count, processes, command=None, identify_delay=5.0, restart_delay=5.0):
+        self.shard_count = shard_count
+        self.command = command or [sys.executable, os.path.abspath(sys.argv[0])]
+        self.identify_delay = identify_delay
+        self.restart_delay = restart_delay
+        self.workers = [Worker(i, shard_ids) for i, shard_ids in enumerate(layout(shard_count, processes))]
+        self._stopping = False
+
+    def start(self, worker):
+        env = dict(os.environ,
+                   HEYHEY_SHARD_WORKER=str(worker.number),
+                   HEYHEY_SHARD_IDS=','.join(map(str, worker.shard_ids)),
+                   HEYHEY_SHARD_COUNT=str(self.shard_count))
+        worker.process = subprocess.Popen(self.command, env=env)
+        worker.started = time.monotonic()
+        worker.restart_at = None
+        logger.info(f'Started worker {worker.number} (pid {worker.process.pid}) with shards {worker.shard_ids}')
+
+    def stop(self, *args):
+        self._stopping = True
+
+    def run(self):
+        '''
+        Starts workers and watches them until the supervisor is asked to stop. Blocking.
+        '''
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logger.info(f'Running {self.shard_count} shards in {len(self.workers)} processes')
+        try:
+            for worker in self.workers:
+                if self._stopping:
+                    break
+                self.start(worker)
+                self._sleep(self.identify_delay * len(worker.shard_ids))
+            while not self._stopping:
+                self.check()
+                self._sleep(1)
+        finally:
+            self.shutdown()
+
+    def check(self):
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    self.start(worker)
+                continue
+            code = worker.process.poll()
+            if code is None:
+                if now - worker.started > 300:
+                    worker.failures = 0
+                continue
+            # worker that ran for a while is restarted right away, crash loops are slowed down
+            worker.failures = worker.failures + 1 if now - worker.started < 300 else 0
+            delay = min(self.restart_delay * 2 ** max(worker.failures - 1, 0), 300)
+            worker.restart_at = now + delay
+            logger.warning(f'Worker {worker.number} exited with code {code}, restarting in {delay:.0f} s')
+
+    def shutdown(self, timeout=10):
+        running = [worker.process for worker in self.workers if worker.process is not None and worker.process.poll() is None]
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in running:
+            try:
+                process.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                process.kill()
+        logger.info('Workers stopped')
+
+    def _sleep(self, seconds):
+        deadline = time.monotonic() + seconds
+        while not self._stopping and time.monotonic() < deadline:
+            time.sleep(min(0.5, deadline - time.monotonic()))
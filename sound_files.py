@@ -0,0 +1,20 @@
+'''
+Helpers for locating sound files on disk.
+Sounds can be stored as .wav (48 kHz stereo PCM) or .opus (Ogg Opus, 20 ms frames), depending on AUDIO_FORMAT.
+'''
+import os
+
+AUDIO_EXTENSIONS = ('.opus', '.wav') # preferred first
+
+
+def is_audio_file(filename):
+    return filename.lower().endswith(AUDIO_EXTENSIONS)
+
+
+def strip_extension(filename):
+    '''
+    Removes audio extension from the filename, other suffixes (like version numbers) are kept.
+    '''
+    base, ext = os.path.splitext(filename)
+    return base if ext.lower() in AUDIO_EXTENSIONS else filename
+
@@ -0,0 +1,162 @@
+'''
+In-memory search index of sound names for autocomplete.
+
+Names are normalized (case folded, `_`, `-` and `.` treated as spaces) and indexed by trigrams and by
+the first characters of every word. A query is split into words, every word must be found in the name:
+words of 3+ characters are looked up by intersecting trigram posting sets, shorter ones by word prefix.
+Matches are ranked: names starting with the query (taken in order from a sorted list, which is all
+a query being typed usually needs), then names with a word starting with the first query word,
+then the rest; shorter names first.
+If there are not enough matches, names sharing most trigrams with the query fill the rest (typos).
+The index follows the catalog incrementally: only added and removed names are (un)indexed.
+'''
+import re
+import heapq
+import bisect
+from collections import Counter
+
+GRAM = 3
+SHORT_PREFIX = GRAM - 1 # words shorter than a trigram are found by their first characters
+FUZZY_MIN_SCORE = 0.5 # share of query trigrams a fuzzy match must contain
+
+_separators = re.compile(r'[\s_\-.]+')
+
+
+def normalize(text):
+    return _separators.sub(' ', text.casefold()).strip()
+
+
+def grams(text):
+    return {text[i:i + GRAM] for i in range(len(text) - GRAM + 1)}
+
+
+class SoundIndex:
+    def __init__(self, names=()):
+        self._source = None # names sequence the index was last synced with
+        self._normalized = {} # {name: normalized name}
+        self._sorted = [] # sorted (normalized name, name), for prefix queries
+        self._grams = {} # {trigram: {name}}
+        self._prefixes = {} # {first 1..SHORT_PREFIX characters of a word: {name}}
+        self.sync(names)
+
+    def __len__(self):
+        return len(self._normalized)
+
+    def _keys(self, normalized):
+        prefixes = {word[:length] for word in normalized.split() for length in range(1, SHORT_PREFIX + 1)}
+        return grams(normalized), prefixes
+
+    def add(self, name):
+        if name in self._normalized:
+            return
+        normalized = normalize(name)
+        self._normalized[name] = normalized
+        bisect.insort(self._sorted, (normalized, name))
+        trigrams, prefixes = self._keys(normalized)
+        for gram in trigrams:
+            self._grams.setdefault(gram, set()).add(name)
+        for prefix in prefixes:
+            self._prefixes.setdefault(prefix, set()).add(name)
+
+    def remove(self, name):
+        normalized = self._normalized.pop(name, None)
+        if normalized is None:
+            return
+        del self._sorted[bisect.bisect_left(self._sorted, (normalized, name))]
+        trigrams, prefixes = self._keys(normalized)
+        for keys, index in ((trigrams, self._grams), (prefixes, self._prefixes)):
+            for key in keys:
+                names = index[key]
+                names.discard(name)
+                if not names:
+                    del index[key]
+
+    def sync(self, names):
+        '''
+        Brings the index in line with names. Cheap when called with the same (cached) sequence again,
+        otherwise only the difference is indexed.
+        '''
+        if names is self._source:
+            return
+        wanted = set(names)
+        current = self._normalized.keys()
+        for name in current - wanted:
+            self.remove(name)
+        for name in wanted - current:
+            self.add(name)
+        # mutable containers can change without becoming another object
+        self._source = names if isinstance(names, (tuple, frozenset)) else None
+
+    def _candidates(self, words):
+        '''
+        Names that may contain all the words: intersection of posting sets, smallest first.
+        '''
+        postings = []
+        for word in words:
+            if len(word) >= GRAM:
+                postings.extend(self._grams.get(gram, set()) for gram in grams(word))
+            else:
+                postings.append(self._prefixes.get(word, set()))
+        postings.sort(key=len)
+        return postings[0].intersection(*postings[1:])
+
+    def _prefixed(self, query, limit):
+        '''
+        Names starting with the query in sorted order (exact match first), at most limit.
+        '''
+        result = []
+        i = bisect.bisect_left(self._sorted, (query,))
+        while i < len(self._sorted) and len(result) < limit:
+            normalized, name = self._sorted[i]
+            if not normalized.startswith(query):
+                break
+            result.append(name)
+            i += 1
+        return result
+
+    def _rank(self, name, first):
+        normalized = self._normalized[name]
+        kind = 0 if f' {first}' in normalized else 1
+        return kind, len(normalized), name
+
+    def search(self, query, limit=25):
+        '''
+        Best matching names for the query, at most limit.
+        '''
+        query = normalize(query)
+        words = query.split()
+        if not words:
+            return [name for _, name in self._sorted[:limit]]
+        result = self._prefixed(query, limit)
+        if len(result) == limit:
+            return result
+        exclude = set(result)
+        matches = (
+            name for name in self._candidates(words)
+            if name not in exclude and all(self._matches(self._normalized[name], word) for word in words)
+        )
+        result.extend(name for *_, name in heapq.nsmallest(limit - len(result), map(lambda name: self._rank(name, words[0]), matches)))
+        if len(result) < limit:
+            result.extend(self._fuzzy(query, limit - len(result), exclude=set(result)))
+        return result
+
+    @staticmethod
+    def _matches(normalized, word):
+        if len(word) >= GRAM:
+            return word in normalized
+        # short words only match the beginning of a word
+        return normalized.startswith(word) or f' {word}' in normalized
+
+    def _fuzzy(self, query, limit, exclude):
+        query_grams = grams(query)
+        if not query_grams:
+            return []
+        hits = Counter()
+        for gram in query_grams:
+            hits.update(self._grams.get(gram, ()))
+        required = len(query_grams) * FUZZY_MIN_SCORE
+        ranked = heapq.nsmallest(limit, (
+            (-count, len(self._normalized[name]), name) for name, count in hits.items()
+            if count >= required and name not in exclude
+        ))
+        return [name for *_, name in ranked]
@@ -0,0 +1,306 @@
+'''
+Pack file of decoded sounds, shared by bot processes through a memory map.
+
+When the bot runs in several processes (DISCORD_SHARD_PROCESSES), every process caching decoded audio
+would keep its own copy of every sound. Instead, the process that owns the catalog writes all sounds,
+decoded to 48 kHz s16le stereo PCM (plus Opus packets of .opus files, sent without re-encoding),
+into one file. Bot processes map it read-only: sources read frames straight from the mapping, so the
+audio lives once in the OS page cache no matter how many processes play it.
+
+Layout: magic, index offset and length, then 8-byte aligned blobs, then a JSON index
+{path: {size, mtime, duration, pcm: [offset, length], opus: [offsets table offset, packets, data offset]}}.
+Opus packets are stored back to back with a table of packets + 1 uint32 offsets.
+The file is rewritten to a temporary file and renamed over the old one, readers notice the new file
+and map it, sources that are playing keep the old mapping until they are done.
+Sounds that changed since the pack was written are not served from it (the caller decodes them itself).
+'''
+import os
+import json
+import mmap
+import time
+import array
+import struct
+import logging
+import threading
+
+import discord
+
+import governor
+from audio_cache import FRAME_SIZE, FRAME_DURATION, BYTES_PER_SECOND, decode_pcm, read_opus_packets
+
+logger = logging.getLogger('HeyHeyBot')
+
+MAGIC = b'HHBPACK1'
+HEADER = struct.Struct('<8sQQ') # magic, index offset, index length
+ALIGN = 8
+
+
+class MappedPCMAudio(discord.AudioSource):
+    '''
+    Plays PCM frames from a range of a memory map (or any buffer).
+    '''
+    def __init__(self, buffer, start, length):
+        self.buffer = buffer
+        self.position = start
+        self.end = start + length
+
+    def read(self):
+        if self.position + FRAME_SIZE > self.end:
+            return b''
+        chunk = self.buffer[self.position:self.position + FRAME_SIZE]
+        self.position += FRAME_SIZE
+        return chunk
+
+    def is_opus(self):
+        return False
+
+
+class MappedOpusAudio(discord.AudioSource):
+    '''
+    Plays Opus packets from a memory map, offsets[i]:offsets[i + 1] is packet i relative to data start.
+    '''
+    def __init__(self, buffer, offsets, data):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.data = data
+        self.index = 0
+
+    def read(self):
+        if self.index + 1 >= len(self.offsets):
+            return b''
+        packet = self.buffer[self.data + self.offsets[self.index]:self.data + self.offsets[self.index + 1]]
+        self.index += 1
+        return packet
+
+    def is_opus(self):
+        return True
+
+
+class PackEntry:
+    '''
+    A sound in the pack, used like audio_cache entries. Its audio is in the mapping, not in process memory.
+    '''
+    size = 0
+
+    def __init__(self, buffer, duration, pcm=None, opus=None):
+        self.buffer = buffer
+        self.duration = duration
+        self.pcm = pcm
+        self.opus = opus is not None
+        self._opus = opus
+
+    def source(self):
+        if self._opus is not None:
+            table, count, data = self._opus
+            offsets = memoryview(self.buffer)[table:table + (count + 1) * 4].cast('I')
+            return MappedOpusAudio(self.buffer, offsets, data)
+        return MappedPCMAudio(self.buffer, *self.pcm)
+
+
+class SoundPack:
+    '''
+    Read side of the pack. get() returns entries of sounds that didn't change since the pack was written.
+    check_interval - how often (seconds) the file is checked for a newer pack
+    catalog - SoundCatalog sizes and modification times of sounds are compared with, instead of checking the files
+    '''
+    def __init__(self, path, check_interval=1.0, catalog=None):
+        self.path = path
+        self.check_interval = check_interval
+        self.catalog = catalog
+        self._map = None
+        self._index = {}
+        self._stat = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale = 0
+
+    def _open(self):
+        try:
+            with open(self.path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                if stat.st_size < HEADER.size:
+                    return
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return
+        magic, offset, length = HEADER.unpack_from(mapping, 0)
+        if magic != MAGIC:
+            logger.warning(f'{self.path} is not a sound pack')
+            return
+        self._index = json.loads(mapping[offset:offset + length])
+        # sources that are playing keep a reference to the old mapping, it is released after them
+        self._map = mapping
+        self._stat = (stat.st_ino, stat.st_mtime_ns)
+        logger.info(f'Mapped sound pack {self.path}: {len(self._index)} sounds, {stat.st_size / 1024 / 1024:.1f} MB')
+
+    def _check(self):
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if (stat.st_ino, stat.st_mtime_ns) != self._stat:
+            self._open()
+
+    def entries(self):
+        with self._lock:
+            self._check()
+            return dict(self._index)
+
+    def get(self, audio_file, pcm=False):
+        '''
+        Returns PackEntry of the file if it is in the pack and didn't change since, otherwise None.
+        With pcm=True the entry plays decoded PCM even for Opus files.
+        '''
+        path = os.path.normpath(audio_file)
+        with self._lock:
+            self._check()
+            item = self._index.get(path)
+            mapping = self._map
+        if item is None:
+            return None
+        if self.catalog is not None:
+            # lookups run on the event loop, the catalog already knows the files
+            entry = self.catalog.get(*os.path.split(path))
+            if entry is None:
+                return None
+            current = (entry.mtime, entry.size)
+        else:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                return None
+            current = (stat.st_mtime_ns, stat.st_size)
+        if current != (item['mtime'], item['size']):
+            self.stale += 1
+            return None
+        self.hits += 1
+        if item.get('opus') and not pcm:
+            return PackEntry(mapping, item['duration'], opus=item['opus'])
+        return PackEntry(mapping, item['duration'], pcm=item['pcm'])
+
+    def stats(self):
+        return {'sounds': len(self._index), 'bytes': len(self._map) if self._map is not None else 0, 'hits': self.hits, 'stale': self.stale}
+
+
+def write_pack(path, files, previous=None):
+    '''
+    Writes a pack of the files ({path: (mtime ns, size)}). Sounds that are unchanged in the previous pack
+    (a SoundPack) are copied from it, the others are decoded. Returns number of decoded sounds.
+    '''
+    old = previous.entries() if previous is not None else {}
+    old_map = previous._map if previous is not None else None
+    index = {}
+    decoded = 0
+    temp = f'{path}.tmp'
+    with open(temp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, 0, 0))
+
+        def blob(data):
+            padding = -f.tell() % ALIGN
+            f.write(b'\0' * padding)
+            offset = f.tell()
+            f.write(data)
+            return offset
+
+        for audio_file, (mtime, size) in sorted(files.items()):
+            item = old.get(audio_file)
+            if item is not None and old_map is not None and (item['mtime'], item['size']) == (mtime, size):
+                offset, length = item['pcm']
+                entry = {'mtime': mtime, 'size': size, 'duration': item['duration'], 'pcm': [blob(old_map[offset:offset + length]), length]}
+                if item.get('opus'):
+                    table, count, data = item['opus']
+                    offsets = memoryview(old_map)[table:table + (count + 1) * 4].cast('I')
+                    packets_length = offsets[-1]
+                    offsets.release()
+                    entry['opus'] = [blob(old_map[table:table + (count + 1) * 4]), count, blob(old_map[data:data + packets_length])]
+                index[audio_file] = entry
+                continue
+            try:
+                pcm = decode_pcm(audio_file, kind=governor.TRANSCODE)
+                packets = read_opus_packets(audio_file) if audio_file.lower().endswith('.opus') else None
+            except Exception as e:
+                logger.warning(f'Sound pack: could not decode {audio_file}: {e}')
+                continue
+            decoded += 1
+            entry = {'mtime': mtime, 'size': size, 'duration': len(pcm) / BYTES_PER_SECOND, 'pcm': [blob(pcm), len(pcm)]}
+            if packets:
+                offsets = array.array('I', [0])
+                for packet in packets:
+                    offsets.append(offsets[-1] + len(packet))
+                entry['opus'] = [blob(offsets.tobytes()), len(packets), blob(b''.join(packets))]
+                entry['duration'] = len(packets) * FRAME_DURATION
+            index[audio_file] = entry
+
+        data = json.dumps(index).encode('utf-8')
+        offset = blob(data)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, offset, len(data)))
+    os.replace(temp, path)
+    return decoded
+
+
+class PackBuilder:
+    '''
+    Keeps the pack in line with the catalog, in a background thread of the process that owns the catalog.
+    The pack is rewritten `delay` seconds after schedule() was called (changes from the webserver), and
+    checked every `interval` seconds for changes made to the folders by hand.
+    '''
+    def __init__(self, path, catalog, folders, interval=10.0, delay=1.0):
+        self.path = path
+        self.catalog = catalog
+        self.folders = folders
+        self.interval = interval
+        self.delay = delay
+        self.pack = SoundPack(path, check_interval=0)
+        self.builds = 0
+        self._built = None # files of the current pack
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='sound-pack', daemon=True)
+            self._thread.start()
+        return self
+
+    def schedule(self, *files):
+        self._wake.set()
+
+    def files(self):
+        self.catalog.refresh(force=True)
+        return {entry.path: (entry.mtime, entry.size) for folder in self.folders for entry in self.catalog.entries(folder)}
+
+    def build(self):
+        '''
+        Rewrites the pack if sounds changed since it was written. Returns True if it was rewritten.
+        '''
+        files = self.files()
+        if self._built is None:
+            # pack from the previous run is reused if it is still up to date
+            current = {path: (item['mtime'], item['size']) for path, item in self.pack.entries().items()}
+            if current == files:
+                self._built = files
+        if files == self._built:
+            return False
+        start = time.perf_counter()
+        decoded = write_pack(self.path, files, self.pack)
+        self._built = files
+        self.builds += 1
+        logger.info(f'Sound pack written: {len(files)} sounds ({decoded} decoded) in {time.perf_counter() - start:.1f} s')
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                self.build()
+            except Exception as e:
+                logger.error(f'Could not write sound pack {self.path}: {e!r}')
+            if self._wake.wait(self.interval):
+                self._wake.clear()
+                # more changes usually follow (conversion writes several files)
+                time.sleep(self.delay)
@@ -0,0 +1,271 @@
+'''
+Persistent soundboard messages.
+
+`!playsound` posts one message with a page of sound buttons, a page select menu and prev/stop/next buttons,
+instead of a message for every 25 sounds. Everything a button needs is in its custom_id (`heyhey:sound:<name>`,
+`heyhey:page:<n>:...`), the item classes are registered once with the client as dynamic items, so buttons of
+boards posted before a restart keep working. Turning a page edits the board in place.
+Posted boards are remembered in a JSON file and edited when sounds are added or removed.
+'''
+import os
+import json
+import asyncio
+import logging
+
+import discord
+
+logger = logging.getLogger('HeyHeyBot')
+
+PREFIX = 'heyhey'
+PAGE_SIZE = 15 # 3 rows of 5 buttons, the other two rows are the page select and navigation
+MAX_OPTIONS = 25 # Discord limit for select menu options
+MAX_CUSTOM_ID = 100
+MAX_LABEL = 80
+
+
+def board_of(interaction):
+    return interaction.client.soundboard
+
+
+class SoundButton(discord.ui.DynamicItem[discord.ui.Button], template=PREFIX + r':sound:(?P<name>.+)'):
+    def __init__(self, name):
+        super().__init__(discord.ui.Button(
+            label=name[:MAX_LABEL],
+            custom_id=f'{PREFIX}:sound:{name}'[:MAX_CUSTOM_ID],
+            style=discord.ButtonStyle.secondary
+        ))
+        self.name = name
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match['name'])
+
+    async def callback(self, interaction):
+        board = board_of(interaction)
+        await board.play(interaction, board.resolve(self.name))
+
+
+class PageButton(discord.ui.DynamicItem[discord.ui.Button], template=PREFIX + r':page:(?P<page>\d+):(?P<label>\w+)'):
+    '''
+    Previous/next page, the target page is in custom_id (label only keeps custom_ids of both buttons different).
+    '''
+    def __init__(self, page, label, disabled=False):
+        super().__init__(discord.ui.Button(
+            label='◀' if label == 'prev' else '▶',
+            custom_id=f'{PREFIX}:page:{page}:{label}',
+            style=discord.ButtonStyle.primary,
+            disabled=disabled
+        ))
+        self.page = page
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(int(match['page']), match['label'])
+
+    async def callback(self, interaction):
+        await board_of(interaction).show(interaction, self.page)
+
+
+class PageSelect(discord.ui.DynamicItem[discord.ui.Select], template=PREFIX + r':pages'):
+    def __init__(self, options=()):
+        super().__init__(discord.ui.Select(custom_id=f'{PREFIX}:pages', placeholder='Go to page', options=list(options)))
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls()
+
+    async def callback(self, interaction):
+        values = interaction.data.get('values') or ['0']
+        await board_of(interaction).show(interaction, int(values[0]))
+
+
+class StopButton(discord.ui.DynamicItem[discord.ui.Button], template=PREFIX + r':stop'):
+    def __init__(self):
+        super().__init__(discord.ui.Button(label='⏹️ Stop', custom_id=f'{PREFIX}:stop', style=discord.ButtonStyle.danger))
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls()
+
+    async def callback(self, interaction):
+        await board_of(interaction).stop(interaction)
+
+
+class Soundboard:
+    '''
+    names - returns sorted names of sounds (catalog.names of the audio folder)
+    path - JSON file with posted boards {message id: [channel id, page]}
+    delay - seconds to wait after a change before boards are edited, changes in between are edited at once
+    max_boards - number of last posted boards that are kept up to date (older ones still work, but are not edited)
+    '''
+    def __init__(self, names, path='./data/soundboards.json', delay=2.0, max_boards=25):
+        self.names = names
+        self.play = None
+        self.stop = None
+        self.path = path
+        self.delay = delay
+        self.max_boards = max_boards
+        self.client = None
+        self.boards = {} # {message id: (channel id, page)}, in posting order
+        self.rendered = {} # {message id: components last sent}, boards that didn't change are not edited
+        self.refresh_task = None
+        self.load()
+
+    def setup(self, client, play, stop):
+        '''
+        Registers the board items with the client, must be called once before the bot connects.
+        play(interaction, name) - coroutine that plays the sound for the user and responds to the interaction
+        stop(interaction) - coroutine that stops playback in the guild and responds
+        '''
+        self.client = client
+        self.play = play
+        self.stop = stop
+        client.soundboard = self
+        client.add_dynamic_items(SoundButton, PageButton, PageSelect, StopButton)
+
+    @staticmethod
+    def is_board_item(custom_id):
+        return custom_id.startswith(PREFIX + ':')
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.boards = {int(message_id): tuple(board) for message_id, board in json.load(f).items()}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f'Could not load soundboards from {self.path}: {e}')
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            temp = self.path + '.tmp'
+            with open(temp, 'w', encoding='utf-8') as f:
+                json.dump({str(message_id): list(board) for message_id, board in self.boards.items()}, f)
+            os.replace(temp, self.path)
+        except OSError as e:
+            logger.warning(f'Could not save soundboards to {self.path}: {e}')
+
+    def remember(self, message_id, channel_id, page):
+        self.boards.pop(message_id, None)
+        self.boards[message_id] = (channel_id, page)
+        while len(self.boards) > self.max_boards:
+            forgotten = next(iter(self.boards))
+            del self.boards[forgotten]
+            self.rendered.pop(forgotten, None)
+        self.save()
+
+    def pages(self, names=None):
+        names = list(self.names()) if names is None else names
+        return [names[i:i + PAGE_SIZE] for i in range(0, len(names), PAGE_SIZE)] or [[]]
+
+    def resolve(self, name):
+        '''
+        Sound name from a custom_id, names too long for custom_id are matched by prefix.
+        '''
+        if len(f'{PREFIX}:sound:{name}') < MAX_CUSTOM_ID:
+            return name
+        names = self.names()
+        if name in names:
+            return name
+        return next((candidate for candidate in names if candidate.startswith(name)), name)
+
+    def view(self, page, pages=None):
+        '''
+        Board view for the page (clamped to existing pages).
+        '''
+        pages = self.pages() if pages is None else pages
+        page = min(max(page, 0), len(pages) - 1)
+        view = discord.ui.View(timeout=None)
+        custom_ids = set()
+        for name in pages[page]:
+            button = SoundButton(name)
+            if button.item.custom_id in custom_ids:
+                continue # names that differ only after custom_id length limit
+            custom_ids.add(button.item.custom_id)
+            view.add_item(button)
+        if len(pages) > 1:
+            # select shows a window of pages around the current one
+            first = min(max(page - MAX_OPTIONS // 2, 0), max(len(pages) - MAX_OPTIONS, 0))
+            options = [
+                discord.SelectOption(
+                    label=f'{names[0]} – {names[-1]}'[:100],
+                    description=f'Page {number + 1} of {len(pages)}',
+                    value=str(number),
+                    default=number == page
+                )
+                for number, names in enumerate(pages[first:first + MAX_OPTIONS], start=first)
+            ]
+            select = PageSelect(options)
+            select.item.row = 3
+            view.add_item(select)
+        last = len(pages) - 1
+        for item in (PageButton(max(page - 1, 0), 'prev', disabled=page == 0), StopButton(),
+                     PageButton(min(page + 1, last), 'next', disabled=page == last)):
+            item.item.row = 4
+            view.add_item(item)
+        return view
+
+    async def post(self, channel):
+        '''
+        Posts a new board to the channel (one message).
+        '''
+        view = self.view(0)
+        message = await channel.send('', view=view)
+        self.remember(message.id, channel.id, 0)
+        self.rendered[message.id] = view.to_components()
+        return message
+
+    async def show(self, interaction, page):
+        '''
+        Turns the board the interaction came from to the page.
+        '''
+        pages = self.pages()
+        page = min(max(page, 0), len(pages) - 1)
+        view = self.view(page, pages)
+        await interaction.response.edit_message(view=view)
+        if interaction.message is not None:
+            self.remember(interaction.message.id, interaction.channel_id, page)
+            self.rendered[interaction.message.id] = view.to_components()
+
+    def notify(self, *paths):
+        '''
+        Thread safe: schedules editing of the boards after sounds in the audio folder changed.
+        '''
+        client = self.client
+        if client is None or not client.is_ready():
+            return
+        client.loop.call_soon_threadsafe(self.changed)
+
+    def changed(self):
+        # boards are edited once after a burst of changes (e.g. several uploads)
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.create_task(self.refresh(self.delay))
+
+    async def refresh(self, delay=0):
+        '''
+        Edits remembered boards whose buttons changed, boards that were deleted are forgotten.
+        '''
+        if delay:
+            await asyncio.sleep(delay)
+        pages = self.pages()
+        edited = 0
+        for message_id, (channel_id, page) in list(self.boards.items()):
+            view = self.view(page, pages)
+            components = view.to_components()
+            if self.rendered.get(message_id) == components:
+                continue
+            message = self.client.get_partial_messageable(channel_id).get_partial_message(message_id)
+            try:
+                await message.edit(view=view)
+            except discord.NotFound:
+                self.boards.pop(message_id, None)
+                self.rendered.pop(message_id, None)
+                continue
+            except discord.HTTPException as e:
+                logger.warning(f'Could not update soundboard {message_id}: {e}')
+                continue
+            self.rendered[message_id] = components
+            edited += 1
+        self.save()
+        logger.debug(f'Soundboards updated: {edited} of {len(self.boards)}')
@@ -0,0 +1,151 @@
+'''
+Voice connection manager for the bot.
+
+A voice connection is expensive to set up (gateway handshake, UDP discovery, encryption),
+so instead of connecting for every announcement the bot keeps one connection per guild,
+moves it between channels and disconnects only after it was idle for a while.
+'''
+import time
+import asyncio
+import logging
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger('HeyHeyBot')
+
+CONNECT_SECONDS = metrics.histogram('heyhey_voice_connect_seconds', 'Time to connect or move the voice connection', ('action',))
+CONNECT_FAILURES = metrics.counter('heyhey_voice_connect_failures_total', 'Failed voice connects and moves', ('action',))
+
+
+class LatencyStats:
+    '''
+    Keeps last samples of an operation duration.
+    '''
+    def __init__(self, size=100):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.failures = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def summary(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return {'count': self.count, 'failures': self.failures}
+        return {
+            'count': self.count,
+            'failures': self.failures,
+            'avg_ms': round(sum(samples) / len(samples) * 1000, 1),
+            'p50_ms': round(samples[len(samples) // 2] * 1000, 1),
+            'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 1),
+            'max_ms': round(samples[-1] * 1000, 1)
+        }
+
+
+class VoiceManager:
+    '''
+    Keeps voice connections warm between announcements.
+
+    idle_timeout - seconds to stay connected after the last sound (0 disconnects right away)
+    stay_with_users - stay connected while there are other users in the channel (DISCORD_CONTINUE_PRESENCE)
+    '''
+    def __init__(self, idle_timeout=30, stay_with_users=False):
+        self.idle_timeout = idle_timeout
+        self.stay_with_users = stay_with_users
+        self.connects = LatencyStats()
+        self.moves = LatencyStats()
+        self._locks = {} # {guild_id: asyncio.Lock}
+        self._timers = {} # {guild_id: asyncio.Task}
+
+    def _lock(self, guild):
+        return self._locks.setdefault(guild.id, asyncio.Lock())
+
+    def _cancel_timer(self, guild):
+        timer = self._timers.pop(guild.id, None)
+        if timer is not None:
+            timer.cancel()
+
+    async def connect(self, channel):
+        '''
+        Returns a voice client connected to the channel, reusing the guild's connection if there is one.
+        '''
+        guild = channel.guild
+        self._cancel_timer(guild)
+        async with self._lock(guild):
+            voice_client = guild.voice_client
+            if voice_client is not None and voice_client.is_connected():
+                if voice_client.channel == channel:
+                    return voice_client
+                stats, action = self.moves, 'Moved'
+            else:
+                stats, action = self.connects, 'Connected'
+            start = time.perf_counter()
+            try:
+                if action == 'Moved':
+                    await voice_client.move_to(channel)
+                else:
+                    if voice_client is not None:
+                        # stale client left after a dropped connection
+                        await voice_client.disconnect(force=True)
+                    voice_client = await channel.connect()
+            except Exception:
+                stats.failures += 1
+                CONNECT_FAILURES.inc(action=action.lower())
+                raise
+            elapsed = time.perf_counter() - start
+            stats.add(elapsed)
+            CONNECT_SECONDS.observe(elapsed, action=action.lower())
+            logger.info(f'{action} to {channel.name} in {elapsed * 1000:.0f} ms')
+            logger.debug(f'Voice connection stats: {self.stats()}')
+            return voice_client
+
+    def has_users(self, guild):
+        voice_client = guild.voice_client
+        if voice_client is None:
+            return False
+        return any(not member.bot for member in voice_client.channel.members)
+
+    async def release(self, guild):
+        '''
+        Called when guild has nothing more to play. Schedules disconnect after the idle timeout.
+        '''
+        if guild.voice_client is None:
+            return
+        if self.stay_with_users and self.has_users(guild):
+            # stay in the channel, release is called again after the next sound
+            return
+        self._cancel_timer(guild)
+        if self.idle_timeout <= 0:
+            await self.disconnect(guild)
+        else:
+            self._timers[guild.id] = asyncio.create_task(self._disconnect_later(guild))
+
+    async def _disconnect_later(self, guild):
+        await asyncio.sleep(self.idle_timeout)
+        # from here on connect() must not cancel us in the middle of disconnecting, it waits for the lock instead
+        self._timers.pop(guild.id, None)
+        if self.stay_with_users and self.has_users(guild):
+            return
+        logger.info(f'Voice connection in {guild.name} idle for {self.idle_timeout} s, disconnecting')
+        await self.disconnect(guild)
+
+    async def disconnect(self, guild):
+        self._cancel_timer(guild)
+        async with self._lock(guild):
+            voice_client = guild.voice_client
+            if voice_client is None:
+                return
+            try:
+                await voice_client.disconnect()
+            except Exception as e:
+                logger.warning(f'Error disconnecting from voice channel: {e}')
+
+    def stats(self):
+        return {
+            'connect': self.connects.summary(),
+            'move': self.moves.summary(),
+            'idle_connections': len(self._timers)
+        }
@@ -1,78 +1,245 @@
 '''
 Small python script to normalize volume of all wav files in a given directory
+
+Run without arguments to be asked for the directory and confirmations,
+or non-interactively, e.g. `python volume_normalization.py ./data/audio --yes`.
+Files are analyzed and normalized in parallel (one process per core). Loudness is measured in-process
+(see loudness.py) and a linear gain is applied, limited so true peak stays under --max-true-peak.
+FFmpeg is only used for WAV files that are not 16-bit.
+Measured loudness is kept in a cache file in the directory (keyed by content hash and modification time),
+so files that didn't change since the last run are not analyzed again and files that are already
+at the target loudness are not normalized again.
 '''
 import os
+import sys
+import json
+import time
+import wave
+import argparse
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import governor
+from loudness import analyze_file, normalization_gain
+from ingest import write_wav_with_gain
+from catalog import file_hash
+
+CACHE_FILENAME = '.loudness.json'
+
+
+def finite(value):
+    return value if value not in (float('inf'), float('-inf')) else None
+
+
+def probe_loudness(full_path):
+    '''
+    Measures loudness with FFmpeg, for files the built-in analyzer can't read. Returns (loudness, true peak).
+    '''
+    with governor.slot(governor.TRANSCODE):
+        result = subprocess.run(
+            governor.command(governor.TRANSCODE, ['ffmpeg', '-hide_banner', '-nostats', '-i', full_path, '-af', 'loudnorm=print_format=json', '-f', 'null', '-']),
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True
+        ).stderr.decode('utf-8')
+    # loudnorm prints its stats as the last JSON object in the output
+    stats = json.loads(result[result.rindex('{'):result.rindex('}') + 1])
+    return float(stats['input_i']), float(stats['input_tp'])
+
+
+def measure_loudness(full_path):
+    '''
+    Returns (integrated loudness in LUFS or None for silence, true peak in dBTP or None, seconds spent).
+    '''
+    start = time.perf_counter()
+    try:
+        stats = analyze_file(full_path)
+        loudness, true_peak = stats['integrated'], stats['true_peak']
+    except (ValueError, wave.Error):
+        # not 16-bit PCM (24-bit, float or WAVE_FORMAT_EXTENSIBLE files)
+        loudness, true_peak = probe_loudness(full_path)
+    return finite(loudness), finite(true_peak), time.perf_counter() - start
+
+
+def normalize_file(full_path, gain):
+    '''
+    Applies gain in dB to the file, WAV to WAV. Original is replaced only if writing succeeded.
+    Returns seconds spent.
+    '''
+    start = time.perf_counter()
+    normalized_path = full_path[:-4] + '_normalized.wav'
+    try:
+        try:
+            write_wav_with_gain(full_path, normalized_path, gain)
+        except (ValueError, wave.Error):
+            with governor.slot(governor.TRANSCODE):
+                subprocess.run(
+                    governor.command(governor.TRANSCODE, ['ffmpeg', '-hide_banner', '-nostats', '-loglevel', 'error', '-i', full_path,
+                     '-af', f'volume={gain:.2f}dB', '-c:a', 'pcm_s16le', '-y', normalized_path]),
+                    check=True
+                )
+        os.replace(normalized_path, full_path)
+    finally:
+        # a half written file would be picked up as a sound
+        if os.path.exists(normalized_path):
+            os.remove(normalized_path)
+    return time.perf_counter() - start
+
+
+def load_cache(directory):
+    try:
+        with open(os.path.join(directory, CACHE_FILENAME), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(directory, cache):
+    path = os.path.join(directory, CACHE_FILENAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def cache_entry(full_path, loudness, true_peak):
+    stat = os.stat(full_path)
+    return {'mtime': stat.st_mtime, 'size': stat.st_size, 'hash': file_hash(full_path), 'loudness': loudness, 'true_peak': true_peak}
+
+
+def cached_loudness(cache, by_hash, full_path, file_name):
+    '''
+    Returns cached (loudness, true peak) (None for silence) or raises KeyError if file must be analyzed.
+    Files with unchanged mtime and size are not even read; changed mtime falls back to content hash.
+    Entries written before true peak was cached must be analyzed again.
+    '''
+    entry = cache.get(file_name)
+    stat = os.stat(full_path)
+    if entry and 'true_peak' in entry and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+        return entry['loudness'], entry['true_peak']
+    digest = file_hash(full_path)
+    if digest in by_hash:
+        loudness, true_peak = by_hash[digest]
+        cache[file_name] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'hash': digest, 'loudness': loudness, 'true_peak': true_peak}
+        return loudness, true_peak
+    raise KeyError(file_name)
+
+
+def confirm(message, interactive):
+    if interactive:
+        input(message)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Normalize volume of all wav files in a directory')
+    parser.add_argument('directory', nargs='?', help='directory with wav files (default: ./data/audio)')
+    parser.add_argument('-y', '--yes', action='store_true', help='don\'t ask for confirmations')
+    parser.add_argument('-t', '--target', type=float, help='target loudness in LUFS (default: average of all files)')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='parallel processes (default: number of cores)')
+    parser.add_argument('--max-true-peak', type=float, default=-1.0, help='gain is limited so true peak stays under this many dBTP (default: -1)')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='files within this many LU from the target are not normalized (default: 0.5)')
+    parser.add_argument('--no-cache', action='store_true', help=f'analyze all files, ignore {CACHE_FILENAME}')
+    args = parser.parse_args()
+    interactive = not args.yes
+
+    # Ask user for input directory
+    input_directory = args.directory
+    if not input_directory and interactive:
+        input_directory = input("Which directory contains your wav files? (default: ./data/audio)\n")
+    if not input_directory:
+        input_directory = './data/audio'
+
+    file_names = sorted(f for f in os.listdir(input_directory) if f.endswith('.wav') and not f.endswith('_normalized.wav'))
+    if not file_names:
+        print("\nNo files found")
+        return
+    cache = {} if args.no_cache else load_cache(input_directory)
+    by_hash = {entry['hash']: (entry['loudness'], entry['true_peak']) for entry in cache.values() if 'true_peak' in entry}
+    run_start = time.perf_counter()
+
+    # 1. Get loudness stats for all files (cached or analyzed in parallel)
+    loudness_values = {}
+    true_peaks = {}
+    to_analyze = []
+    for file_name in file_names:
+        try:
+            loudness_values[file_name], true_peaks[file_name] = cached_loudness(cache, by_hash, os.path.join(input_directory, file_name), file_name)
+        except KeyError:
+            to_analyze.append(file_name)
+    print(f" - {len(file_names) - len(to_analyze)} files unchanged since last run, analyzing {len(to_analyze)} files with {args.workers} workers")
+    analysis_start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(measure_loudness, os.path.join(input_directory, f)): f for f in to_analyze}
+        for future in as_completed(futures):
+            file_name = futures[future]
+            full_path = os.path.join(input_directory, file_name)
+            try:
+                loudness, true_peak, elapsed = future.result()
+            except Exception as e:
+                print(f" - Failed to process {full_path}: {e}")
+                continue
+            loudness_values[file_name] = loudness
+            true_peaks[file_name] = true_peak
+            cache[file_name] = cache_entry(full_path, loudness, true_peak)
+            volume = f'{loudness:.2f} LUFS' if loudness is not None else 'silent'
+            print(f" - Processed {full_path}: {volume} ({elapsed * 1000:.0f} ms)")
+    analysis_time = time.perf_counter() - analysis_start
+    if not args.no_cache:
+        save_cache(input_directory, cache)
+
+    measured = [v for v in loudness_values.values() if v is not None]
+    print(f"\nFound loudness values for {len(measured)} files\n")
+    if not measured:
+        print("\nNo files found")
+        return
+
+    # 2. Calculate average loudness
+    avg_loudness = sum(measured) / len(measured)
+    target = args.target if args.target is not None else avg_loudness
+    print(f"\nAverage loudness: {avg_loudness:.2f} LUFS, target: {target:.2f} LUFS")
+
+    # files that are already as loud as their peaks allow get (almost) no gain and are skipped
+    gains = {}
+    for f, v in loudness_values.items():
+        if v is None or abs(v - target) <= args.tolerance:
+            continue
+        tp = true_peaks[f] if true_peaks[f] is not None else float('-inf')
+        gain = normalization_gain({'integrated': v, 'true_peak': tp}, target, args.max_true_peak)
+        if abs(gain) >= 0.1:
+            gains[f] = gain
+    to_normalize = list(gains)
+    print(f"{len(to_normalize)} files differ from the target by more than {args.tolerance} LU")
+    if not to_normalize:
+        return
+    confirm(f"Press Enter to normalize volume of these files to {target:.2f} LUFS and replace originals or Ctrl+C to exit\n", interactive)
+
+    # 3. Normalize volume of files in parallel, originals are replaced by normalized files
+    normalize_start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(normalize_file, os.path.join(input_directory, f), gains[f]): f for f in to_normalize}
+        for future in as_completed(futures):
+            file_name = futures[future]
+            full_path = os.path.join(input_directory, file_name)
+            try:
+                elapsed = future.result()
+            except Exception as e:
+                print(f" - Failed to normalize {full_path}: {e}")
+                continue
+            print(f" - Normalized {full_path}: {gains[file_name]:+.2f} dB ({elapsed * 1000:.0f} ms)")
+            true_peak = true_peaks[file_name]
+            cache[file_name] = cache_entry(full_path, loudness_values[file_name] + gains[file_name],
+                                           true_peak + gains[file_name] if true_peak is not None else None)
+    normalize_time = time.perf_counter() - normalize_start
+    if not args.no_cache:
+        save_cache(input_directory, cache)
+
+    total_time = time.perf_counter() - run_start
+    print(f"\nVolume normalized to {target:.2f} LUFS, original files replaced")
+    print(f"Analyzed {len(to_analyze)} files in {analysis_time:.1f} s ({len(to_analyze) / analysis_time if analysis_time else 0:.1f} files/s), "
+          f"normalized {len(to_normalize)} files in {normalize_time:.1f} s ({len(to_normalize) / normalize_time if normalize_time else 0:.1f} files/s), "
+          f"total {total_time:.1f} s for {len(file_names)} files")
+    confirm(f"\nPress Enter to exit\n", interactive)
+
 
-# Ask user for input directory
-input_directory = input("Which directory contains your wav files? (default: ./data/audio)\n")
-if not input_directory:
-    input_directory = './data/audio'
-
-# 1. Get loudness stats for all files
-loudness_values = []
-for file_name in os.listdir(input_directory):
-    if file_name.endswith('.wav'):
-        full_path = os.path.join(input_directory, file_name)
-        print(f" - Processing {full_path}")
-        result = subprocess.check_output(
-            ['ffmpeg', '-i', full_path, '-af', 'loudnorm=print_format=json', '-f', 'null', '-'],
-            stderr=subprocess.STDOUT
-        ).decode('utf-8')
-        # print(f" - Result: {result}")
-        
-        # Get loudness value
-        for line in result.split('\n'):
-            if "input_i" in line:
-                data = line.split(':')[1].replace(',', '').replace('"', '').strip()
-                data = float(data)
-                # if inf or -inf
-                if data == float('inf') or data == float('-inf'):
-                    data = 0
-                print(f"   Volume: {data:.2f} dBFS")
-                loudness_values.append(data)
-                break
-
-print(f"\nFound loudness values for {len(loudness_values)} files\n")
-if not loudness_values:
-    print("\nNo files found")
-    exit()
-
-# 2. Calculate average loudness
-avg_loudness = sum(loudness_values) / len(loudness_values)
-
-print(f"\nAverage loudness: {avg_loudness:.2f} dBFS")
-input(f"Press Enter to normalize volume of all files to this value or Ctrl+C to exit\n")
-
-# 3. Normalize volume of all files
-for file_name in os.listdir(input_directory):
-    if file_name.endswith('.wav'):
-        full_path = os.path.join(input_directory, file_name)
-        temp_mp3_path = os.path.join(input_directory, file_name.replace('.wav', '_temp.mp3'))
-        normalized_path = os.path.join(input_directory, file_name.replace('.wav', '_normalized.wav'))
-        # Normalization
-        subprocess.call(
-            ['ffmpeg', '-i', full_path, '-af', f'loudnorm=I={avg_loudness}', '-y', temp_mp3_path]
-        )
-        # Convert back to wav (because of an issue with wav-wav conversion, i think there is some sort of bitrate issue)
-        # TODO: fix wav-wav conversion
-        subprocess.call(
-            ['ffmpeg', '-i', temp_mp3_path, '-acodec', 'pcm_s16le', '-y', normalized_path]
-        )
-        # Delete temp mp3 file
-        os.remove(temp_mp3_path)
-
-print(f"\nVolume normalized, files saved to {input_directory}")
-input(f"Press Enter to replace original files with normalized files or Ctrl+C to exit\n")
-
-# 4. Заменим файлы file_normalized.wav на исходные file.wav
-for file_name in os.listdir(input_directory):
-    if file_name.endswith('_normalized.wav'):
-        full_path = os.path.join(input_directory, file_name)
-        original_path = os.path.join(input_directory, file_name.replace('_normalized.wav', '.wav'))
-        print(f" - Replacing {original_path}")
-        os.remove(original_path)
-        os.rename(full_path, original_path)
-
-print(f"\nVolume normalized to {avg_loudness:.2f} dBFS, original files replaced")
-input(f"\nPress Enter to exit\n")
\ No newline at end of file
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.exit(1)
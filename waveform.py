@@ -0,0 +1,125 @@
+'''
+Waveform envelopes of sounds for the web page, so it can draw hundreds of sounds without downloading audio.
+
+A sound is split into equal parts at a few fixed resolutions, every part has its peak (largest absolute
+sample of all channels) and RMS, both scaled to 0-255. The file is read once in chunks: peaks and power
+of small blocks are collected first, resolutions are made of these blocks.
+
+Envelopes are stored in a small binary sidecar: magic, number of resolutions, then for every resolution
+its size (uint16) and `size` peak bytes followed by `size` RMS bytes. The webserver names sidecars after
+the content hash of the sound, so they are computed again only when the sound changes.
+'''
+import os
+import wave
+import struct
+import tempfile
+import contextlib
+
+import numpy as np
+
+import ingest
+
+RESOLUTIONS = (64, 256, 1024)
+MAGIC = b'HHBPEAK1'
+HEADER = struct.Struct('<8sH')
+SIZE = struct.Struct('<H')
+DETAIL = 4096 # blocks collected while reading, resolutions are at most this detailed
+
+
+def blocks(audio_file, detail=DETAIL):
+    '''
+    Returns peaks, summed power and sample counts of up to `detail` blocks of a 16-bit WAV file.
+    Samples are floats in -1..1, power is summed over the samples of a block (mean of channels).
+    '''
+    with contextlib.closing(wave.open(audio_file, 'rb')) as f:
+        if f.getsampwidth() != 2:
+            raise ValueError(f'{audio_file}: only 16-bit WAV files are supported')
+        channels = f.getnchannels()
+        size = max(1, -(-f.getnframes() // detail))
+        # about 10 seconds per read, whole blocks only
+        chunk = size * max(1, f.getframerate() * 10 // size)
+        peaks, power, counts = [], [], []
+        while True:
+            data = f.readframes(chunk)
+            if not data:
+                break
+            samples = np.frombuffer(data, dtype='<i2').reshape(-1, channels).astype(np.float32) / 32768
+            starts = np.arange(0, len(samples), size)
+            peaks.append(np.maximum.reduceat(np.abs(samples).max(axis=1), starts))
+            power.append(np.add.reduceat(np.square(samples).mean(axis=1), starts))
+            counts.append(np.diff(np.append(starts, len(samples))))
+    if not peaks:
+        return np.zeros(0, np.float32), np.zeros(0, np.float32), np.zeros(0, np.int64)
+    return np.concatenate(peaks), np.concatenate(power), np.concatenate(counts)
+
+
+def envelope(peaks, power, counts, resolution):
+    '''
+    Peak and RMS (uint8 arrays of `resolution` values) of blocks grouped into `resolution` parts.
+    Sounds shorter than `resolution` blocks are stretched.
+    '''
+    if not len(peaks):
+        return np.zeros(resolution, np.uint8), np.zeros(resolution, np.uint8)
+    starts = np.linspace(0, len(peaks), resolution + 1).astype(np.int64)[:-1]
+    starts = np.minimum(starts, len(peaks) - 1)
+    # reduceat returns the block itself where a part starts at the same block as the next one
+    peak = np.maximum.reduceat(peaks, starts)
+    rms = np.sqrt(np.add.reduceat(power, starts) / np.maximum(np.add.reduceat(counts, starts), 1))
+    scale = lambda values: np.clip(np.rint(values * 255), 0, 255).astype(np.uint8)
+    return scale(peak), scale(rms)
+
+
+def compute(audio_file, resolutions=RESOLUTIONS):
+    '''
+    Returns {resolution: (peak bytes, rms bytes)} of a sound. WAV files are read directly,
+    other files (Opus) are decoded to a temporary WAV with FFmpeg.
+    '''
+    try:
+        data = blocks(audio_file)
+    except (wave.Error, EOFError, ValueError):
+        with tempfile.TemporaryDirectory() as folder:
+            decoded = os.path.join(folder, 'decoded.wav')
+            if not ingest.decode_to_wav(audio_file, decoded):
+                raise ValueError(f'Could not decode {audio_file}')
+            data = blocks(decoded)
+    envelopes = {}
+    for resolution in resolutions:
+        peak, rms = envelope(*data, resolution)
+        envelopes[resolution] = (peak.tobytes(), rms.tobytes())
+    return envelopes
+
+
+def write(path, envelopes):
+    '''
+    Writes envelopes to a sidecar file, replacing it atomically.
+    '''
+    temp = f'{path}.part'
+    with open(temp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(envelopes)))
+        for resolution, (peak, rms) in sorted(envelopes.items()):
+            f.write(SIZE.pack(resolution) + peak + rms)
+    os.replace(temp, path)
+
+
+def read(path):
+    '''
+    Reads envelopes of a sidecar file: {resolution: (peak bytes, rms bytes)}.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        magic, count = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a waveform file')
+        envelopes = {}
+        offset = HEADER.size
+        for _ in range(count):
+            (resolution,) = SIZE.unpack_from(data, offset)
+            offset += SIZE.size
+            envelopes[resolution] = (data[offset:offset + resolution], data[offset + resolution:offset + 2 * resolution])
+            offset += 2 * resolution
+    except struct.error:
+        raise ValueError(f'{path} is truncated')
+    if offset > len(data):
+        raise ValueError(f'{path} is truncated')
+    return envelopes
@@ -1,34 +1,99 @@
 '''
 Flask webserver for uploading and deleting audio files.
 User can upload audio files to the server and delete them. Auth is required.
-Uploaded audio files are converted to .wav format and saved to the data/audio folder.
+Uploaded audio files are converted to .wav format (or Ogg Opus with AUDIO_FORMAT=opus) and saved to the data/audio folder.
+With WEBPAGE_SERVER=production the app is served by Cheroot, a multi-threaded WSGI server, instead of Flask's development server.
+Many sounds can be imported at once from a zip or tar archive, progress is streamed with Server-Sent Events.
 '''
 
-from flask import Flask, request, Response, render_template, redirect, url_for, session, send_from_directory, jsonify
+from flask import Flask, Request, request, Response, render_template, redirect, url_for, session, send_file, jsonify, current_app
 from werkzeug.utils import secure_filename
 import os
-import subprocess
+import json
+import base64
+import time
+import hmac
 import secrets
-import glob
 import shutil
-from pydub import AudioSegment
-from pydub.playback import play
+import tarfile
+import zipfile
+import tempfile
+import threading
+from collections import OrderedDict
+from sound_files import AUDIO_EXTENSIONS
+from jobs import JobQueue, Batch
+from catalog import SoundCatalog
+from blob_store import BlobStore
+import ingest
+import metrics
+import governor
+import waveform
 
 from dotenv import load_dotenv
 load_dotenv()
 
+AUDIO_MIMETYPES = {'.wav': 'audio/wav', '.opus': 'audio/ogg'}
+PREVIEW_FOLDER = '.previews' # in every sound folder, hidden from file lists
+PREVIEW_EXTENSIONS = ('.webm', '.peaks') # audio preview and waveform envelopes
+BACKFILL_JOBS = 4 # previews and waveforms of sounds added without upload made at a time
+
+REQUEST_SECONDS = metrics.histogram('heyhey_http_request_seconds', 'Time to handle a web request', ('endpoint', 'method'))
+CONVERT_SECONDS = metrics.histogram('heyhey_convert_seconds', 'Time to convert an uploaded sound', ('result',))
+
+
+class StreamingRequest(Request):
+    '''
+    Request that writes uploaded files straight to the disk while the body is parsed, chunk by chunk,
+    instead of keeping them in memory (or a temporary file) and copying them with file.save() afterwards.
+    Files are staged in app.config['UPLOAD_STAGING_FOLDER'], WebApp.save_upload() moves them into place
+    and whatever is left when the request ends is removed.
+    '''
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = tempfile.NamedTemporaryFile('wb+', dir=current_app.config['UPLOAD_STAGING_FOLDER'], suffix='.part', delete=False)
+        if not hasattr(self, 'staged_files'):
+            self.staged_files = []
+        self.staged_files.append(stream)
+        return stream
+
+    @property
+    def max_content_length(self):
+        # archives for bulk import can be larger than single uploads
+        if self.endpoint == 'import_archive':
+            return current_app.config['MAX_IMPORT_LENGTH']
+        return current_app.config['MAX_CONTENT_LENGTH']
+
+
 class WebApp:
-    def __init__(self):
+    def __init__(self, on_change=None, catalog=None):
         self.credentials = {
             'username': os.getenv('WEBPAGE_USERNAME'),
             'password': os.getenv('WEBPAGE_PASSWORD')
         }
-        self.allowed_extentions = {'mp3', 'wav'}
+        self.allowed_extentions = {'mp3', 'wav', 'ogg', 'opus'}
+        # format sounds are stored in: 'wav' (48 kHz PCM) or 'opus' (Ogg Opus, played by the bot without re-encoding)
+        self.audio_format = os.getenv('AUDIO_FORMAT', 'wav').lower()
+        if self.audio_format not in ('wav', 'opus'):
+            self.audio_format = 'wav'
+        # silence under this level (dBFS) is cut from the start and the end of uploads, 'off' keeps it
+        trim = os.getenv('AUDIO_TRIM_SILENCE_DB', '-50')
+        try:
+            self.trim_db = float(trim)
+        except ValueError:
+            self.trim_db = None
         self.upload_folder = os.getenv('UPLOAD_FOLDER') if os.getenv('UPLOAD_FOLDER') else './data/audio'
         self.greetings_folder = './data/greetings'
         self.host = os.getenv('WEBPAGE_HOST') if os.getenv('WEBPAGE_HOST') else 'localhost'
         self.port = int(os.getenv('WEBPAGE_PORT')) if os.getenv('WEBPAGE_PORT') else 5100
+        # 'production' (Cheroot, WEBPAGE_THREADS requests handled at a time) or 'development' (Flask)
+        self.server = os.getenv('WEBPAGE_SERVER', 'development').lower()
+        self.threads = int(os.getenv('WEBPAGE_THREADS', 8))
         self.ssl_context = None
+        # called with paths of files that were replaced or removed, so the bot can drop cached audio
+        self.on_change = on_change
+        # index of sound files, shared with the bot when started from app.py
+        self.catalog = catalog if catalog is not None else SoundCatalog(os.getenv('SOUND_CATALOG', './data/catalog.json'))
+        # sounds are stored once, files in the folders are links to them
+        self.store = BlobStore(os.getenv('BLOB_STORE', './data/blobs'))
         
         # Setup SSL if certificates are provided
         cert_path = os.getenv('SSL_CERT')
@@ -37,8 +102,15 @@ class WebApp:
             self.ssl_context = (cert_path, key_path)
 
         self.app = Flask(__name__)
+        self.app.request_class = StreamingRequest
         self.app.config['UPLOAD_FOLDER'] = self.upload_folder
-        self.app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 # 16 MB
+        # uploads are streamed to the disk, so the limit doesn't need to fit in memory
+        self.app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('WEBPAGE_MAX_UPLOAD_MB', 16)) * 1024 * 1024
+        self.app.config['MAX_IMPORT_LENGTH'] = int(os.getenv('WEBPAGE_MAX_IMPORT_MB', 512)) * 1024 * 1024
+        # staging folder is next to the sounds, so moving a finished upload is a rename
+        # (it is hidden and has no audio files, so the bot doesn't see it)
+        self.app.config['UPLOAD_STAGING_FOLDER'] = os.path.join(self.upload_folder, '.incoming')
+        self.app.teardown_request(self.remove_staged_files)
 
         self.app.add_url_rule('/', 'index', self.index, methods=['GET', 'POST'])
         self.app.add_url_rule('/upload', 'upload', self.upload, methods=['GET', 'POST'])
@@ -50,6 +122,18 @@ class WebApp:
         self.app.add_url_rule('/logout', 'logout', self.logout, methods=['GET', 'POST'])
         self.app.add_url_rule('/play', 'play_audio', self.play_audio, methods=['GET'])
         self.app.add_url_rule('/get_greetings', 'get_greetings', self.get_greetings, methods=['GET'])
+        self.app.add_url_rule('/jobs/<job_id>', 'job_status', self.job_status, methods=['GET'])
+        self.app.add_url_rule('/api/sounds', 'api_sounds', self.api_sounds, methods=['GET'])
+        self.app.add_url_rule('/api/greetings', 'api_greetings', self.api_greetings, methods=['GET'])
+        self.app.add_url_rule('/api/waveforms', 'api_waveforms', self.api_waveforms, methods=['GET'])
+        self.app.add_url_rule('/metrics', 'metrics', self.metrics, methods=['GET'])
+        self.app.add_url_rule('/import', 'import_archive', self.import_archive, methods=['POST'])
+        self.app.add_url_rule('/import/<batch_id>', 'import_status', self.import_status, methods=['GET'])
+        self.app.add_url_rule('/import/<batch_id>/events', 'import_events', self.import_events, methods=['GET'])
+        # /metrics is scraped with this token (Authorization: Bearer <token>), logged in users can open it too
+        self.metrics_token = os.getenv('WEBPAGE_METRICS_TOKEN')
+        self.app.before_request(self.start_timer)
+        self.app.after_request(self.observe_request)
 
         # set secret key
         self.app.secret_key = secrets.token_hex(16)
@@ -57,14 +141,32 @@ class WebApp:
         # add template location
         self.app.template_folder = './templates'
 
+        # uploads are converted in background, WEBPAGE_CONVERT_WORKERS conversions at a time
+        self.jobs = JobQueue(workers=int(os.getenv('WEBPAGE_CONVERT_WORKERS', 2)))
+        # previews and waveforms queued and not done yet (sounds added without upload)
+        self.preview_jobs = set()
+        self.preview_lock = threading.Lock()
+        # archive imports, last 20 are kept for status requests
+        self.imports = OrderedDict()
+        self.imports_lock = threading.Lock()
+
         # Create necessary directories if they don't exist
         os.makedirs(self.upload_folder, exist_ok=True)
         os.makedirs(self.greetings_folder, exist_ok=True)
+        os.makedirs(self.app.config['UPLOAD_STAGING_FOLDER'], exist_ok=True)
+        self.catalog.load(self.upload_folder, self.greetings_folder)
 
     def run(self):
         '''
         Starts the webserver with optional SSL support.
         '''
+        if self.server == 'production':
+            try:
+                from cheroot import wsgi
+            except ImportError:
+                self.app.logger.warning('WEBPAGE_SERVER=production needs cheroot (pip install cheroot), using development server')
+            else:
+                return self.run_production(wsgi)
         self.app.run(
             host=self.host, 
             port=self.port, 
@@ -73,33 +175,74 @@ class WebApp:
             ssl_context=self.ssl_context
         )
 
+    def run_production(self, wsgi):
+        '''
+        Serves the app with Cheroot: a fixed pool of WEBPAGE_THREADS threads handles requests,
+        further connections wait until a thread is free.
+        '''
+        server = wsgi.Server(
+            (self.host, self.port),
+            self.app,
+            numthreads=self.threads,
+            max=self.threads,
+            request_queue_size=64,
+            timeout=30
+        )
+        if self.ssl_context:
+            from cheroot.ssl.builtin import BuiltinSSLAdapter
+            server.ssl_adapter = BuiltinSSLAdapter(*self.ssl_context)
+        try:
+            server.start()
+        finally:
+            server.stop()
+
+    def remove_staged_files(self, exc=None):
+        '''
+        Removes uploaded files that were not moved into place (invalid uploads, errors).
+        '''
+        for stream in getattr(request, 'staged_files', ()):
+            stream.close()
+            if os.path.exists(stream.name):
+                os.remove(stream.name)
+
+    def notify_change(self, *paths):
+        '''
+        Updates the catalog and tells the bot that files were written, replaced or removed.
+        '''
+        self.catalog.update(*paths)
+        if self.on_change is not None:
+            try:
+                self.on_change(*paths)
+            except Exception as e:
+                self.app.logger.warning(f'Change notification failed: {e}')
+
     def get_greeting_versions(self, username):
         '''
         Get all versions of greeting files for a username
         '''
-        pattern = os.path.join(self.greetings_folder, f"{username}.*.wav")
-        files = glob.glob(pattern)
-        return sorted(files, key=lambda x: int(x.split('.')[-2]) if x.split('.')[-2].isdigit() else 0)
+        return [entry.path for entry in self.catalog.versions(self.greetings_folder, username)]
 
     def get_next_version(self, username):
         '''
         Get the next version number for a user's greeting file
         '''
-        existing_versions = self.get_greeting_versions(username)
+        existing_versions = self.catalog.versions(self.greetings_folder, username)
         if not existing_versions:
             return 1
-        last_version = max([int(f.split('.')[-2]) for f in existing_versions if f.split('.')[-2].isdigit()])
-        return last_version + 1
+        return existing_versions[-1].version + 1
 
     def backup_existing_greeting(self, username):
         '''
         Backup existing greeting file with versioning
         '''
-        current_file = os.path.join(self.greetings_folder, f"{username}.wav")
-        if os.path.exists(current_file):
+        current_file = self.catalog.find(os.path.join(self.greetings_folder, username))
+        if current_file is not None:
             next_version = self.get_next_version(username)
-            backup_file = os.path.join(self.greetings_folder, f"{username}.{next_version}.wav")
+            ext = os.path.splitext(current_file)[1]
+            backup_file = os.path.join(self.greetings_folder, f"{username}.{next_version}{ext}")
             os.rename(current_file, backup_file)
+            self.catalog.duplicate(current_file, backup_file)
+            self.notify_change(current_file, backup_file)
             return True
         return False
 
@@ -118,32 +261,32 @@ class WebApp:
         version = data['version']
 
         # Source file is the versioned file
-        source_file = os.path.join(self.greetings_folder, f"{username}.{version}.wav")
-        if not os.path.exists(source_file):
+        source = self.catalog.entry(os.path.join(self.greetings_folder, f"{username}.{version}"))
+        if source is None:
             return jsonify({'error': 'Source version not found'}), 404
+        source_file = source.path
 
         # Backup current if it exists
-        current_file = os.path.join(self.greetings_folder, f"{username}.wav")
-        if os.path.exists(current_file):
-            self.backup_existing_greeting(username)
+        self.backup_existing_greeting(username)
+        current_file = os.path.join(self.greetings_folder, f"{username}{os.path.splitext(source_file)[1]}")
 
-        # Copy the versioned file as the new current
+        # Link the versioned file as the new current
         try:
-            shutil.copy2(source_file, current_file)
+            self.store.link(source_file, current_file, source.hash)
+            self.catalog.duplicate(source_file, current_file)
+            self.notify_change(current_file)
             return jsonify({'success': True, 'message': f'Version {version} set as current greeting for {username}'})
         except Exception as e:
             return jsonify({'error': f'Failed to set version as current: {str(e)}'}), 500
 
-    def filelist(self, filter=('wav'), folder=None):
+    def filelist(self, filter=AUDIO_EXTENSIONS, folder=None):
         '''
         Returns a list of all files in the specified folder, while filtering for the given file extension.
         '''
         target_folder = folder if folder else self.app.config['UPLOAD_FOLDER']
-        files = []
-        for file in os.listdir(target_folder):
-            if file.endswith(filter):
-                files.append(file)
-        files.sort()
+        files = self.catalog.files(target_folder)
+        if filter != AUDIO_EXTENSIONS:
+            files = [file for file in files if file.endswith(filter)]
         return files
 
     def get_greetings(self):
@@ -154,25 +297,20 @@ class WebApp:
             return jsonify({'error': 'Not authorized'}), 401
 
         greetings = []
-        for file in os.listdir(self.greetings_folder):
-            if file.endswith('.wav'):
-                parts = file.rsplit('.', 2)
-                if len(parts) == 2:  # Current greeting file
-                    username = parts[0]
-                    greetings.append({
-                        'username': username,
-                        'filename': file,
-                        'is_current': True
-                    })
-                elif len(parts) == 3 and parts[1].isdigit():  # Versioned backup
-                    username = parts[0]
-                    version = parts[1]
-                    greetings.append({
-                        'username': username,
-                        'filename': file,
-                        'version': version,
-                        'is_current': False
-                    })
+        for entry in self.catalog.entries(self.greetings_folder):
+            if entry.version is not None:  # Versioned backup
+                greetings.append({
+                    'username': entry.base,
+                    'filename': entry.filename,
+                    'version': str(entry.version),
+                    'is_current': False
+                })
+            else:  # Current greeting file
+                greetings.append({
+                    'username': entry.name,
+                    'filename': entry.filename,
+                    'is_current': True
+                })
 
         return jsonify(greetings)
 
@@ -183,11 +321,8 @@ class WebApp:
         if not session.get('logged_in'):
             return redirect(url_for('login'))
         else:
-            soundboard_files = self.filelist()
-            greeting_files = self.filelist(folder=self.greetings_folder)
-            return render_template('index.html', 
-                                uploaded_files=soundboard_files,
-                                greeting_files=greeting_files)
+            # file lists are loaded by the page from /api/sounds and /api/greetings
+            return render_template('index.html')
         
     def login(self):
         '''
@@ -212,39 +347,376 @@ class WebApp:
     def upload(self):
         '''
         Lets user upload audio files to the soundboard.
+        File is saved as is and converted in background, response contains id of the conversion job.
         '''
         if not session.get('logged_in'):
             return redirect(url_for('login'))
         else:
             if request.method == 'POST':
+                # checked before the file is received
+                if governor.busy(governor.TRANSCODE):
+                    return self.busy_response()
                 if 'file' not in request.files:
-                    return render_template('index.html', error='No file selected.')
+                    return self.error_response('No file selected.')
                 file = request.files['file']
                 if file.filename == '':
-                    return render_template('index.html', error='No file selected.')
+                    return self.error_response('No file selected.')
                 if file and self.allowed_file(file.filename):
-                    filename = secure_filename(file.filename)
-                    file.save(os.path.join(self.app.config['UPLOAD_FOLDER'], filename))
-                    success = self.convert(filename)
-                    if success:
-                        return render_template('index.html', 
-                                            success='File uploaded.',
-                                            uploaded_files=self.filelist(),
-                                            greeting_files=self.filelist(folder=self.greetings_folder))
-                    else:
-                        os.remove(os.path.join(self.app.config['UPLOAD_FOLDER'], filename))
-                        return render_template('index.html', 
-                                            error='Something went wrong while converting the file.',
-                                            uploaded_files=self.filelist(),
-                                            greeting_files=self.filelist(folder=self.greetings_folder))
+                    if not self.admit():
+                        return self.busy_response()
+                    try:
+                        filename = self.save_upload(file, self.app.config['UPLOAD_FOLDER'], os.path.splitext(secure_filename(file.filename))[0])
+                    except BaseException:
+                        governor.release(governor.TRANSCODE)
+                        raise
+                    job = self.jobs.submit(f'Converting {file.filename}', self.run_admitted, self.convert_upload, filename)
+                    return self.upload_response(job, 'File uploaded, converting...')
                 else:
-                    return render_template('index.html', 
-                                        error='Invalid file extension.',
-                                        uploaded_files=self.filelist(),
-                                        greeting_files=self.filelist(folder=self.greetings_folder))
+                    return self.error_response('Invalid file extension.')
             else:
                 return render_template('index.html')
 
+    def save_upload(self, file, folder, name):
+        '''
+        Saves uploaded file under a temporary name, so it doesn't show up in file lists (and isn't played)
+        before it is converted. Returns the temporary filename.
+        '''
+        filename = f'{name}.upload'
+        if file.stream in getattr(request, 'staged_files', ()):
+            # already on the disk
+            file.stream.close()
+            shutil.move(file.stream.name, os.path.join(folder, filename))
+        else:
+            file.save(os.path.join(folder, filename))
+        return filename
+
+    def convert_upload(self, filename, folder=None):
+        '''
+        Conversion job: converts uploaded file, removes it if conversion failed.
+        Job result is the sound name, its duration and seconds of silence cut from the start and the end.
+        '''
+        stats = None
+        try:
+            stats = self.convert(filename, folder=folder)
+        finally:
+            # also when conversion raised (e.g. FFmpeg is missing)
+            file_path = os.path.join(folder if folder else self.app.config['UPLOAD_FOLDER'], filename)
+            if not stats and os.path.exists(file_path):
+                os.remove(file_path)
+        if not stats:
+            raise RuntimeError('Something went wrong while converting the file.')
+        return {
+            'name': os.path.splitext(filename)[0],
+            'duration': stats.get('duration'),
+            'trim_start': stats.get('trim_start'),
+            'trim_end': stats.get('trim_end')
+        }
+
+    def admit(self):
+        '''
+        Reserves a place for a conversion, False if too many are waiting already (see governor.py).
+        '''
+        try:
+            governor.admit(governor.TRANSCODE)
+            return True
+        except governor.Busy:
+            return False
+
+    def run_admitted(self, func, *args, **kwargs):
+        '''
+        Runs admitted work (an upload or an import) and releases its place when it is done.
+        '''
+        try:
+            return func(*args, **kwargs)
+        finally:
+            governor.release(governor.TRANSCODE)
+
+    def busy_response(self):
+        '''
+        Too many conversions are waiting, the upload is rejected right away instead of queued.
+        '''
+        message = 'Server is busy converting other files, please try again in a minute.'
+        if self.wants_json():
+            response = jsonify({'error': message})
+        else:
+            response = current_app.make_response(render_template('index.html', error=message))
+        response.status_code = 429
+        response.headers['Retry-After'] = '30'
+        return response
+
+    def upload_response(self, job, message):
+        '''
+        Returns job id as JSON for scripts, or index page that waits for the job for browsers.
+        '''
+        if self.wants_json():
+            return jsonify({'job_id': job.id, 'status': job.status, 'message': message}), 202
+        return render_template('index.html', success=message, job_id=job.id)
+
+    def wants_json(self):
+        return request.accept_mimetypes.best == 'application/json'
+
+    def error_response(self, message, status=400):
+        '''
+        Returns error as JSON for scripts and the page, or index page with the error for plain form posts.
+        '''
+        if self.wants_json():
+            return jsonify({'error': message}), status
+        return render_template('index.html', error=message)
+
+    def sound_json(self, entry):
+        return {
+            'filename': entry.filename,
+            'name': entry.name,
+            'username': entry.base,
+            'version': entry.version,
+            'is_current': entry.version is None,
+            'duration': entry.duration,
+            'size': entry.size,
+            'loudness': entry.loudness,
+            'trim_start': entry.trim_start,
+            'trim_end': entry.trim_end,
+            'hash': entry.hash
+        }
+
+    def api_sounds(self):
+        '''
+        Soundboard files, see api_list().
+        '''
+        return self.api_list(self.upload_folder)
+
+    def api_greetings(self):
+        '''
+        Greeting files, current and versions, see api_list().
+        '''
+        return self.api_list(self.greetings_folder)
+
+    def api_waveforms(self):
+        '''
+        Waveform envelopes of sounds: ?folder=soundboard|greetings&resolution=256&name=<filename>&name=...
+        (up to 200 names) returns {resolution, items: {filename: {hash, peak, rms}}, pending: [filenames]}.
+        peak and rms are base64 encoded bytes, one 0-255 value per part of the sound.
+        Envelopes of sounds added without upload are computed in background, they are listed in `pending`
+        until they are ready.
+        '''
+        if not session.get('logged_in'):
+            return jsonify({'error': 'Not authorized'}), 401
+        folder = self.greetings_folder if request.args.get('folder') == 'greetings' else self.upload_folder
+        resolution = request.args.get('resolution', 256, type=int)
+        if resolution not in waveform.RESOLUTIONS:
+            return jsonify({'error': f'Resolution must be one of {", ".join(map(str, waveform.RESOLUTIONS))}'}), 400
+        names = request.args.getlist('name')[:200]
+        items, pending = {}, []
+        for name in names:
+            entry = self.catalog.get(folder, name)
+            if entry is None:
+                continue
+            if not entry.hash:
+                # found by a folder scan, the catalog reads it in background
+                pending.append(name)
+                continue
+            try:
+                peak, rms = waveform.read(self.waveform_path(entry))[resolution]
+            except (OSError, ValueError, KeyError):
+                self.queue_waveform(entry)
+                pending.append(name)
+                continue
+            items[name] = {'hash': entry.hash, 'peak': base64.b64encode(peak).decode('ascii'), 'rms': base64.b64encode(rms).decode('ascii')}
+        return jsonify({'resolution': resolution, 'items': items, 'pending': pending})
+
+    def api_list(self, folder):
+        '''
+        Page of files sorted by filename: ?offset=0&limit=100&q=<substring>
+        returns {cursor, total, offset, items}.
+        With ?since=<cursor> returns only files changed after it: {cursor, changes: [{filename, item or null if deleted}]},
+        or {cursor, reset: true} if the cursor is too old and the list has to be loaded again.
+        '''
+        if not session.get('logged_in'):
+            return jsonify({'error': 'Not authorized'}), 401
+        since = request.args.get('since')
+        if since is not None:
+            cursor, changes = self.catalog.changes(folder, since)
+            if changes is None:
+                return jsonify({'cursor': cursor, 'reset': True})
+            return jsonify({
+                'cursor': cursor,
+                'changes': [{'filename': filename, 'item': self.sound_json(entry) if entry else None}
+                            for filename, entry in changes.items()]
+            })
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+        cursor, total, entries = self.catalog.page(folder, offset, limit, request.args.get('q'))
+        return jsonify({
+            'cursor': cursor,
+            'total': total,
+            'offset': offset,
+            'items': [self.sound_json(entry) for entry in entries]
+        })
+
+    def start_timer(self):
+        request.started = time.perf_counter()
+
+    def observe_request(self, response):
+        # unknown URLs have no endpoint, they are counted together
+        REQUEST_SECONDS.observe(time.perf_counter() - request.started, endpoint=request.endpoint or 'none', method=request.method)
+        return response
+
+    def metrics(self):
+        '''
+        Metrics of the bot and the webserver in Prometheus text format.
+        '''
+        authorization = request.headers.get('Authorization', '')
+        token_valid = bool(self.metrics_token) and hmac.compare_digest(authorization, f'Bearer {self.metrics_token}')
+        if not token_valid and not session.get('logged_in'):
+            return Response('Not authorized\n', status=401, mimetype='text/plain')
+        return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+    def job_status(self, job_id):
+        '''
+        Returns status of a background job.
+        '''
+        if not session.get('logged_in'):
+            return jsonify({'error': 'Not authorized'}), 401
+        job = self.jobs.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(job.to_dict())
+
+    def import_archive(self):
+        '''
+        Imports all sounds of a zip or tar archive: to the soundboard, or with target=greetings as greetings
+        of Discord users named like the files. Entries are extracted one by one while earlier ones are converted
+        on the job queue. Returns id of the import, its progress is streamed from /import/<id>/events.
+        '''
+        if not session.get('logged_in'):
+            return self.error_response('Not authorized', 401)
+        if governor.busy(governor.TRANSCODE):
+            return self.busy_response()
+        file = request.files.get('archive')
+        if file is None or file.filename == '':
+            return self.error_response('No file selected.')
+        if not file.filename.lower().endswith(ingest.ARCHIVE_EXTENSIONS):
+            return self.error_response('Archive must be a zip or tar file.')
+        folder = self.greetings_folder if request.form.get('target') == 'greetings' else self.app.config['UPLOAD_FOLDER']
+        batch = Batch(f'Importing {file.filename}')
+        # archive stays in the staging folder until all entries are extracted
+        staging = self.app.config['UPLOAD_STAGING_FOLDER']
+        archive_path = os.path.join(staging, self.save_upload(file, staging, f'import-{batch.id}'))
+        # the whole import takes one place, its entries are throttled by extraction
+        if not self.admit():
+            os.remove(archive_path)
+            return self.busy_response()
+        with self.imports_lock:
+            self.imports[batch.id] = batch
+            while len(self.imports) > 20:
+                self.imports.popitem(last=False)
+        threading.Thread(target=self.run_admitted, args=(self.extract_archive, batch, archive_path, folder), name=f'import-{batch.id}', daemon=True).start()
+        message = f'Importing {file.filename}...'
+        if self.wants_json():
+            return jsonify({'import_id': batch.id, 'status': batch.status, 'message': message,
+                            'events': url_for('import_events', batch_id=batch.id)}), 202
+        return render_template('index.html', success=message)
+
+    def extract_archive(self, batch, archive_path, folder):
+        '''
+        Extracts archive entries one at a time and queues their conversion. At most two entries per
+        conversion worker wait on the disk, extraction waits for conversions to catch up.
+        A failed entry is reported and skipped, only an unreadable archive fails the whole import.
+        '''
+        waiting = threading.BoundedSemaphore(self.jobs.workers * 2)
+        names = set()
+        error = None
+        try:
+            for name, size, stream in ingest.iter_archive(archive_path):
+                filename = os.path.basename(name)
+                # folders and resource forks added by macOS
+                if filename.startswith('.') or name.startswith('__MACOSX/'):
+                    continue
+                sound = os.path.splitext(secure_filename(filename))[0]
+                if not self.allowed_file(filename) or not sound:
+                    batch.update(name, 'failed', error='Invalid file extension.')
+                    continue
+                if sound in names:
+                    batch.update(name, 'failed', error=f'Another file in the archive is named {sound}.')
+                    continue
+                if size > self.app.config['MAX_CONTENT_LENGTH']:
+                    batch.update(name, 'failed', error='File is too large.')
+                    continue
+                names.add(sound)
+                waiting.acquire()
+                batch.update(name, 'queued')
+                try:
+                    if folder == self.greetings_folder:
+                        self.backup_existing_greeting(sound)
+                    with open(os.path.join(folder, f'{sound}.upload'), 'wb') as f:
+                        shutil.copyfileobj(stream, f, 1024 * 1024)
+                except (OSError, zipfile.BadZipFile, tarfile.TarError, EOFError) as e:
+                    waiting.release()
+                    batch.update(name, 'failed', error=f'Could not extract the file: {e}')
+                    continue
+                self.jobs.submit(f'Importing {name}', self.import_entry, batch, name, f'{sound}.upload', folder, waiting)
+        except (OSError, zipfile.BadZipFile, tarfile.TarError, EOFError) as e:
+            error = f'Could not read the archive: {e}'
+        finally:
+            if os.path.exists(archive_path):
+                os.remove(archive_path)
+            batch.finish(error)
+
+    def import_entry(self, batch, name, filename, folder, waiting):
+        '''
+        Conversion job of an archive entry, the result is reported to the batch.
+        '''
+        waiting.release()
+        batch.update(name, 'converting')
+        try:
+            batch.update(name, 'done', result=self.convert_upload(filename, folder))
+        except Exception as e:
+            batch.update(name, 'failed', error=str(e))
+
+    def import_status(self, batch_id):
+        '''
+        Returns progress of an archive import with the entries that failed.
+        '''
+        if not session.get('logged_in'):
+            return jsonify({'error': 'Not authorized'}), 401
+        batch = self.imports.get(batch_id)
+        if batch is None:
+            return jsonify({'error': 'Import not found'}), 404
+        return jsonify(batch.to_dict())
+
+    def import_events(self, batch_id):
+        '''
+        Streams progress of an archive import as Server-Sent Events, one event per entry status change.
+        A stream is closed after a minute (or when the import is done), so it doesn't hold a server thread:
+        EventSource reconnects with Last-Event-ID and gets the events it missed.
+        '''
+        if not session.get('logged_in'):
+            return jsonify({'error': 'Not authorized'}), 401
+        batch = self.imports.get(batch_id)
+        if batch is None:
+            return jsonify({'error': 'Import not found'}), 404
+        position = request.headers.get('Last-Event-ID', request.args.get('after', 0), type=int)
+        if batch.status != 'running' and position >= len(batch.events):
+            # nothing more will happen, 204 tells EventSource not to reconnect
+            return Response(status=204)
+
+        def stream(position):
+            yield 'retry: 1000\n\n'
+            deadline = time.monotonic() + 60
+            while time.monotonic() < deadline:
+                events = batch.wait(position, timeout=15)
+                if not events:
+                    yield ': keep-alive\n\n'
+                    continue
+                for event in events:
+                    position += 1
+                    kind = 'entry' if 'entry' in event else 'finished'
+                    yield f'id: {position}\nevent: {kind}\ndata: {json.dumps(event)}\n\n'
+                if events[-1]['batch'] != 'running':
+                    return
+
+        return Response(stream(position), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
     def set_greeting(self):
         '''
         Sets an existing sound as a user's greeting sound
@@ -257,18 +729,20 @@ class WebApp:
             return jsonify({'error': 'Missing required fields'}), 400
 
         username = secure_filename(data['username'])
-        source_file = os.path.join(self.upload_folder, data['filename'])
-        
-        if not os.path.exists(source_file):
+        entry = self.catalog.get(self.upload_folder, data['filename'])
+        if entry is None:
             return jsonify({'error': 'Source file not found'}), 404
+        source_file = entry.path
 
         # Backup existing greeting if it exists
         self.backup_existing_greeting(username)
 
-        # Copy the selected sound as the new greeting
-        target_file = os.path.join(self.greetings_folder, f"{username}.wav")
+        # Link the selected sound as the new greeting
+        target_file = os.path.join(self.greetings_folder, f"{username}{os.path.splitext(source_file)[1]}")
         try:
-            shutil.copy2(source_file, target_file)
+            self.store.link(source_file, target_file, entry.hash)
+            self.catalog.duplicate(source_file, target_file)
+            self.notify_change(target_file)
             return jsonify({'success': True, 'message': f'Greeting set for {username}'})
         except Exception as e:
             return jsonify({'error': f'Failed to set greeting: {str(e)}'}), 500
@@ -281,46 +755,40 @@ class WebApp:
             return redirect(url_for('login'))
         
         if request.method == 'POST':
+            if governor.busy(governor.TRANSCODE):
+                return self.busy_response()
             if 'file' not in request.files:
-                return render_template('index.html', error='No file selected.')
+                return self.error_response('No file selected.')
             
             file = request.files['file']
             discord_username = request.form.get('discord_username', '').strip()
             
             if file.filename == '' or not discord_username:
-                return render_template('index.html', error='Both file and Discord username are required.')
+                return self.error_response('Both file and Discord username are required.')
             
             if file and self.allowed_file(file.filename):
-                # Backup existing greeting if it exists
-                self.backup_existing_greeting(discord_username)
-
-                # Save new greeting
-                filename = secure_filename(f"{discord_username}.wav")
-                file_path = os.path.join(self.greetings_folder, filename)
-                file.save(file_path)
-                success = self.convert(filename, folder=self.greetings_folder)
-                
-                if success:
-                    return render_template('index.html',
-                                        success=f'Greeting sound for {discord_username} uploaded successfully.',
-                                        uploaded_files=self.filelist(),
-                                        greeting_files=self.filelist(folder=self.greetings_folder))
-                else:
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                    return render_template('index.html',
-                                        error='Something went wrong while converting the file.',
-                                        uploaded_files=self.filelist(),
-                                        greeting_files=self.filelist(folder=self.greetings_folder))
+                # place is reserved before the current greeting is moved to history
+                if not self.admit():
+                    return self.busy_response()
+                try:
+                    # Backup existing greeting if it exists
+                    self.backup_existing_greeting(discord_username)
+
+                    # Save new greeting, it becomes current when conversion is done
+                    filename = self.save_upload(file, self.greetings_folder, secure_filename(discord_username))
+                except BaseException:
+                    governor.release(governor.TRANSCODE)
+                    raise
+                job = self.jobs.submit(f'Converting greeting for {discord_username}', self.run_admitted, self.convert_upload, filename, folder=self.greetings_folder)
+                return self.upload_response(job, f'Greeting sound for {discord_username} uploaded, converting...')
             else:
-                return render_template('index.html',
-                                    error='Invalid file extension.',
-                                    uploaded_files=self.filelist(),
-                                    greeting_files=self.filelist(folder=self.greetings_folder))
+                return self.error_response('Invalid file extension.')
 
     def play_audio(self):
         '''
-        Serves the audio file with the given filename.
+        Serves the audio file with the given filename, or its small preview with preview=1.
+        Responses have the content hash as ETag, so the browser revalidates and gets 304 instead of the file,
+        and support Range requests.
         '''
         if not session.get('logged_in'):
             return redirect(url_for('login'))
@@ -331,12 +799,110 @@ class WebApp:
                 
                 target_folder = self.greetings_folder if folder == 'greetings' else self.app.config['UPLOAD_FOLDER']
                 
-                if filename in self.filelist(folder=target_folder):
-                    return send_from_directory(target_folder, filename)
-                else:
+                entry = self.catalog.get(target_folder, filename)
+                if entry is None:
                     return 'File not found', 404
+                if request.args.get('preview') and entry.hash:
+                    preview_path = self.preview_path(entry)
+                    if os.path.exists(preview_path):
+                        return self.send_audio(preview_path, 'audio/webm', f'{entry.hash}-preview', entry.mtime)
+                    # sound was added without upload, serve it as is until its preview is ready
+                    self.queue_preview(entry)
+                return self.send_audio(entry.path, AUDIO_MIMETYPES[entry.ext], entry.hash, entry.mtime)
             else:
                 return 'Invalid request', 400
+
+    def send_audio(self, path, mimetype, etag, mtime):
+        '''
+        Sends file with conditional GET (ETag, Last-Modified) and Range support.
+        '''
+        response = send_file(
+            os.path.abspath(path),
+            mimetype=mimetype,
+            conditional=True,
+            etag=etag if etag else True,
+            last_modified=mtime / 1e9 if mtime else None
+        )
+        # may be kept by the browser, but must be revalidated before use
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def preview_path(self, entry):
+        '''
+        Preview of a sound, named after its content hash, so replaced sounds never get an old preview.
+        '''
+        return os.path.join(entry.folder, PREVIEW_FOLDER, f'{entry.filename}.{entry.hash[:12]}.webm')
+
+    def make_preview(self, entry):
+        '''
+        Encodes preview of a sound and removes previews of its older versions.
+        '''
+        preview_path = self.preview_path(entry)
+        os.makedirs(os.path.dirname(preview_path), exist_ok=True)
+        if not ingest.encode_preview(entry.path, preview_path):
+            raise RuntimeError(f'Failed to encode preview of {entry.filename}')
+        self.remove_previews(entry.folder, entry.filename, keep=entry.hash)
+        return os.path.basename(preview_path)
+
+    def queue_preview(self, entry):
+        self.queue_backfill(self.preview_path(entry), f'Encoding preview of {entry.filename}', self.make_preview, entry)
+
+    def queue_backfill(self, path, description, make, entry):
+        '''
+        Queues a preview or waveform of a sound added without upload. Backfills have low priority and don't
+        take places of the governor meant for uploads: they are skipped while conversions are backed up and
+        at most BACKFILL_JOBS are queued. A skipped one is queued when it is requested again.
+        '''
+        if governor.busy(governor.TRANSCODE):
+            return
+        with self.preview_lock:
+            if path in self.preview_jobs or len(self.preview_jobs) >= BACKFILL_JOBS:
+                return
+            self.preview_jobs.add(path)
+        self.jobs.submit(description, self.run_preview_job, path, make, entry)
+
+    def run_preview_job(self, path, make, entry):
+        '''
+        Makes a preview queued for `path`. The path is forgotten when the job is done, so a failed one is
+        queued again the next time it is requested.
+        '''
+        try:
+            return make(entry)
+        finally:
+            with self.preview_lock:
+                self.preview_jobs.discard(path)
+
+    def waveform_path(self, entry):
+        '''
+        Waveform envelopes of a sound, named after its content hash like previews.
+        '''
+        return os.path.join(entry.folder, PREVIEW_FOLDER, f'{entry.filename}.{entry.hash[:12]}.peaks')
+
+    def make_waveform(self, entry):
+        '''
+        Computes waveform envelopes of a sound and removes the ones of its older versions.
+        '''
+        path = self.waveform_path(entry)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        waveform.write(path, waveform.compute(entry.path))
+        self.remove_previews(entry.folder, entry.filename, keep=entry.hash)
+        return os.path.basename(path)
+
+    def queue_waveform(self, entry):
+        self.queue_backfill(self.waveform_path(entry), f'Computing waveform of {entry.filename}', self.make_waveform, entry)
+
+    def remove_previews(self, folder, filename, keep=None):
+        '''
+        Removes previews and waveforms of a sound, except the ones of content hash `keep`.
+        '''
+        preview_folder = os.path.join(folder, PREVIEW_FOLDER)
+        if not os.path.isdir(preview_folder):
+            return
+        kept = f'{filename}.{keep[:12]}.' if keep else None
+        for item in os.scandir(preview_folder):
+            path = os.path.join(preview_folder, item.name)
+            if item.name.startswith(f'{filename}.') and item.name.endswith(PREVIEW_EXTENSIONS) and not (kept and item.name.startswith(kept)):
+                os.remove(path)
     
     def delete(self):
         '''
@@ -352,17 +918,15 @@ class WebApp:
                 target_folder = self.greetings_folder if folder == 'greetings' else self.app.config['UPLOAD_FOLDER']
                 file_path = os.path.join(target_folder, filename)
                 
-                if os.path.exists(file_path):
+                if self.catalog.get(target_folder, filename) is not None:
                     os.remove(file_path)
-                    return render_template('index.html',
-                                        success='File deleted.',
-                                        uploaded_files=self.filelist(),
-                                        greeting_files=self.filelist(folder=self.greetings_folder))
+                    self.remove_previews(target_folder, filename)
+                    self.notify_change(file_path)
+                    if self.wants_json():
+                        return jsonify({'success': True, 'message': 'File deleted.'})
+                    return render_template('index.html', success='File deleted.')
                 else:
-                    return render_template('index.html',
-                                        error='File not found.',
-                                        uploaded_files=self.filelist(),
-                                        greeting_files=self.filelist(folder=self.greetings_folder))
+                    return self.error_response('File not found.', 404)
             else:
                 return render_template('index.html')
             
@@ -374,23 +938,52 @@ class WebApp:
     
     def convert(self, filename, folder=None, loudness=-16):
         '''
-        Converts audio file to .wav format with volume normalization.
+        Converts audio file to .wav (or Ogg Opus) format with volume normalization and silence trimmed.
+        Opus is encoded once here with 20 ms frames, so the bot can send packets without re-encoding.
+        Volume is normalized with a linear gain to `loudness` LUFS, limited so true peak stays under -1 dBTP.
+        Returns conversion stats (see ingest.convert), or False if conversion failed.
         '''
         target_folder = folder if folder else self.app.config['UPLOAD_FOLDER']
         file_path = os.path.join(target_folder, filename)
         
         if os.path.exists(file_path):
-            output_path = os.path.join(target_folder, filename.replace('.mp3', '.wav'))
-            subprocess.call(
-                ['ffmpeg', '-i', file_path, '-af', f'loudnorm=I={loudness}', '-ar', '48000', '-ac', '2', '-y', output_path]
-            )
+            base = os.path.splitext(file_path)[0]
+            output_path = f'{base}.{self.audio_format}'
+            # loudness is measured in-process, FFmpeg only decodes and encodes Opus
+            # (temporary files have no audio extension, so they don't show up in file lists)
+            start = time.perf_counter()
+            stats = ingest.convert(file_path, output_path, self.audio_format, loudness, self.trim_db)
+            CONVERT_SECONDS.observe(time.perf_counter() - start, result='failed' if stats is None else 'done')
+            if stats is None:
+                return False
+            integrated = stats['integrated'] + stats['gain']
+            # the same sound uploaded again becomes a link to the stored one
+            self.store.add(output_path)
+            self.catalog.update(output_path, loudness=integrated if integrated != float('-inf') else None,
+                                trim_start=stats.get('trim_start'), trim_end=stats.get('trim_end'))
+            if stats.get('trim_start') is not None:
+                self.app.logger.info(f"{os.path.basename(output_path)}: cut {stats['trim_start'] * 1000:.0f} ms of silence "
+                                     f"at the start and {stats['trim_end'] * 1000:.0f} ms at the end")
+            # preview and waveform for the web interface are made once here, the sound can be played without them
+            entry = self.catalog.get(target_folder, os.path.basename(output_path))
+            for make in (self.make_preview, self.make_waveform):
+                try:
+                    make(entry)
+                except Exception as e:
+                    self.app.logger.warning(e)
             
             # Remove original file if it's different from the output
             if file_path != output_path:
                 os.remove(file_path)
-            return True
+            # Remove the same sound stored in the other format, so only one version is played
+            for ext in AUDIO_EXTENSIONS:
+                if f'{base}{ext}' != output_path and os.path.exists(f'{base}{ext}'):
+                    os.remove(f'{base}{ext}')
+                    self.remove_previews(target_folder, os.path.basename(f'{base}{ext}'))
+            self.notify_change(*[f'{base}{ext}' for ext in AUDIO_EXTENSIONS])
+            return stats
         else:
             return False
     
 if __name__ == "__main__":
-    WebApp()
+    WebApp().run()